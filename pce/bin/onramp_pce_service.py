@@ -35,6 +35,9 @@ Commands:
     jobdelete
         Remove OnRamp job run from environment.
 
+    statemigrate
+        Import file-based module and job state into the configured backend.
+
     shell
         Initializes an interactive python shell in the OnRamp PCE environment.
 """
@@ -52,10 +55,13 @@ from validate import Validator
 from os.path import abspath, expanduser
 
 from PCE import tools
+from PCE.tools.config import get_config
 from PCE.tools.jobs import init_job_delete, job_init_state, job_preprocess, \
                            job_run, get_jobs
 from PCE.tools.modules import deploy_module, get_source_types, \
                               init_module_delete, install_module, ModState
+from PCE.tools.state_backends import FileStateBackend, StateBackend, \
+                                     get_state_backend, migrate_state
 from PCEHelper import pce_root
 
 _pidfile = os.path.join(pce_root, 'src', '.onrampRESTservice.pid')
@@ -570,6 +576,39 @@ def _job_delete():
 
     sys.exit(result)
 
+def _state_migrate():
+    """Import file-based module and job state into the configured backend.
+
+    Usage: onramp_pce_service.py statemigrate [-h] [-v]
+
+    optional arguments:
+      -h, --help     show this help message and exit
+      -v, --verbose  increase output verbosity
+    """
+    descrip = ('Import file-based module and job state into the backend '
+               'configured in onramp_pce_config.cfg.')
+    parser = argparse.ArgumentParser(prog='onramp_pce_service.py statemigrate',
+                                     description=descrip)
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='increase output verbosity')
+    args = parser.parse_args(args=sys.argv[2:])
+
+    if _getPID() > 0:
+        sys.stderr.write('Stop the OnRamp PCE service before migrating state\n')
+        sys.exit(-1)
+
+    dest = get_state_backend()
+    if isinstance(dest, FileStateBackend):
+        sys.stderr.write("Set cluster.state_backend in "
+                         "bin/onramp_pce_config.cfg to a backend other than "
+                         "'file' first\n")
+        sys.exit(-1)
+
+    counts = migrate_state(StateBackend('file'), dest)
+    print ('Imported %d module(s) and %d job(s)'
+           % (counts['modules'], counts['jobs']))
+    sys.exit(0)
+
 def _shell():
     """Initialize an interactive python shell in the OnRamp PCE environment.
 
@@ -598,6 +637,7 @@ switch = {
     'modready': _mod_ready,
     'joblaunch': _job_launch,
     'jobdelete': _job_delete,
+    'statemigrate': _state_migrate,
     'shell': _shell
 }
 
@@ -618,10 +658,7 @@ if __name__ == '__main__':
     }
     log_file = os.path.join(pce_root, 'log', 'onramp.log')
     log_level = 'INFO'
-    cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                    configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec'))
-    cfg.validate(Validator())
+    cfg = get_config()
     if 'cluster' in cfg.keys():
         if 'log_level' in cfg['cluster'].keys():
             log_level = cfg['cluster']['log_level']
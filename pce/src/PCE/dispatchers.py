@@ -8,28 +8,50 @@ Exports:
 """
 
 import logging
+import mimetypes
 import os
-from multiprocessing import Process
+import threading
 
 import cherrypy
+from cherrypy.lib import cptools
 from cherrypy.lib.static import serve_file
 from configobj import ConfigObj
 from validate import Validator
 
 from PCE.tools import get_visible_file
-from PCE.tools.jobs import get_jobs, init_job_delete, launch_job
-from PCE.tools.modules import deploy_module, get_modules, \
-                              get_available_modules, init_module_delete, \
-                              install_module
+from PCE.tools.jobs import get_job_changes, get_job_output, get_jobs, \
+                           init_job_delete
+from PCE.tools.modules import get_modules, get_available_modules, \
+                              init_module_delete
+from PCE.tools.config import get_config
+from PCE.tools.state_backends import get_state_backend
+from PCE.tools.workers import OwnerQueueFull, QueueFull, submit
 from PCEHelper import pce_root
 
+# Seconds clients are asked to wait before retrying when a queue is full.
+_retry_after = 30
+
+# Seconds clients are asked to wait before retrying when too many requests
+# are already long-polling.
+_long_poll_retry_after = 5
+
 class Files:
     """Provide access to visible files in job runs.
 
+    Files are streamed from disk rather than read into memory. Responses carry
+    Content-Length, Last-Modified and ETag headers, conditional GETs are
+    answered with 304 Not Modified, and byte ranges are supported, so a client
+    tailing a running job's output can request only the bytes it has not yet
+    seen (for example, Range: bytes=4096-).
+
     Methods:
         GET: Return requested file.
     """
     exposed = True
+    _cp_config = {
+        'response.stream': True
+    }
+
     def __init__(self, conf, log_name):
         """Initialize Files dispatcher.
 
@@ -55,7 +77,7 @@ class Files:
         result = get_visible_file(args)
         if result[0] == 0:
             # Good.
-            cherrypy.response.headers['Content-Type'] = 'text/plain'
+            return self.serve(result[1])
         if result[0] == -1:
             # Not visible
             cherrypy.response.status = 403
@@ -69,6 +91,26 @@ class Files:
 
         return result[1]
 
+    def serve(self, filename):
+        """Stream the given file, honoring conditional and range requests.
+
+        Args:
+            filename (str): Absolute path of the file to serve.
+
+        Returns:
+            Iterable response body.
+        """
+        st = os.stat(filename)
+        # Changes whenever the file is replaced, grows, or is rewritten. Weak,
+        # as the body may be sent gzip compressed (see RESTservice._gzip()),
+        # and a strong ETag must differ per content encoding.
+        cherrypy.response.headers['ETag'] = 'W/"%x-%x-%x"' % (
+            st.st_ino, st.st_size, int(st.st_mtime * 1000000))
+        cptools.validate_etags()
+
+        content_type = mimetypes.guess_type(filename)[0] or 'text/plain'
+        return serve_file(filename, content_type=content_type)
+
 
 class _OnRampDispatcher:
     """Base class for OnRamp PCE dispatchers."""
@@ -108,6 +150,25 @@ class _OnRampDispatcher:
         response.update(kwargs)
         return response
 
+    def get_queue_full_response(self, e):
+        """Set the response status for a task rejected by the worker queue and
+        return the response.
+
+        Args:
+            e (QueueFull): The rejection.
+
+        Returns:
+            OnRamp formatted response dict including the queue depth.
+        """
+        self.logger.warn(str(e))
+        if isinstance(e, OwnerQueueFull):
+            cherrypy.response.status = 429
+        else:
+            cherrypy.response.status = 503
+        cherrypy.response.headers['Retry-After'] = str(_retry_after)
+        return self.get_response(status_code=-7, status_msg=str(e),
+                                 queue_depth=e.depth)
+
     def log_call(self, func_name):
         """Log entry into the given dispatcher.
         
@@ -245,14 +306,15 @@ class Modules(_OnRampDispatcher):
                 self.logger.warn(msg)
                 return self.get_response(status_code=-8, status_msg=msg)
                 
-            state_file = os.path.join(pce_root, 'src/state/modules/%d' % mod_id)
-            if not os.path.isfile(state_file):
+            if get_state_backend().load('modules', mod_id) is None:
                 msg = 'Module %d not installed' % mod_id
                 self.logger.warn(msg)
                 return self.get_response(status_code=-2, status_msg=msg)
 
-            p = Process(target=deploy_module, args=(mod_id,))
-            p.start()
+            try:
+                submit('deploy_module', mod_id)
+            except QueueFull as e:
+                return self.get_queue_full_response(e)
             return self.get_response(status_msg='Deployment initiated')
 
         # Check params and initiate install.
@@ -270,8 +332,10 @@ class Modules(_OnRampDispatcher):
             data['mod_name']
         )
 
-        p = Process(target=install_module, args=install_args)
-        p.start()
+        try:
+            submit('install_module', *install_args)
+        except QueueFull as e:
+            return self.get_queue_full_response(e)
 
         return self.get_response(status_msg='Checkout initiated')
 
@@ -324,30 +388,147 @@ class Jobs(_OnRampDispatcher):
     """Provide API for OnRamp jobs resource.
 
     Methods:
-        GET: Get status/results for specific job.
+        GET: Get status/results for specific job or list of jobs.
         POST: Launch a new job.
         PUT: Update a specific job.
         DELETE: Delete a specific job.
     """
-    def GET(self, id, **kwargs):
-        """Get status/results for specific job.
+    # Number of requests currently long-polling.
+    _waiting = 0
+    _waiting_lock = threading.Lock()
 
-        Args:
-            id (str): Id of the job to inspect.
+    def GET(self, id=None, resource=None, **kwargs):
+        """Get status/results for specific job or list of jobs.
 
         Kwargs:
-            **kwargs (dict): HTTP query-string parameters. Not currently used.
+            id (str): None signals list get, if not None, return specific job.
+            resource (str): If 'output', return part of the job's output
+                instead of the job (see get_output()).
+            **kwargs (dict): HTTP query-string parameters. When listing jobs,
+                'state' and 'username' restrict the list to matching jobs,
+                'ids' (comma-separated job ids) to the given jobs, and
+                'since' (a state version) to jobs changed after it. Lists
+                requested with 'since' include the current 'state_version'.
+                With 'since', 'wait' gives seconds to wait for a change if
+                there is none yet (see get_changes()).
 
         Returns:
             OnRamp formatted dict containing requested job data.
         """
         self.log_call('GET')
 
+        if resource == 'output':
+            return self.get_output(id, **kwargs)
+        if resource is not None:
+            raise cherrypy.NotFound()
+
+        # Job state is kept current by the background poller when enabled.
+        cached = self.conf['cluster']['poll_interval'] > 0
+
         # Return the resource.
         if id:
-            return self.get_response(job=get_jobs(job_id=id))
+            return self.get_response(job=get_jobs(job_id=id, cached=cached))
         else:
-            return self.get_response(jobs=get_jobs())
+            filters = dict((k, kwargs[k]) for k in ['state', 'username']
+                           if k in kwargs.keys())
+            try:
+                if 'ids' in kwargs.keys():
+                    filters['job_ids'] = [int(job_id) for job_id
+                                          in kwargs['ids'].split(',')
+                                          if job_id.strip()]
+                since = None
+                if 'since' in kwargs.keys():
+                    since = int(kwargs['since'])
+                wait = float(kwargs.get('wait', 0))
+            except ValueError:
+                cherrypy.response.status = 400
+                msg = 'Invalid ids, since or wait: %s' % kwargs
+                self.logger.warn(msg)
+                return self.get_response(status_code=-8, status_msg=msg)
+
+            if since is not None:
+                return self.get_changes(since, wait, cached, **filters)
+            return self.get_response(jobs=get_jobs(cached=cached, **filters))
+
+    def get_changes(self, since, wait, cached, **filters):
+        """Return jobs changed after a state version (GET /jobs/?since=N),
+        waiting up to wait seconds for a change if there is none yet.
+
+        Waiting requests hold a server thread, so wait is capped at
+        long_poll.max_wait, and requests that would wait while
+        long_poll.max_waiters others are waiting are rejected with HTTP 503.
+
+        Args:
+            since (int): State version to report changes after.
+            wait (float): Seconds to wait for a change.
+            cached (bool): As for get_jobs().
+            **filters: As for get_jobs().
+
+        Returns:
+            OnRamp formatted dict containing the changed jobs and the current
+            state version.
+        """
+        cfg = get_config()['long_poll']
+        wait = min(wait, cfg['max_wait'])
+        if wait > 0:
+            with Jobs._waiting_lock:
+                if Jobs._waiting >= cfg['max_waiters']:
+                    wait = None
+                else:
+                    Jobs._waiting += 1
+            if wait is None:
+                msg = 'Too many requests waiting for job changes'
+                self.logger.warn(msg)
+                cherrypy.response.status = 503
+                cherrypy.response.headers['Retry-After'] = \
+                    str(_long_poll_retry_after)
+                return self.get_response(status_code=-7, status_msg=msg)
+
+        try:
+            jobs, version = get_job_changes(since, cached=cached, wait=wait,
+                                            interval=cfg['interval'],
+                                            **filters)
+        finally:
+            if wait > 0:
+                with Jobs._waiting_lock:
+                    Jobs._waiting -= 1
+        return self.get_response(jobs=jobs, state_version=version)
+
+    def get_output(self, id, offset='0', limit=None, **kwargs):
+        """Return part of a job's output (GET /jobs/ID/output).
+
+        Args:
+            id (str): Id of the job.
+
+        Kwargs:
+            offset (str): Byte offset in output.txt to read from.
+            limit (str): Maximum number of bytes to return.
+
+        Returns:
+            OnRamp formatted dict containing the output chunk ('output'), its
+            offset, the offset to request next ('next_offset'), the current
+            size of the output and the job state.
+        """
+        try:
+            job_id = int(id)
+            offset = int(offset)
+            if limit is None:
+                result = get_job_output(job_id, offset)
+            else:
+                result = get_job_output(job_id, offset, int(limit))
+        except ValueError:
+            cherrypy.response.status = 400
+            msg = 'Invalid job id, offset or limit: %s' % id
+            self.logger.warn(msg)
+            return self.get_response(status_code=-8, status_msg=msg)
+
+        if result[0] == -2:
+            cherrypy.response.status = 404
+            return self.get_response(status_code=-2, status_msg=result[1])
+        if result[0] != 0:
+            cherrypy.response.status = 400
+            return self.get_response(status_code=-8, status_msg=result[1])
+        return self.get_response(**result[1])
 
     def POST(self, **kwargs):
         """Launch a new job.
@@ -377,8 +558,10 @@ class Jobs(_OnRampDispatcher):
         else:
             args += (None,)
 
-        p = Process(target=launch_job, args=args)
-        p.start()
+        try:
+            submit('job_launch_task', *args, owner=data['username'])
+        except QueueFull as e:
+            return self.get_queue_full_response(e)
         return self.get_response(status_msg='Job launched')
 
     def PUT(self, id, **kwargs):
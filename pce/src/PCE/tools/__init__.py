@@ -13,7 +13,6 @@ Exports:
     modules: Functionality for working with OnRamp educational modules. DEPRECATED.
 """
 
-import glob
 import hashlib
 import json
 import logging
@@ -25,18 +24,19 @@ from configobj import ConfigObj
 from Crypto import Random
 from Crypto.Cipher import AES
 
+from PCE.tools.visibility import get_visibility_index
 from PCEHelper import pce_root
 
 def get_visible_file(dirs):
-    """Verify access allowed to requested file and return it.
+    """Verify access allowed to requested file and return its path.
 
     Args:
         dirs (list of str): Ordered list of folder names between base_dir
             (currently onramp/pce/users) and specific file.
 
     Returns:
-        Tuple consisting of error code and either the requested file if no error
-        or string indicating cause of error.
+        Tuple consisting of error code and either the absolute path of the
+        requested file if no error or string indicating cause of error.
     """
     num_parent_dirs = 3
     if len(dirs) <= num_parent_dirs or '..' in dirs:
@@ -46,28 +46,16 @@ def get_visible_file(dirs):
                            '/'.join(dirs[:num_parent_dirs]))
     filename = os.path.join(run_dir, '/'.join(dirs[num_parent_dirs:]))
 
-    cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
-    try:
-        conf = ConfigObj(cfg_file, file_error=True)
-    except (IOError, SyntaxError):
+    index = get_visibility_index(run_dir)
+    if index is None:
         return (-3, 'Badly formed or non-existant config/onramp_metadata.cfg') 
 
-    if 'onramp' in conf.keys() and 'visible' in conf['onramp'].keys():
-        globs = conf['onramp']['visible']
-        if isinstance(globs, basestring):
-            # Globs is only a single string. Convert to list.
-            globs = [globs]
-    else:
-        globs = []
-
+    if index.is_visible(os.path.relpath(filename, run_dir)):
+        return (0, filename)
 
     if not os.path.isfile(filename):
         return (-2, 'Requested file not found') 
 
-    for entry in globs:
-        if filename in glob.glob(os.path.join(run_dir, entry)):
-            return (0, open(os.path.join(run_dir, filename), 'r'))
-
     return (-1, 'Requested file not configured to be visible')
 
 def module_log(mod_root, log_id, msg):
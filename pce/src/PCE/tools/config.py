@@ -0,0 +1,182 @@
+"""Process-wide access to onramp_pce_config.cfg.
+
+The configuration is loaded and validated once per process and handed out from
+memory, so request handling and status polling do no config file I/O. It is
+reloaded when reload_config() is called (the service does this on SIGHUP), or
+when check_config() finds that the file has been modified (the service calls
+it periodically from a background thread).
+
+Exports:
+    ConfigService: Loads, validates and caches a PCE configuration file.
+    config_service: Process-wide ConfigService for onramp_pce_config.cfg.
+    get_config: Return the current configuration.
+    get_scheduler: Return the scheduler for the configured batch scheduler.
+    reload_config: Reload the configuration.
+    check_config: Reload the configuration if its file has been modified.
+"""
+import logging
+import os
+import threading
+
+from configobj import ConfigObj, ConfigObjError, flatten_errors
+from validate import Validator
+
+from PCE.tools.schedulers import Scheduler
+from PCEHelper import pce_root
+
+_cfg_file = os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg')
+_cfg_spec = os.path.join(pce_root, 'src', 'configspecs',
+                         'onramp_pce_config.cfgspec')
+_logger = logging.getLogger('onramp')
+
+
+class ConfigService(object):
+    """Load, validate and cache a PCE configuration file.
+
+    All methods are thread-safe. Configuration objects handed out are never
+    modified; a reload replaces them.
+    """
+
+    def __init__(self, cfg_file=_cfg_file, cfg_spec=_cfg_spec):
+        """Return an initialized ConfigService. Nothing is loaded until the
+        configuration is first requested.
+
+        Kwargs:
+            cfg_file (str): Path of the configuration file.
+            cfg_spec (str): Path of the configspec to validate against.
+        """
+        self.cfg_file = cfg_file
+        self.cfg_spec = cfg_spec
+        self._lock = threading.RLock()
+        self._cfg = None
+        self._mtime = None
+        self._schedulers = {}
+
+    def _stat(self):
+        try:
+            return os.stat(self.cfg_file).st_mtime
+        except OSError:
+            return None
+
+    def _load(self):
+        """Return (validated ConfigObj, list of validation errors)."""
+        cfg = ConfigObj(self.cfg_file, configspec=self.cfg_spec)
+        result = cfg.validate(Validator(), preserve_errors=True)
+        errors = []
+        if result is not True:
+            for sections, key, error in flatten_errors(cfg, result):
+                errors.append('%s: %s' % ('.'.join(sections + [str(key)]),
+                                          error or 'missing'))
+        return (cfg, errors)
+
+    def get(self):
+        """Return the current configuration, loading it on first use.
+
+        Returns:
+            Validated ConfigObj.
+        """
+        cfg = self._cfg
+        if cfg is not None:
+            return cfg
+        with self._lock:
+            if self._cfg is None:
+                mtime = self._stat()
+                cfg, errors = self._load()
+                for error in errors:
+                    _logger.warn('Invalid value in %s: %s'
+                                 % (self.cfg_file, error))
+                self._mtime = mtime
+                self._cfg = cfg
+            return self._cfg
+
+    def reload(self):
+        """Reload the configuration.
+
+        If the file cannot be parsed or fails validation, the current
+        configuration is kept.
+
+        Returns:
+            True if the configuration was reloaded, False if not.
+        """
+        with self._lock:
+            mtime = self._stat()
+            try:
+                cfg, errors = self._load()
+            except (IOError, ConfigObjError) as e:
+                _logger.error('Not reloading %s: %s' % (self.cfg_file, e))
+                return False
+            if errors and self._cfg is not None:
+                _logger.error('Not reloading %s: %s'
+                              % (self.cfg_file, '; '.join(errors)))
+                return False
+            self._mtime = mtime
+            self._cfg = cfg
+            self._schedulers = {}
+            _logger.info('Loaded configuration from %s' % self.cfg_file)
+            return True
+
+    def check(self):
+        """Reload the configuration if its file has been modified since it was
+        loaded.
+
+        Returns:
+            True if the configuration was reloaded, False if not.
+        """
+        if self._cfg is None:
+            self.get()
+            return False
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return False
+        with self._lock:
+            if mtime == self._mtime:
+                return False
+            if not self.reload():
+                # Don't retry the same broken file on every check.
+                self._mtime = mtime
+                return False
+            return True
+
+    def get_scheduler(self):
+        """Return the scheduler for the configured batch scheduler.
+
+        The instance is created once and shared until the configuration is
+        reloaded.
+
+        Returns:
+            Instance of a _BatchScheduler.
+        """
+        type = self.get()['cluster']['batch_scheduler']
+        scheduler = self._schedulers.get(type)
+        if scheduler is None:
+            with self._lock:
+                scheduler = self._schedulers.get(type)
+                if scheduler is None:
+                    scheduler = Scheduler(type)
+                    self._schedulers[type] = scheduler
+        return scheduler
+
+
+config_service = ConfigService()
+
+def get_config():
+    """Return the current onramp_pce_config.cfg configuration. See
+    ConfigService.get().
+    """
+    return config_service.get()
+
+def get_scheduler():
+    """Return the scheduler for the batch scheduler configured in
+    onramp_pce_config.cfg. See ConfigService.get_scheduler().
+    """
+    return config_service.get_scheduler()
+
+def reload_config():
+    """Reload onramp_pce_config.cfg. See ConfigService.reload()."""
+    return config_service.reload()
+
+def check_config():
+    """Reload onramp_pce_config.cfg if it has been modified. See
+    ConfigService.check().
+    """
+    return config_service.check()
@@ -5,21 +5,24 @@ Exports:
     JobState: Encapsulation of job state that avoids race conditions.
     launch_job: Schedules job launch using system batch scheduler as configured
         in onramp_pce_config.cfg.
+    job_launch_task: Worker task launching a job.
     get_jobs: Returns list of tracked jobs or single job.
+    get_job_output: Returns part of a job's output.
+    poll_jobs: Refresh scheduler state of active jobs and the job cache.
     init_job_delete: Initiate the deletion of a job.
 """
 import argparse
 import copy
 import errno
 import fcntl
+import hashlib
 import json
-import glob
 import logging
 import os
 import shutil
 import sys
+import threading
 import time
-from itertools import chain
 from multiprocessing import Process
 from subprocess import CalledProcessError, call, check_output, STDOUT
 
@@ -27,14 +30,27 @@ from configobj import ConfigObj
 from validate import Validator
 
 from PCE.tools import module_log
+from PCE.tools.config import get_config, get_scheduler
+from PCE.tools.locks import lock_manager
+from PCE.tools.state_backends import _SingleFileBackend, get_state_backend
+from PCE.tools.workers import submit, worker_task
 from PCE.tools.modules import ModState
-from PCE.tools.schedulers import Scheduler
+from PCE.tools.rundirs import materialize_run_dir
+from PCE.tools.visibility import get_visibility_index
 from PCEHelper import pce_root
 
 _job_state_dir = os.path.join(pce_root, 'src/state/jobs')
 _mod_install_dir = os.path.join(pce_root, 'modules')
+_status_check_states = ['Scheduled', 'Queued', 'Running']
+# Largest number of bytes of job output returned by one get_job_output() call.
+_max_output_chunk = 1048576
 _logger = logging.getLogger('onramp')
 
+# Built jobs keyed by job id, each stored with the state backend signature of
+# the state it was built from. Maintained by poll_jobs() and _get_cached_job().
+_job_cache = {}
+_job_cache_lock = threading.Lock()
+
 class JobState(dict):
     """Provide access to job state in a way that race conditions are avoided.
     JobState() is only intended to be used in combination with the 'with' python
@@ -46,44 +62,50 @@ class JobState(dict):
             job_state['key2'] = 'val2'
     """
 
-    def __init__(self, id, job_state_file=None):
+    def __init__(self, id, job_state_file=None, read_only=False,
+                 lock_timeout=None):
         """Return initialized JobState instance.
         Method works in get-or-create fashion, that is, if state exists for
         job id, open and return it, else create and return it.
         Args:
             id (int): Id of the job to get/create state for.
+        Kwargs:
+            job_state_file (str): Path of the state file, if not the default.
+            read_only (bool): If True, take a shared lock and never write
+                state back, allowing concurrent readers. Changes made to a
+                read-only instance are discarded.
+            lock_timeout (float/None): Seconds to wait for the state lock.
+                None waits indefinitely.
+        Raises:
+            LockTimeout: The state lock could not be acquired in time.
         """
         if job_state_file is None:
-            job_state_file = os.path.join(_job_state_dir, str(id))
+            self._backend = get_state_backend()
+        else:
+            self._backend = _SingleFileBackend(job_state_file)
 
         self.job_id = id
-        self._lock_filename = os.path.join(_job_state_dir, '%s.lock' % str(id))
-        self._job_state_filename = job_state_file
-
-        while(True):
-            try:
-                # Raises OSError if file cannot be opened in create mode.
-                os.open(self._lock_filename,
-                        os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                break
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                time.sleep(.001)
+        self._lock_filename = os.path.join(_job_state_dir, '.%s.lock' % str(id))
+        self._read_only = read_only
+        self._lock = lock_manager.acquire(self._lock_filename,
+                                          shared=read_only,
+                                          timeout=lock_timeout)
 
         try:
-            self._state_file = open(job_state_file, 'r+')
-            data = json.load(self._state_file)
+            data = self._backend.load('jobs', id)
+        except:
+            self._lock.release()
+            raise
+        if data:
             self.update(data)
-            self._state_file.seek(0)
-        except IOError as e1:
-            if e1.errno != errno.ENOENT:
-                raise
-            self._state_file = open(job_state_file, 'w')
-        except ValueError as e2:
-            #_logger.debug('BAD JSON: %s' % file_contents)
-            # Invalid json. Ignore (will be overwritten by _close().
-            pass
+        # Stored state as loaded, used to skip writing unchanged state.
+        self._stored = copy.deepcopy(data)
+
+    def __deepcopy__(self, memo):
+        """Return a deep copy of the state parameters as a plain dict.
+        The copy carries no lock or file handles and may outlive the instance.
+        """
+        return copy.deepcopy(dict(self), memo)
 
     def __enter__(self):
         """Provide entry for use in 'with' statements."""
@@ -98,27 +120,22 @@ class JobState(dict):
             return False
 
     def _close(self):
-        """Serialize and store state parameters.
+        """Serialize and store state parameters, then release the state lock.
         If stored state exists, overwrite it with current instance keys/vals.
+        Nothing is written for read-only instances, or if the state parameters
+        are unchanged since they were loaded.
         """
-        if 'state' in self.keys() and self['state'] != 'Does not exist':
-            json.dump(self, self._state_file)
-            self._state_file.truncate()
-            self._state_file.close()
-        else:
-            _logger.debug("REMOVING STATE FILE with state: %s" % str(self))
-            try:
-                self._state_file.close()
-                os.remove(self._job_state_filename)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise e
-
         try:
-            os.remove(self._lock_filename)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise e
+            if self._read_only:
+                return
+            if 'state' in self.keys() and self['state'] != 'Does not exist':
+                if dict(self) != self._stored:
+                    self._backend.save('jobs', self.job_id, self)
+            elif self._stored is not None:
+                _logger.debug("REMOVING STATE with state: %s" % str(self))
+                self._backend.delete('jobs', self.job_id)
+        finally:
+            self._lock.release()
 
 
 def launch_job(job_id, mod_id, username, run_name, run_params):
@@ -133,12 +150,38 @@ def launch_job(job_id, mod_id, username, run_name, run_params):
         Tuple with 0th position being error code and 1st position being string
         indication of status.
     """
-    accepted_states = ['Schedule failed', 'Launch failed', 'Preprocess failed']
     _logger.debug('PCE.tools.launch_job() called')
+    ret = _prepare_job(job_id, mod_id, username, run_name, run_params)
+    if ret[0] != 0:
+        return ret
+    return job_run(job_id)
+
+@worker_task('preprocess')
+def job_launch_task(job_id, mod_id, username, run_name, run_params):
+    """Initialize and preprocess job as a worker task, then queue it for
+    scheduling.
+    Args:
+        job_id (int): Unique identifier for job.
+        mod_id (int): Id for OnRamp educational module to run in this job.
+        username (str): Username of user running the job.
+        run_name (str): Human-readable label for this job run.
+    Returns:
+        Tuple with 0th position being error code and 1st position being string
+        indication of status.
+    """
+    ret = _prepare_job(job_id, mod_id, username, run_name, run_params)
+    if ret[0] != 0:
+        return ret
+    submit('job_run', job_id, force=True)
+    return (0, 'Job queued for scheduling')
+
+def _prepare_job(job_id, mod_id, username, run_name, run_params):
+    """Check that job may be launched, then initialize and preprocess it."""
+    accepted_states = ['Schedule failed', 'Launch failed', 'Preprocess failed']
 
     # Initialize job state.
     _logger.debug('Check if state exists and if so if accepted')
-    with JobState(job_id) as job_state:
+    with JobState(job_id, read_only=True) as job_state:
         if ('state' in job_state.keys()
             and job_state['state'] not in accepted_states):
             msg = ('Job launch already initiated. '
@@ -149,10 +192,7 @@ def launch_job(job_id, mod_id, username, run_name, run_params):
     ret = job_init_state(job_id, mod_id, username, run_name, run_params)
     if ret[0] != 0:
         return ret
-    ret = job_preprocess(job_id)
-    if ret[0] != 0:
-        return ret
-    return job_run(job_id)
+    return job_preprocess(job_id)
 
 def job_init_state(job_id, mod_id, username, run_name, run_params,
                    job_state_file=None, mod_state_file=None,
@@ -170,12 +210,13 @@ def job_init_state(job_id, mod_id, username, run_name, run_params,
         job_state['state'] = 'Setting up launch'
         job_state['error'] = None
         job_state['mod_status_output'] = None
-        job_state['output'] = None
+        job_state['output_size'] = None
+        job_state['output_digest'] = None
         job_state['visible_files'] = None
         job_state['mod_name'] = None
         job_state['_marked_for_del'] = False
         _logger.debug('Waiting on ModState at: %s' % time.time())
-        with ModState(mod_id, mod_state_file) as mod_state:
+        with ModState(mod_id, mod_state_file, read_only=True) as mod_state:
             _logger.debug('Done waiting on ModState at: %s' % time.time())
             if ('state' not in mod_state.keys()
                 or mod_state['state'] != 'Module ready'):
@@ -227,8 +268,8 @@ def job_init_state(job_id, mod_id, username, run_name, run_params,
     # The way the following is setup, if a run_dir has already been setup with
     # this run_name, it will be used (that is, not overwritten) for this launch.
     try:
-        shutil.copytree(proj_loc, run_dir)
-    except (shutil.Error, OSError) as e:
+        materialize_run_dir(proj_loc, run_dir)
+    except OSError as e:
         pass
     if run_params:
         _logger.debug('Handling run_params')
@@ -247,7 +288,6 @@ def job_init_state(job_id, mod_id, username, run_name, run_params,
 
 
 def job_preprocess(job_id, job_state_file=None):
-    ret_dir = os.getcwd()
     _logger.info('Calling bin/onramp_preprocess.py')
     _logger.debug('Want JobState (preprocess) at: %s' % time.time())
     with JobState(job_id, job_state_file) as job_state:
@@ -256,12 +296,13 @@ def job_preprocess(job_id, job_state_file=None):
         job_state['state'] = 'Preprocessing'
         job_state['error'] = None
         run_dir = job_state['run_dir']
-    os.chdir(run_dir)
     _logger.debug('Done with JobState (preprocess) at: %s' % time.time())
 
+    result = ''
     try:
         result = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                               'bin/onramp_preprocess.py'], stderr=STDOUT)
+                               'bin/onramp_preprocess.py'], stderr=STDOUT,
+                              cwd=run_dir)
     except CalledProcessError as e:
         code = e.returncode
         if code > 127:
@@ -279,39 +320,33 @@ def job_preprocess(job_id, job_state_file=None):
         return (-1, msg)
     finally:
         module_log(run_dir, 'preprocess', result)
-        os.chdir(ret_dir)
 
     return (0, 'Job preprocess complete')
 
+@worker_task('schedule')
 def job_run(job_id, job_state_file=None):
     # Determine batch scheduler to user from config.
-    cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                    configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec'))
-    cfg.validate(Validator())
-    scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
-
-    _logger.debug("in job_run: trying to launch using scheduler %s", cfg['cluster']['batch_scheduler'])
-    #ret_dir = os.getcwd()
-    with JobState(job_id, job_state_file) as job_state:
+    scheduler = get_scheduler()
+
+    _logger.debug("in job_run: trying to launch using scheduler %s",
+                  get_config()['cluster']['batch_scheduler'])
+    with JobState(job_id, job_state_file, read_only=True) as job_state:
         run_dir = job_state['run_dir']
         run_name = job_state['run_name']
-    os.chdir(run_dir)
 
-    #_logger.debug("in job_run: attempting to be in %s, really in %s", run_dir, os.get_cwd())
     # Load run params:
     run_np = None
     run_nodes = None
-    run_cfg = ConfigObj('onramp_runparams.cfg')
+    run_cfg = ConfigObj(os.path.join(run_dir, 'onramp_runparams.cfg'))
     if 'onramp' in run_cfg.keys():
         if 'np' in run_cfg['onramp']:
             run_np = run_cfg['onramp']['np']
         if 'nodes' in run_cfg['onramp']:
             run_nodes = run_cfg['onramp']['nodes']
 
-    _logger.debug("in job_run: loaded params np: %d and nodes: %d", run_np, run_nodes)
+    _logger.debug("in job_run: loaded params np: %s and nodes: %s", run_np, run_nodes)
     # Write batch script.
-    with open('script.sh', 'w') as f:
+    with open(os.path.join(run_dir, 'script.sh'), 'w') as f:
         if run_np and run_nodes:
             f.write(scheduler.get_batch_script(run_name, numtasks=run_np,
                     num_nodes=run_nodes))
@@ -330,7 +365,6 @@ def job_run(job_id, job_state_file=None):
         with JobState(job_id, job_state_file) as job_state:
             job_state['state'] = 'Schedule failed'
             job_state['error'] = result['msg']
-            os.chdir(ret_dir)
             if job_state['_marked_for_del']:
                 _delete_job(job_state)
                 return (-2, 'Job %d deleted' % job_id)
@@ -340,13 +374,13 @@ def job_run(job_id, job_state_file=None):
         job_state['state'] = 'Scheduled'
         job_state['error'] = None
         job_state['scheduler_job_num'] = result['job_num']
-        os.chdir(ret_dir)
         if job_state['_marked_for_del']:
             _delete_job(job_state)
             return (-2, 'Job %d deleted' % job_id)
 
     return (0, 'Job scheduled')
 
+@worker_task('postprocess')
 def job_postprocess(job_id, job_state_file=None):
     """Run bin/onramp_postprocess.py for job_id and update state to reflect.
     Args:
@@ -358,20 +392,20 @@ def job_postprocess(job_id, job_state_file=None):
     _logger.info('PCE.tools.jobs._job_postprocess() called')
 
     # Get attrs needed.
-    with JobState(job_id, job_state_file) as job_state:
+    with JobState(job_id, job_state_file, read_only=True) as job_state:
         username = job_state['username']
         mod_id = job_state['mod_id']
         run_name = job_state['run_name']
         mod_name = job_state['mod_name']
         run_dir = job_state['run_dir']
     args = (username, mod_name, mod_id, run_name)
-    ret_dir = os.getcwd()
 
-    os.chdir(run_dir)
     _logger.debug('Calling bin/onramp_postprocess.py')
+    result = ''
     try:
         result = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                               'bin/onramp_postprocess.py'], stderr=STDOUT)
+                               'bin/onramp_postprocess.py'], stderr=STDOUT,
+                              cwd=run_dir)
     except CalledProcessError as e:
         code = e.returncode
         if code > 127:
@@ -383,7 +417,6 @@ def job_postprocess(job_id, job_state_file=None):
             job_state['state'] = 'Postprocess failed'
             job_state['error'] = msg
             _logger.error(msg)
-            os.chdir(ret_dir)
             if job_state['_marked_for_del']:
                 _delete_job(job_state)
                 return (-2, 'Job %d deleted' % job_id)
@@ -391,20 +424,40 @@ def job_postprocess(job_id, job_state_file=None):
     finally:
         module_log(run_dir, 'postprocess', result)
 
-    # Grab job output.
-    with open('output.txt', 'r') as f:
-        output = f.read()
-    os.chdir(ret_dir)
+    # Record the size and digest of the job output. The output itself is
+    # fetched with get_job_output().
+    output_size, output_digest = _output_digest(run_dir)
 
     # Update state.
     with JobState(job_id, job_state_file) as job_state:
         job_state['state'] = 'Done'
         job_state['error'] = None
-        job_state['output'] = output
+        job_state['output_size'] = output_size
+        job_state['output_digest'] = output_digest
         if job_state['_marked_for_del']:
             _delete_job(job_state)
             return (-2, 'Job %d deleted' % job_id)
 
+    return (0, 'Job postprocess complete')
+
+def _output_digest(run_dir):
+    """Return the size and SHA-256 hex digest of a job's output.txt.
+    Args:
+        run_dir (str): Absolute path of the job's run folder.
+    Returns:
+        Tuple (size, digest), or (None, None) if there is no output.txt.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    try:
+        with open(os.path.join(run_dir, 'output.txt'), 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                sha.update(chunk)
+                size += len(chunk)
+    except IOError:
+        return (None, None)
+    return (size, sha.hexdigest())
+
 def _get_module_status_output(run_dir):
     """Run bin/onramp_status.py for job and return any output.
     Args:
@@ -413,14 +466,12 @@ def _get_module_status_output(run_dir):
         String containint output to stdout and stderr frob job's
         bin/onramp_status.py script.
     """
-    ret_dir = os.getcwd()
-
     # Run bin/onramp_status.py and grab output.
-    os.chdir(run_dir)
     _logger.debug('Calling bin/onramp_status.py')
     try:
         output = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                               'bin/onramp_status.py'], stderr=STDOUT)
+                               'bin/onramp_status.py'], stderr=STDOUT,
+                              cwd=run_dir)
     except CalledProcessError as e:
         code = e.returncode
         if code > 127:
@@ -429,10 +480,33 @@ def _get_module_status_output(run_dir):
                % (code, e.output))
 
     module_log(run_dir, 'status', output)
-    os.chdir(ret_dir)
     return output
 
-def _build_job(job_id, job_state_file=None):
+def _get_scheduler_statuses(job_ids=None):
+    """Query the batch scheduler once for all jobs awaiting completion.
+    Kwargs:
+        job_ids (list/None): If given, only consider jobs with these ids.
+    Returns:
+        Dict mapping job id (as str) to the 2-tuple returned by the
+        scheduler's check_status() for each job in a state that requires
+        status checking.
+    """
+    active = get_state_backend().load_many('jobs', state=_status_check_states)
+    if job_ids is not None:
+        job_ids = set(str(job_id) for job_id in job_ids)
+    sched_job_nums = dict((job_id, data['scheduler_job_num'])
+                          for job_id, data in active.items()
+                          if job_ids is None or job_id in job_ids)
+
+    if not sched_job_nums:
+        return {}
+
+    statuses = get_scheduler().check_status_many(sched_job_nums.values())
+    return dict((job_id, statuses[job_num])
+                for job_id, job_num in sched_job_nums.items())
+
+def _build_job(job_id, job_state_file=None, job_status=None,
+               check_status=True):
     """Launch actions required to maintain job state and/or currate job results
     and return the state.
     When current job state (as a function of both PCE state tracking and
@@ -440,27 +514,29 @@ def _build_job(job_id, job_state_file=None):
     checking prior to building and returning state.
     Args:
         job_id (int): Id of the job to get state for.
+    Kwargs:
+        job_status (tuple/None): Scheduler status for the job as already
+            returned by check_status(). If None and the job is awaiting
+            completion, the scheduler is queried for it.
+        check_status (bool): If False, only build the job from stored state.
+            The scheduler is not queried, no scripts are run and state is
+            opened read-only.
     Returns:
         OnRamp formatted dictionary containing job attrs.
     """
-    status_check_states = ['Scheduled', 'Queued', 'Running']
-    with JobState(job_id, job_state_file) as job_state:
+    with JobState(job_id, job_state_file,
+                  read_only=not check_status) as job_state:
         _logger.debug('Building at %s' % time.time())
         if 'state' not in job_state.keys():
             _logger.debug('No state at %s' % time.time())
             _logger.debug('job_state keys: %s' % job_state.keys())
             return {}
 
-        if job_state['state'] in status_check_states:
-            specfile = os.path.join(pce_root, 'src', 'configspecs',
-                                    'onramp_pce_config.cfgspec')
-            cfg = ConfigObj(os.path.join(pce_root, 'bin',
-                                         'onramp_pce_config.cfg'),
-                            configspec=specfile)
-            cfg.validate(Validator())
-            scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
-            sched_job_num = job_state['scheduler_job_num']
-            job_status = scheduler.check_status(sched_job_num)
+        if check_status and job_state['state'] in _status_check_states:
+            if job_status is None:
+                scheduler = get_scheduler()
+                sched_job_num = job_state['scheduler_job_num']
+                job_status = scheduler.check_status(sched_job_num)
 
             # Bad.
             if job_status[0] != 0:
@@ -484,8 +560,12 @@ def _build_job(job_id, job_state_file=None):
                     return copy.deepcopy(job_state)
                 job_state['error'] = None
                 job_state['mod_status_output'] = None
-                p = Process(target=job_postprocess, args=(job_id, job_state_file))
-                p.start()
+                if job_state_file is None:
+                    submit('job_postprocess', job_id, force=True)
+                else:
+                    p = Process(target=job_postprocess,
+                                args=(job_id, job_state_file))
+                    p.start()
             elif job_status[1] == 'Running':
                 job_state['state'] = 'Running'
                 job_state['error'] = None
@@ -514,32 +594,12 @@ def _build_job(job_id, job_state_file=None):
     dir_args = (job['username'], job['mod_name'], job['mod_id'],
                 job['run_name'])
     run_dir = os.path.join(pce_root, 'users/%s/%s_%d/%s' % dir_args)
-    cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
-    try:
-        conf = ConfigObj(cfg_file, file_error=True)
-    except (IOError, SyntaxError):
+    index = get_visibility_index(run_dir)
+    if index is None:
         # Badly formed or non-existant config/onramp_metadata.cfg.
-        _logger.debug('Bad metadata')
-        _logger.debug(cfg_file)
+        _logger.debug('Bad metadata in %s' % run_dir)
         return job
 
-    if 'onramp' in conf.keys() and 'visible' in conf['onramp'].keys():
-        globs = conf['onramp']['visible']
-        if isinstance(globs, basestring):
-            # Globs is only a single string. Convert to list.
-            globs = [globs]
-    else:
-        globs = []
-
-    ret_dir = os.getcwd()
-    os.chdir(run_dir)
-    filenames = [
-        name for name in
-        chain.from_iterable(
-            map(glob.glob, globs)
-        )
-    ]
-
     prefix = os.path.join(pce_root, 'users') + '/'
     url_prefix = run_dir.split(prefix)[1]
 
@@ -547,9 +607,8 @@ def _build_job(job_id, job_state_file=None):
             'name': filename,
             'size': os.path.getsize(os.path.join(run_dir, filename)),
             'url': os.path.join('files', os.path.join(url_prefix, filename))
-        } for filename in filenames
+        } for filename in sorted(index.files)
     ]
-    os.chdir(ret_dir)
 
     return job
 
@@ -566,20 +625,191 @@ def _clean_job(job):
             job.pop(key, None)
     return job
 
-def get_jobs(job_id=None, job_state_file=None):
+def _state_signature(job_id):
+    """Return a value that changes whenever the job's state is saved, or None
+    if the job has no stored state.
+    """
+    return get_state_backend().signature('jobs', job_id)
+
+def _cache_job(job_id, job):
+    """Store a cleaned copy of job in the job cache."""
+    signature = _state_signature(job_id)
+    with _job_cache_lock:
+        if signature is None or not job:
+            _job_cache.pop(str(job_id), None)
+        else:
+            _job_cache[str(job_id)] = (signature, _clean_job(job))
+
+def _get_cached_job(job_id):
+    """Return job from the job cache, rebuilding it from stored state if the
+    state has changed since it was cached. Never queries the scheduler.
+    """
+    signature = _state_signature(job_id)
+    with _job_cache_lock:
+        entry = _job_cache.get(str(job_id))
+    if entry and entry[0] == signature:
+        return copy.deepcopy(entry[1])
+    if signature is None:
+        _cache_job(job_id, {})
+        return {}
+
+    job = _clean_job(_build_job(job_id, check_status=False))
+    _cache_job(job_id, job)
+    return copy.deepcopy(job)
+
+def poll_jobs():
+    """Refresh scheduler state of all active jobs and update the job cache.
+    Intended to be called periodically from a background thread. Jobs that
+    have finished running are sent to postprocessing from here. Errors are
+    logged, not raised, so that the caller keeps polling.
+    """
+    try:
+        job_ids = get_state_backend().list_ids('jobs')
+        statuses = _get_scheduler_statuses()
+        for job_id in statuses.keys():
+            _cache_job(job_id, _build_job(job_id, job_status=statuses[job_id]))
+        with _job_cache_lock:
+            for job_id in set(_job_cache.keys()) - set(job_ids):
+                _job_cache.pop(job_id, None)
+    except Exception as e:
+        _logger.exception('Job state poll failed: %s' % str(e))
+
+def get_jobs(job_id=None, job_state_file=None, cached=False, job_ids=None,
+             **filters):
     """Return list of tracked jobs or single job.
     Kwargs:
         job_id (int/None): If int, return jobs resource with corresponding id.
             If None, return list of all tracked job resources.
+        cached (bool): If True, serve jobs from the job cache maintained by
+            poll_jobs() instead of querying the scheduler.
+        job_ids (list/None): When listing, only return jobs with these ids.
+            Ids of jobs that don't exist are skipped.
+        **filters: When listing, only return jobs whose state, username,
+            mod_id and/or scheduler_job_num match the given values.
     Returns:
         OnRamp formatted dict containing job attrs for each job requested.
     """
+    if job_id is None:
+        listed = get_state_backend().list_ids('jobs', **filters)
+        if job_ids is not None:
+            wanted = set(str(id) for id in job_ids)
+            listed = [id for id in listed if id in wanted]
+        job_ids = listed
+
+    if cached and job_state_file is None:
+        if job_id:
+            return _get_cached_job(job_id)
+        return filter(None, [_get_cached_job(job_id) for job_id in job_ids])
+
     if job_id:
         return _clean_job(_build_job(job_id, job_state_file))
 
-    return [_clean_job(_build_job(job_id)) for job_id in
-            filter(lambda x: not x.startswith('.'),
-                   os.listdir(_job_state_dir))]
+    statuses = _get_scheduler_statuses(job_ids)
+    return filter(None, [
+        _clean_job(_build_job(job_id, job_status=statuses.get(job_id)))
+        for job_id in job_ids
+    ])
+
+def get_job_changes(since=0, cached=False, wait=0, interval=0.5, job_ids=None,
+                    **filters):
+    """Return jobs whose state changed after the given state version.
+    Clients track job changes by passing the returned state version as since
+    of their next call. Deleted jobs are not reported.
+    Kwargs:
+        since (int): State version to report changes after. 0 returns all
+            jobs.
+        cached (bool): As for get_jobs().
+        wait (float): If no job has changed after since, wait up to this
+            many seconds for one to.
+        interval (float): Seconds between checks for a change while waiting,
+            for state backends that can't notify of changes.
+        job_ids (list/None): Only report changes to jobs with these ids.
+        **filters: As for get_jobs().
+    Returns:
+        Tuple with 0th position being the list of changed jobs and 1st
+        position being the current state version.
+    """
+    backend = get_state_backend()
+    if wait > 0:
+        backend.wait_for_change('jobs', since, wait, interval)
+    changed, version = backend.changed_since('jobs', since)
+    if job_ids is not None:
+        wanted = set(str(id) for id in job_ids)
+        changed = [id for id in changed if id in wanted]
+    if not changed:
+        return ([], version)
+    return (get_jobs(cached=cached, job_ids=changed, **filters), version)
+
+def _trim_partial_utf8(data):
+    """Return data less any incomplete UTF-8 sequence at its end."""
+    for i in range(1, min(4, len(data)) + 1):
+        byte = ord(data[-i])
+        if byte & 0xC0 == 0x80:
+            # Continuation byte. Keep looking for the lead byte.
+            continue
+        if byte & 0x80 == 0:
+            return data
+        if byte & 0xE0 == 0xC0:
+            needed = 2
+        elif byte & 0xF0 == 0xE0:
+            needed = 3
+        else:
+            needed = 4
+        if i < needed:
+            return data[:-i]
+        return data
+    return data
+
+def get_job_output(job_id, offset=0, limit=_max_output_chunk):
+    """Return part of a job's output.txt.
+    Output can be read while the job is running: clients tail it by passing
+    the returned next_offset as the offset of their next call. Chunks never
+    end in the middle of a UTF-8 character, unless nothing else would be
+    returned.
+    Args:
+        job_id (int): Id of the job.
+    Kwargs:
+        offset (int): Byte offset to read from.
+        limit (int): Maximum number of bytes to read. Capped at
+            _max_output_chunk.
+    Returns:
+        Tuple with 0th position being error code and 1st position being dict
+        with keys 'output', 'offset', 'next_offset', 'size' and 'state' on
+        success, or string indication of error.
+    """
+    if offset < 0 or limit < 0:
+        return (-1, 'Offset and limit must not be negative')
+    limit = min(limit, _max_output_chunk)
+
+    with JobState(job_id, read_only=True) as job_state:
+        if 'state' not in job_state.keys():
+            return (-2, 'Job %d does not exist' % job_id)
+        state = job_state['state']
+        run_dir = job_state.get('run_dir')
+
+    data = ''
+    size = 0
+    if run_dir:
+        try:
+            with open(os.path.join(run_dir, 'output.txt'), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                f.seek(offset)
+                data = f.read(limit)
+        except IOError:
+            # No output yet.
+            pass
+
+    trimmed = _trim_partial_utf8(data)
+    if trimmed:
+        data = trimmed
+
+    return (0, {
+        'output': data.decode('utf-8', 'replace'),
+        'offset': offset,
+        'next_offset': offset + len(data),
+        'size': size,
+        'state': state
+    })
 
 def init_job_delete(job_id):
     """Initiate the deletion of a job.
@@ -617,16 +847,9 @@ def _delete_job(job_state):
     """
     job_cancel_states = ['Scheduled', 'Queued', 'Running']
     if job_state['state'] in job_cancel_states:
-        cfgfile = os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg')
-        specfile = os.path.join(pce_root, 'src', 'configspecs',
-                                'onramp_pce_config.cfgspec')
-        cfg = ConfigObj(cfgfile, configspec=specfile)
-        cfg.validate(Validator())
-        scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
+        scheduler = get_scheduler()
         result = scheduler.cancel_job(job_state['scheduler_job_num'])
         _logger.debug('Cancel job output: %s' % result[1])
-    job_state_file = os.path.join(_job_state_dir, str(job_state['job_id']))
-    os.remove(job_state_file)
     args = (job_state['username'], job_state['mod_name'], job_state['mod_id'],
             job_state['run_name'])
     run_dir = os.path.join(pce_root, 'users/%s/%s_%d/%s' % args)
@@ -0,0 +1,330 @@
+"""Lock manager for PCE module and job state.
+
+Locks are taken on per-state lock files with POSIX record locks
+(fcntl.lockf), which block in the kernel instead of spinning, work on the NFS
+mounts commonly used for src/state, and are released by the kernel when the
+holding process exits. Because record locks are owned by a process and not by
+a file descriptor, threads of the same process are arbitrated by the manager
+itself, which keeps exactly one descriptor open per lock file.
+
+Exports:
+    LockTimeout: Raised when a lock cannot be acquired within the timeout.
+    StateLock: Handle for an acquired lock.
+    LockManager: Reader/writer lock manager for state lock files.
+    lock_manager: Process-wide LockManager instance.
+    get_lock_stats: Return lock wait-time and hold-time counters.
+    remove_stale_lock_files: Remove lock files left behind by the old O_EXCL
+        locking scheme.
+"""
+import errno
+import fcntl
+import logging
+import os
+import threading
+import time
+from multiprocessing.util import register_after_fork
+
+_logger = logging.getLogger('onramp')
+
+# Bounds (in seconds) of the backoff used while polling for a lock under a
+# timeout.
+_min_poll_interval = .001
+_max_poll_interval = .05
+
+
+class LockTimeout(Exception):
+    """Raised when a state lock cannot be acquired within the given timeout."""
+    pass
+
+
+class StateLock(object):
+    """Handle for an acquired state lock.
+
+    Instances are returned by LockManager.acquire() and may be used in 'with'
+    statements.
+
+    Example:
+
+        with lock_manager.acquire('/path/to/.47.lock', shared=True):
+            pass
+    """
+
+    def __init__(self, manager, path, shared):
+        """Initialize the handle.
+
+        Args:
+            manager (LockManager): Manager the lock was acquired from.
+            path (str): Absolute path of the lock file.
+            shared (bool): True if held as a reader lock.
+        """
+        self.manager = manager
+        self.path = path
+        self.shared = shared
+        self.acquired_at = time.time()
+        self._released = False
+
+    def release(self):
+        """Release the lock. Releasing an already released lock is a no-op."""
+        if self._released:
+            return
+        self._released = True
+        self.manager._release(self)
+
+    def __enter__(self):
+        """Provide entry for use in 'with' statements."""
+        return self
+
+    def __exit__(self, e_type, e_value, e_traceback):
+        """Provide exit for use in 'with' statements."""
+        self.release()
+        return False
+
+
+class _LockEntry(object):
+    """Bookkeeping for a single lock file within this process."""
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.refs = 0
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.acquiring = False
+
+
+class LockManager(object):
+    """Reader/writer lock manager for state lock files.
+
+    Any number of readers (shared=True) may hold a lock at once, across both
+    threads and processes. A writer holds it exclusively. Waiting writers are
+    given preference over new readers within a process so a steady stream of
+    readers cannot starve them.
+    """
+
+    def __init__(self):
+        """Return an initialized LockManager."""
+        self._reset()
+        register_after_fork(self, LockManager._after_fork)
+
+    def _reset(self):
+        self._mutex = threading.Lock()
+        self._cond = threading.Condition(self._mutex)
+        self._entries = {}
+        self._stats = {
+            'acquired': 0,
+            'shared_acquired': 0,
+            'contended': 0,
+            'timeouts': 0,
+            'wait_time': 0.0,
+            'max_wait_time': 0.0,
+            'hold_time': 0.0,
+            'max_hold_time': 0.0
+        }
+
+    def _after_fork(self):
+        """Drop locks inherited from the parent process.
+
+        Record locks are not inherited across fork, so descriptors and
+        bookkeeping copied from the parent are meaningless in the child.
+        """
+        for entry in self._entries.values():
+            try:
+                os.close(entry.fd)
+            except OSError:
+                pass
+        self._reset()
+
+    def _can_enter(self, entry, shared):
+        if entry.acquiring or entry.writer:
+            return False
+        if shared:
+            return entry.waiting_writers == 0
+        return entry.readers == 0
+
+    def acquire(self, path, shared=False, timeout=None):
+        """Acquire the lock guarding the given lock file.
+
+        The lock file is created if needed and is never removed, so that all
+        contenders always lock the same inode.
+
+        Args:
+            path (str): Path of the lock file.
+
+        Kwargs:
+            shared (bool): Acquire a reader lock if True, else a writer lock.
+            timeout (float/None): Seconds to wait before giving up. None blocks
+                until the lock is acquired.
+
+        Returns:
+            StateLock instance for the acquired lock.
+
+        Raises:
+            LockTimeout: The lock could not be acquired within timeout.
+        """
+        path = os.path.abspath(path)
+        start = time.time()
+        deadline = None
+        if timeout is not None:
+            deadline = start + timeout
+        contended = False
+
+        with self._mutex:
+            entry = self._entries.get(path)
+            if entry is None:
+                entry = _LockEntry(os.open(path, os.O_RDWR | os.O_CREAT, 0644))
+                self._entries[path] = entry
+            entry.refs += 1
+            if not shared:
+                entry.waiting_writers += 1
+
+            try:
+                # Wait on other threads of this process.
+                while not self._can_enter(entry, shared):
+                    contended = True
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise LockTimeout('Timed out waiting for %s' % path)
+                    self._cond.wait(remaining)
+
+                # Wait on other processes.
+                if entry.readers == 0:
+                    entry.acquiring = True
+                    self._mutex.release()
+                    try:
+                        if self._lock_file(entry.fd, shared, deadline):
+                            contended = True
+                    finally:
+                        self._mutex.acquire()
+                        entry.acquiring = False
+                        self._cond.notify_all()
+            except BaseException as e:
+                if isinstance(e, LockTimeout):
+                    self._stats['timeouts'] += 1
+                if not shared:
+                    entry.waiting_writers -= 1
+                self._drop_ref(path, entry)
+                self._cond.notify_all()
+                raise
+
+            if shared:
+                entry.readers += 1
+                self._stats['shared_acquired'] += 1
+            else:
+                entry.waiting_writers -= 1
+                entry.writer = True
+            lock = StateLock(self, path, shared)
+            wait_time = lock.acquired_at - start
+            self._stats['acquired'] += 1
+            if contended:
+                self._stats['contended'] += 1
+            self._stats['wait_time'] += wait_time
+            self._stats['max_wait_time'] = max(self._stats['max_wait_time'],
+                                               wait_time)
+        return lock
+
+    def _lock_file(self, fd, shared, deadline):
+        """Take the inter-process lock on fd.
+
+        Returns:
+            True if the lock was contended, else False.
+
+        Raises:
+            LockTimeout: The lock could not be taken before deadline.
+        """
+        op = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        try:
+            fcntl.lockf(fd, op | fcntl.LOCK_NB)
+            return False
+        except IOError as e:
+            if e.errno not in (errno.EACCES, errno.EAGAIN):
+                raise
+
+        if deadline is None:
+            fcntl.lockf(fd, op)
+            return True
+
+        interval = _min_poll_interval
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise LockTimeout('Timed out waiting for lock file')
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, _max_poll_interval)
+            try:
+                fcntl.lockf(fd, op | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EACCES, errno.EAGAIN):
+                    raise
+
+    def _drop_ref(self, path, entry):
+        entry.refs -= 1
+        if entry.refs == 0:
+            os.close(entry.fd)
+            del self._entries[path]
+
+    def _release(self, lock):
+        hold_time = time.time() - lock.acquired_at
+        with self._mutex:
+            entry = self._entries[lock.path]
+            if lock.shared:
+                entry.readers -= 1
+            else:
+                entry.writer = False
+            if entry.readers == 0 and not entry.writer:
+                fcntl.lockf(entry.fd, fcntl.LOCK_UN)
+            self._drop_ref(lock.path, entry)
+            self._stats['hold_time'] += hold_time
+            self._stats['max_hold_time'] = max(self._stats['max_hold_time'],
+                                               hold_time)
+            self._cond.notify_all()
+
+    def get_stats(self):
+        """Return a copy of the lock counters for this process.
+
+        Returns:
+            Dict with the following fields:
+                acquired: Number of locks acquired.
+                shared_acquired: Number of those that were reader locks.
+                contended: Number of acquisitions that had to wait.
+                timeouts: Number of acquisitions that timed out.
+                wait_time: Total seconds spent waiting for locks.
+                max_wait_time: Longest single wait in seconds.
+                hold_time: Total seconds locks were held.
+                max_hold_time: Longest single hold in seconds.
+                held: Number of lock files currently in use.
+        """
+        with self._mutex:
+            stats = dict(self._stats)
+            stats['held'] = len(self._entries)
+        return stats
+
+
+lock_manager = LockManager()
+
+def get_lock_stats():
+    """Return wait-time and hold-time counters of the process-wide lock
+    manager. See LockManager.get_stats().
+    """
+    return lock_manager.get_stats()
+
+def remove_stale_lock_files(state_dir):
+    """Remove lock files left behind by the old O_EXCL locking scheme.
+
+    The old scheme signalled a held lock by the existence of a '<id>.lock'
+    file, so a crashed process blocked the state forever. Such files are no
+    longer used and are safe to remove.
+
+    Args:
+        state_dir (str): State folder to clean.
+    """
+    for name in os.listdir(state_dir):
+        if name.endswith('.lock') and not name.startswith('.'):
+            _logger.info('Removing stale lock file %s' % name)
+            try:
+                os.remove(os.path.join(state_dir, name))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
@@ -28,6 +28,9 @@ from subprocess import CalledProcessError, check_output, STDOUT
 from configobj import ConfigObj
 
 from PCE.tools import module_log
+from PCE.tools.locks import lock_manager
+from PCE.tools.state_backends import _SingleFileBackend, get_state_backend
+from PCE.tools.workers import worker_task
 from PCEHelper import pce_root
 
 _mod_state_dir = os.path.join(pce_root, 'src/state/modules')
@@ -50,7 +53,8 @@ class ModState(dict):
             mod_state['key2'] = 'val2'
     """
 
-    def __init__(self, id, mod_state_file=None):
+    def __init__(self, id, mod_state_file=None, read_only=False,
+                 lock_timeout=None):
         """Return initialized ModState instance.
 
         Method works in get-or-create fashion, that is, if state exists for
@@ -58,38 +62,46 @@ class ModState(dict):
 
         Args:
             id (int): Id of the module to get/create state for.
+
+        Kwargs:
+            mod_state_file (str): Path of the state file, if not the default.
+            read_only (bool): If True, take a shared lock and never write
+                state back, allowing concurrent readers. Changes made to a
+                read-only instance are discarded.
+            lock_timeout (float/None): Seconds to wait for the state lock.
+                None waits indefinitely.
+
+        Raises:
+            LockTimeout: The state lock could not be acquired in time.
         """
         if mod_state_file is None:
-            mod_state_file = os.path.join(_mod_state_dir, str(id))
+            self._backend = get_state_backend()
+        else:
+            self._backend = _SingleFileBackend(mod_state_file)
 
         self.mod_id = id
-        self._lock_filename = os.path.join(_mod_state_dir, '%s.lock' % str(id))
-        self._mod_state_filename = mod_state_file
-
-        while(True):
-            try:
-                # Raises OSError if file cannot be opened in create mode.
-                os.open(self._lock_filename,
-                        os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-                break
-            except OSError as e:
-                if e.errno != errno.EEXIST:
-                    raise
-                time.sleep(.001)
+        self._lock_filename = os.path.join(_mod_state_dir, '.%s.lock' % str(id))
+        self._read_only = read_only
+        self._lock = lock_manager.acquire(self._lock_filename,
+                                          shared=read_only,
+                                          timeout=lock_timeout)
 
         try:
-            self._state_file = open(mod_state_file, 'r+')
-            data = json.load(self._state_file)
+            data = self._backend.load('modules', id)
+        except:
+            self._lock.release()
+            raise
+        if data:
             self.update(data)
-            self._state_file.seek(0)
-        except IOError as e1:
-            if e1.errno != errno.ENOENT:
-                raise
-            self._state_file = open(mod_state_file, 'w')
-        except ValueError as e2:
-            #_logger.debug('BAD JSON: %s' % file_contents)
-            # Invalid json. Ignore (will be overwritten by _close().
-            pass
+        # Stored state as loaded, used to skip writing unchanged state.
+        self._stored = copy.deepcopy(data)
+
+    def __deepcopy__(self, memo):
+        """Return a deep copy of the state parameters as a plain dict.
+
+        The copy carries no lock or file handles and may outlive the instance.
+        """
+        return copy.deepcopy(dict(self), memo)
 
     def __enter__(self):
         """Provide entry for use in 'with' statements."""
@@ -104,27 +116,22 @@ class ModState(dict):
             return False
 
     def _close(self):
-        """Serialize and store state parameters.
+        """Serialize and store state parameters, then release the state lock.
 
         If stored state exists, overwrite it with current instance keys/vals.
+        Nothing is written for read-only instances, or if the state parameters
+        are unchanged since they were loaded.
         """
-        if 'state' in self.keys() and self['state'] != 'Does not exist':
-            self._state_file.write(json.dumps(self))
-            self._state_file.truncate()
-            self._state_file.close()
-        else:
-            try:
-                self._state_file.close()
-                os.remove(self._mod_state_filename)
-            except OSError as e:
-                if e.errno != errno.ENOENT:
-                    raise e
-
         try:
-            os.remove(self._lock_filename)
-        except OSError as e:
-            if e.errno != errno.ENOENT:
-                raise e
+            if self._read_only:
+                return
+            if 'state' in self.keys() and self['state'] != 'Does not exist':
+                if dict(self) != self._stored:
+                    self._backend.save('modules', self.mod_id, self)
+            elif self._stored is not None:
+                self._backend.delete('modules', self.mod_id)
+        finally:
+            self._lock.release()
 
 
 def _local_checkout(source_path, install_path):
@@ -153,6 +160,7 @@ def get_source_types():
     """Return list of acceptable module source types (local, git, etc.)."""
     return source_handlers.keys()
 
+@worker_task('deploy')
 def install_module(source_type, source_path, install_parent_folder, mod_id,
                    mod_name, verbose=False, mod_state_file=None):
     """Install OnRamp educational module into environment.
@@ -229,6 +237,7 @@ def install_module(source_type, source_path, install_parent_folder, mod_id,
 
     return (0, 'Module %d installed' % mod_id)
 
+@worker_task('deploy')
 def deploy_module(mod_id, verbose=False, mod_state_file=None):
     """Deploy an installed OnRamp educational module.
 
@@ -256,15 +265,12 @@ def deploy_module(mod_id, verbose=False, mod_state_file=None):
         mod_state['error'] = None
         mod_dir = mod_state['installed_path']
 
-    ret_dir = os.getcwd()
-    _logger.debug('ret_dir: %s' % ret_dir)
-    os.chdir(mod_dir)
-
+    output = ''
     try:
-        _logger.debug('Calling bin/onramp_deploy.py')
-        _logger.debug('CWD: %s' % os.getcwd())
+        _logger.debug('Calling bin/onramp_deploy.py in %s' % mod_dir)
         output = check_output([os.path.join(pce_root, 'src/env/bin/python'),
-                              'bin/onramp_deploy.py'], stderr=STDOUT)
+                              'bin/onramp_deploy.py'], stderr=STDOUT,
+                              cwd=mod_dir)
         _logger.debug('Back from bin/onramp_deploy.py')
     except CalledProcessError as e:
         _logger.debug('CalledProcessError from bin/onramp_deploy.py')
@@ -301,7 +307,6 @@ def deploy_module(mod_id, verbose=False, mod_state_file=None):
             mod_state['error'] = str(e1)
         return (-1, str(e1))
     finally:
-        os.chdir(ret_dir)
         module_log(mod_dir, 'deploy', output)
 
     _logger.debug("Updating state to 'Module ready'")
@@ -341,7 +346,7 @@ def get_modules(mod_id=None):
     """
     _logger.debug('Mod (%s) HERE' % (str(mod_id)))
     if mod_id is not None:
-        with ModState(mod_id) as mod_state:
+        with ModState(mod_id, read_only=True) as mod_state:
             _logger.debug('Mod (%s) HERE 2' % (str(mod_id)))
             if 'state' in mod_state.keys():
                 mod = copy.deepcopy(mod_state)
@@ -370,16 +375,8 @@ def get_modules(mod_id=None):
             'source_location': None
         }
 
-    results = []
-
-    # Need to filter out hidden files because of .nfs* files.
-    for id in filter(lambda x: not x.startswith('.'),
-                     os.listdir(_mod_state_dir)):
-        next_mod = {}
-        with ModState(id) as mod_state:
-            next_mod = copy.deepcopy(mod_state)
-        results.append(_clean_mod(next_mod))
-    return results
+    mods = get_state_backend().load_many('modules')
+    return [_clean_mod(mod) for mod in mods.values()]
 
 def get_available_modules():
     """Return list of modules shipped with OnRamp.
@@ -441,9 +438,6 @@ def _delete_module(mod_state):
     Args:
         mod_state (ModState): State object for the module to remove.
     """
-    mod_id = mod_state['mod_id']
-    mod_state_file = os.path.join(_mod_state_dir, str(mod_id))
-    os.remove(mod_state_file)
     if 'installed_path' in mod_state.keys():
         path = mod_state['installed_path']
         shutil.rmtree(path)
@@ -1,16 +1,14 @@
 __doc__ = """
 OnRamp job launching support package.
 Provides functionality for launching jobs, as well as means of
-setting/storing/updating job state data.
+setting/storing/updating job state data in Redis.
 Exports:
-    JobState: Encapsulation of job state that avoids race conditions.
-    launch_job: Schedules job launch using system batch scheduler as configured
-        in onramp_pce_config.cfg.
-    get_jobs: Returns list of tracked jobs or single job.
-    init_job_delete: Initiate the deletion of a job.
+    RedisState: Field-level, transactional job/module state kept in Redis.
+    ModState: RedisState for modules.
+    JobState: RedisState for jobs.
+    JobHandler: Launches, tracks and deletes jobs using Redis state.
 """
 
-from redis import StrictRedis
 from subprocess import *
 import logging
 import shutil
@@ -18,94 +16,134 @@ import json
 import time
 import os
 
-ret_dir = None
-_job_state_dir = None
-ConfigObj = None
-Validator = None
-Scheduler = None
-module_log = None
-pce_root = ""
+from configobj import ConfigObj
+from validate import Validator
+
+from PCE.tools import module_log
+from PCE.tools.config import get_config, get_scheduler
+from PCE.tools.jobs import _output_digest
+from PCE.tools.rundirs import materialize_run_dir
+from PCE.tools.state_backends import RedisStateBackend
+from PCEHelper import pce_root
 
 
 class RedisState(object):
-    def __init__(self, state_id, redis):
+    """Job/module state kept as a Redis hash.
+
+    State parameters are the public attributes of the instance. They are read
+    when entering a 'with' statement, and on exit only the attributes that
+    changed inside the statement are written, in a single Redis transaction
+    that also maintains the backend's index sets. Concurrent writers therefore
+    never clobber fields they did not touch.
+
+    Example:
+
+        with JobState(47, backend) as job_state:
+            job_state.set('Queued')
+    """
+    kind = None
+    exempt_fields = ['id', 'states', 'r_states']
+
+    def __init__(self, state_id, backend):
+        """Initialize the state.
+
+        Args:
+            state_id (int): Id of the job/module.
+            backend (RedisStateBackend): Backend to keep state in.
+        """
         self.id = state_id
-        self.redis = redis
+        self._backend = backend
+        self._snapshot = {}
+        self._cleared = False
         self.state = None
         self.states = None
         self.r_states = None
 
+    def _fields(self):
+        """Return dict of the state parameters of the instance."""
+        return dict((k, v) for k, v in self.__dict__.iteritems()
+                    if not k.startswith('_') and k not in self.exempt_fields)
+
     def _load_state(self):
-        job_info = self.redis.get("job-{}".format(self.id))
-        if job_info is not None:
-            self.update(json.loads(job_info))
+        self._cleared = False
+        data = self._backend.load(self.kind, self.id)
+        if data is not None:
+            self.update(data)
+        self._snapshot = json.loads(json.dumps(self._fields()))
 
     def _save_state(self):
-        job_info = {k: v for k, v in self.__dict__.iteritems()}
-        # need to remove all of the attributes on the
-        # class that cannot be represented as a string
-        job_info.pop("redis", None)
-        job_info.pop("states", None)
-        job_info.pop("r_states", None)
-        # put the state information into the redis db
-        self.redis.set("job-{}".format(self.id), json.dumps(job_info))
+        if self._cleared:
+            self._backend.delete(self.kind, self.id)
+            return
+        fields = self._fields()
+        changed = dict((k, v) for k, v in fields.iteritems()
+                       if k not in self._snapshot or self._snapshot[k] != v)
+        removed = [k for k in self._snapshot.keys() if k not in fields]
+        if changed or removed:
+            self._backend.update(self.kind, self.id, changed, removed)
+        self._snapshot = json.loads(json.dumps(fields))
 
     def __enter__(self):
         """Provide entry for use in 'with' statements."""
-        # load the job from the redis database
+        # load the state from the redis database
         self._load_state()
         return self
 
     def __exit__(self, e_type, e_value, e_traceback):
         """Provide exit for use in 'with' statements."""
-        # save the job to the redis database
+        # save the changed fields to the redis database
         self._save_state()
         if e_type:
             return False
 
     def set(self, state):
-        if state in self.r_states:
-            self.state = self.r_states[state]
-        else:
+        """Set the state to the given state name.
+
+        Args:
+            state (str): Name of the state, one of the values of self.states.
+
+        Raises:
+            ValueError: state is not a valid state name.
+        """
+        if self.r_states is not None and state not in self.r_states:
             raise ValueError("An invalid state was passed "
-                             "to the {} class!".format(self.__name__))
+                             "to the {} class!".format(type(self).__name__))
+        self.state = state
 
     def update(self, data):
-        # loop over the kwargs and update the class
+        """Set the state parameters in the given dict."""
         for k, v in data.iteritems():
-            try:
-                if getattr(self, k) is not None:
-                    setattr(self, k, v)
-            except AttributeError:
-                # this shouldn't ever happen however if it did
-                # it is because something was set on the class
-                # that wasn't explicitly set in the __init__
-                setattr(self, k, v)
+            setattr(self, k, v)
 
     def clear(self):
-        # clear all of the attributes on the class
-        exempt_fields = ['id', 'redis', 'states', 'r_states']
-        for k, v in self.__dict__.iteritems():
-            if k not in exempt_fields:
-                setattr(self, k, None)
-        # save the state of the class into redis
-        self._save_state()
+        """Remove the state. Takes effect when leaving the 'with' statement."""
+        for k in self._fields().keys():
+            setattr(self, k, None)
+        self._cleared = True
 
     def delete(self):
-        self.redis.delete("job-{}".format(self.id))
+        """Remove the state immediately."""
+        self._backend.delete(self.kind, self.id)
+
+    def __str__(self):
+        return str(self._fields())
 
 
 class ModState(RedisState):
-    def __init__(self, mod_id, redis):
-        super(ModState, self).__init__(mod_id, redis)
+    kind = 'modules'
+
+    def __init__(self, mod_id, backend):
+        super(ModState, self).__init__(mod_id, backend)
         self.state = None
         self.mod_name = None
         self.installed_path = None
 
 
 class JobState(RedisState):
-    def __init__(self, job_id, redis):
-        super(JobState, self).__init__(job_id, redis)
+    kind = 'jobs'
+
+    def __init__(self, job_id, backend):
+        super(JobState, self).__init__(job_id, backend)
         # setup defaults values for the class
         self.mod_id = None
         self.username = None
@@ -116,7 +154,8 @@ class JobState(RedisState):
         self.state = None
         self.error = None
         self.mod_status_output = None
-        self.output = None
+        self.output_size = None
+        self.output_digest = None
         self.visible_files = None
         self.mod_name = None
         self.marked_for_del = False
@@ -125,6 +164,7 @@ class JobState(RedisState):
             -1: "Launch failed",
             -2: "Preprocess failed",
             -3: "Schedule failed",
+            -4: "Postprocess failed",
             -5: "Run failed",
             -99: "Error: Undefined",
             0: "Unknown job id",
@@ -140,11 +180,21 @@ class JobState(RedisState):
 
 
 class JobHandler(object):
-    def __init__(self):
+    def __init__(self, redis=None):
+        """Connect to Redis and return the instance.
+
+        Kwargs:
+            redis (StrictRedis): Client to keep state with, e.g. a fakeredis
+                instance. If None, a client is created from the redis section
+                of onramp_pce_config.cfg.
+        """
         self._log = logging.getLogger("onramp")
         self._mod_install_dir = os.path.join(pce_root, 'modules')
-        self.rc0 = StrictRedis(db=0)  # Connection to JobState database
-        self.rc1 = StrictRedis(db=1)  # Connection to ModState database
+        if redis is None:
+            cfg = get_config()
+            self.backend = RedisStateBackend(None, **cfg.get('redis', {}))
+        else:
+            self.backend = RedisStateBackend(None, client=redis)
 
     def create(self, job_id, mod_id, username, run_name, run_params, run_dir=None):
         """
@@ -161,7 +211,7 @@ class JobHandler(object):
 
         self._log.debug('Want JobState (init) at: %s' % time.time())
 
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             job_state.update({
                 'mod_id': mod_id,
                 'username': username,
@@ -171,7 +221,7 @@ class JobHandler(object):
             self._log.debug('Initializing job at %s' % time.time())
             self._log.debug('PID: %d' % os.getpid())
             self._log.debug('Waiting on ModState at: %s' % time.time())
-            with ModState(mod_id, self.rc1) as mod_state:
+            with ModState(mod_id, self.backend) as mod_state:
                 self._log.debug('Done waiting on ModState at: %s' % time.time())
                 if mod_state.state is None or mod_state.state != 'Module ready':
                     msg = 'Module not ready'
@@ -180,10 +230,10 @@ class JobHandler(object):
                     self._log.warn(msg)
                     self._log.warn('mod_state: %s' % str(mod_state))
                     if job_state.marked_for_del:
-                        self.delete(job_state)
+                        self._delete(job_state)
                         return -2, 'Job %d deleted' % job_id
                     return -1, 'Module not ready'
-                job_state.mode_name = mod_state.mod_name
+                job_state.mod_name = mod_state.mod_name
                 proj_loc = mod_state.installed_path
                 mod_name = mod_state.mod_name
                 self._log.debug('Leaving modstate part of init')
@@ -214,7 +264,7 @@ class JobHandler(object):
                 pass
 
         self._log.debug('Setting run dir')
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             job_state.run_dir = run_dir
             self._log.debug('state vals: %s' % job_state)
         self._log.debug('Run dir set')
@@ -222,8 +272,8 @@ class JobHandler(object):
         # The way the following is setup, if a run_dir has already been setup with
         # this run_name, it will be used (that is, not overwritten) for this launch.
         try:
-            shutil.copytree(proj_loc, run_dir)
-        except (shutil.Error, OSError):
+            materialize_run_dir(proj_loc, run_dir)
+        except OSError:
             pass
 
         if run_params:
@@ -248,25 +298,22 @@ class JobHandler(object):
         :return:
         """
 
-        ret_dir = os.getcwd()
-
         self._log.info('Calling bin/onramp_preprocess.py')
         self._log.debug('Want JobState (preprocess) at: %s' % time.time())
 
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             self._log.debug('In JobState (preprocess) at: %s' % time.time())
             self._log.debug('preprocess PID: %d' % os.getpid())
             job_state.set('Preprocessing')
             job_state.error = None
             run_dir = job_state.run_dir
 
-        os.chdir(run_dir)
         self._log.debug('Done with JobState (preprocess) at: %s' % time.time())
 
         try:
             path = os.path.join(pce_root, 'src/env/bin/python')
             command = [path, 'bin/onramp_preprocess.py']
-            result = check_output(command, stderr=STDOUT)
+            result = check_output(command, stderr=STDOUT, cwd=run_dir)
         except CalledProcessError as e:
             code = e.returncode
             if code > 127:
@@ -274,16 +321,15 @@ class JobHandler(object):
             result = e.output
             msg = 'Preprocess exited with return status %d and output: %s' % (code, result)
             self._log.error(msg)
-            with JobState(job_id, self.rc0) as job_state:
+            with JobState(job_id, self.backend) as job_state:
                 job_state.set('Preprocess failed')
                 job_state.error = msg
                 if job_state.marked_for_del:
-                    self.delete(job_state)
+                    self._delete(job_state)
                     return -2, 'Job %d deleted' % job_id
             return -1, msg
         finally:
             module_log(run_dir, 'preprocess', result)
-            os.chdir(ret_dir)
 
         return 0, 'Job preprocess complete'
 
@@ -295,34 +341,27 @@ class JobHandler(object):
         """
 
         # Determine batch scheduler to user from config.
-        cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                        configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                                'onramp_pce_config.cfgspec'))
-        cfg.validate(Validator())
-        scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
-
-        self._log.debug("in job_run: trying to launch using scheduler %s", cfg['cluster']['batch_scheduler'])
-        # ret_dir = os.getcwd() # FIXME: determine if this is supposed to be commented out or not
-        with JobState(job_id, self.rc0) as job_state:
+        scheduler = get_scheduler()
+
+        self._log.debug("in job_run: trying to launch using scheduler %s",
+                        type(scheduler).__name__)
+        with JobState(job_id, self.backend) as job_state:
             run_dir = job_state.run_dir
             run_name = job_state.run_name
 
-        os.chdir(run_dir)
-
-        # self._log.debug("in job_run: attempting to be in %s, really in %s", run_dir, os.get_cwd())
         # Load run params:
         run_np = None
         run_nodes = None
-        run_cfg = ConfigObj('onramp_runparams.cfg')
+        run_cfg = ConfigObj(os.path.join(run_dir, 'onramp_runparams.cfg'))
         if 'onramp' in run_cfg.keys():
             if 'np' in run_cfg['onramp']:
                 run_np = run_cfg['onramp']['np']
             if 'nodes' in run_cfg['onramp']:
                 run_nodes = run_cfg['onramp']['nodes']
 
-        self._log.debug("in job_run: loaded params np: %d and nodes: %d", run_np, run_nodes)
+        self._log.debug("in job_run: loaded params np: %s and nodes: %s", run_np, run_nodes)
         # Write batch script.
-        with open('script.sh', 'w') as f:
+        with open(os.path.join(run_dir, 'script.sh'), 'w') as f:
             if run_np and run_nodes:
                 f.write(scheduler.get_batch_script(run_name, numtasks=run_np, num_nodes=run_nodes))
             elif run_np:
@@ -336,22 +375,20 @@ class JobHandler(object):
         result = scheduler.schedule(run_dir)
         if result['status_code'] != 0:
             self._log.error(result['msg'])
-            with JobState(job_id, self.rc0) as job_state:
+            with JobState(job_id, self.backend) as job_state:
                 job_state.set('Schedule failed')
                 job_state.error = result['msg']
-                os.chdir(ret_dir)
                 if job_state.marked_for_del:
-                    self.delete(job_state)
+                    self._delete(job_state)
                     return -2, 'Job %d deleted' % job_id
             return result['returncode'], result['msg']
 
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             job_state.set('Scheduled')
             job_state.error = None
             job_state.scheduler_job_num = result['job_num']
-            os.chdir(ret_dir)
             if job_state.marked_for_del:
-                self.delete(job_state)
+                self._delete(job_state)
                 return -2, 'Job %d deleted' % job_id
 
         return 0, 'Job scheduled'
@@ -366,7 +403,7 @@ class JobHandler(object):
         self._log.info('PCE.tools.jobs._job_postprocess() called')
 
         # Get attrs needed.
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             username = job_state.username
             mod_id = job_state.mod_id
             run_name = job_state.run_name
@@ -374,14 +411,12 @@ class JobHandler(object):
             run_dir = job_state.run_dir
 
         args = (username, mod_name, mod_id, run_name)
-        ret_dir = os.getcwd()
 
-        os.chdir(run_dir)
         self._log.debug('Calling bin/onramp_postprocess.py')
         try:
             path = os.path.join(pce_root, 'src/env/bin/python')
             command = [path, 'bin/onramp_postprocess.py']
-            result = check_output(command, stderr=STDOUT)
+            result = check_output(command, stderr=STDOUT, cwd=run_dir)
 
         except CalledProcessError as e:
             code = e.returncode
@@ -389,69 +424,72 @@ class JobHandler(object):
                 code -= 256
             result = e.output
             msg = 'Postprocess exited with return status %d and output: %s' % (code, result)
-            with JobState(job_id, self.rc0) as job_state:
+            with JobState(job_id, self.backend) as job_state:
                 job_state.set('Postprocess failed')
                 job_state.error = msg
                 self._log.error(msg)
 
-                os.chdir(ret_dir)
-
                 if job_state.marked_for_del:
-                    self.delete(job_state)
+                    self._delete(job_state)
                     return -2, 'Job %d deleted' % job_id
             return -1, msg
 
         finally:
             module_log(run_dir, 'postprocess', result)
 
-        # Grab job output.
-        with open('output.txt', 'r') as f:
-            output = f.read()
-
-        os.chdir(ret_dir)
+        # Record the size and digest of the job output.
+        output_size, output_digest = _output_digest(run_dir)
 
         # Update state.
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             job_state.set('Done')
             job_state.error = None
-            job_state.output = output
+            job_state.output_size = output_size
+            job_state.output_digest = output_digest
             if job_state.marked_for_del:
-                self.delete(job_state)
+                self._delete(job_state)
                 return -2, 'Job %d deleted' % job_id
 
+        return 0, 'Job postprocess complete'
+
     def delete(self, job_id):
+        """Delete the job, or mark it for deletion if it is in progress.
+
+        :param job_id: Id of the job to delete.
+        :return: Tuple of (status code, message).
         """
+        with JobState(job_id, self.backend) as job_state:
+            if job_state.state is None:
+                return -1, 'Job %d does not exist' % job_id
+            return self._delete(job_state)
 
-        :param job_id:
-        :return:
+    def _delete(self, job_state):
+        """Delete the job of an open JobState if it is not in progress.
+
+        The state is removed when the caller leaves its 'with' statement.
+
+        :param job_state: JobState of the job, open in a 'with' statement.
+        :return: Tuple of (status code, message).
         """
         job_cancel_states = ['Scheduled', 'Queued', 'Running']
         finished_states = ['Launch failed', 'Schedule failed', 'Preprocess failed',
                            'Run failed', 'Postprocess failed', 'Done']
         finished_states += job_cancel_states
 
-        with JobState(job_id, self.rc0) as job_state:
-            if job_state.state is None:
-                return -1, 'Job %d does not exist' % job_id
-            if job_state.state in finished_states:
-                job_cancel_states = ['Scheduled', 'Queued', 'Running']
-                if job_state.state in job_cancel_states:
-                    cfgfile = os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg')
-                    specfile = os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec')
-                    cfg = ConfigObj(cfgfile, configspec=specfile)
-                    cfg.validate(Validator())
-                    scheduler = Scheduler(cfg['cluster']['batch_scheduler'])
-                    result = scheduler.cancel_job(job_state.scheduler_job_num)
-                    self._log.debug('Cancel job output: %s' % result[1])
-                args = (job_state.username, job_state.mode_name, job_state.mod_id,
-                        job_state.run_name)
-                run_dir = os.path.join(pce_root, 'users/%s/%s_%d/%s' % args)
-                shutil.rmtree(run_dir, ignore_errors=True)
-                job_state.clear()
-                return 0, 'Job %d deleted' % job_id
-            job_state.marked_for_del = True
-            return 0, 'Job %d marked for deletion' % job_id
+        job_id = job_state.id
+        if job_state.state in finished_states:
+            if job_state.state in job_cancel_states:
+                scheduler = get_scheduler()
+                result = scheduler.cancel_job(job_state.scheduler_job_num)
+                self._log.debug('Cancel job output: %s' % result[1])
+            args = (job_state.username, job_state.mod_name, job_state.mod_id,
+                    job_state.run_name)
+            run_dir = os.path.join(pce_root, 'users/%s/%s_%d/%s' % args)
+            shutil.rmtree(run_dir, ignore_errors=True)
+            job_state.clear()
+            return 0, 'Job %d deleted' % job_id
+        job_state.marked_for_del = True
+        return 0, 'Job %d marked for deletion' % job_id
 
     def launch(self, job_id, mod_id, username, run_name, run_params):
         """
@@ -469,7 +507,7 @@ class JobHandler(object):
 
         # check to see if the job has already been launched or failed
         failed_states = ['Schedule failed', 'Launch failed', 'Preprocess failed']
-        with JobState(job_id, self.rc0) as job_state:
+        with JobState(job_id, self.backend) as job_state:
             if job_state.state is not None and job_state.state not in failed_states:
                 msg = 'Job launch already initiated. Current state {}.'.format(job_state.state)
                 self._log.warn(msg)
@@ -488,25 +526,45 @@ class JobHandler(object):
         # call the run method of the job to start running it
         return self.run(job_id)
 
-    def get_state(self):
-        """
+    def get_state(self, job_id):
+        """Return the state of a single job.
 
-        :return:
+        :param job_id: Id of the job.
+        :return: Dict of job state parameters, or None if there is no such job.
         """
-        pass
-
-    def get_states(self):
+        state = self.backend.load('jobs', job_id)
+        if state is not None:
+            state['job_id'] = int(job_id)
+        return state
+
+    def get_states(self, job_ids=None, **filters):
+        """Return the states of many jobs in a single round trip to Redis.
+
+        :param job_ids: Ids of the jobs to return. If None, all jobs matching
+            filters are returned.
+        :param filters: Field/value pairs from the indexed job fields (state,
+            username, mod_id, scheduler_job_num). A list value matches any of
+            its items.
+        :return: List of dicts of job state parameters, ordered by job id.
         """
-
-        :return:
+        if job_ids is None:
+            states = self.backend.load_many('jobs', **filters)
+        else:
+            states = self.backend.load_ids('jobs', job_ids)
+            if filters:
+                matching = self.backend.list_ids('jobs', **filters)
+                states = dict((k, v) for k, v in states.iteritems()
+                              if k in matching)
+        results = []
+        for job_id in sorted(states.keys(), key=int):
+            state = states[job_id]
+            state['job_id'] = int(job_id)
+            results.append(state)
+        return results
+
+    def subscribe(self):
+        """Return a redis PubSub object subscribed to job state transitions.
+
+        Messages carry JSON of the form {"id": ..., "from": ..., "to": ...}.
         """
-        pass
-
-
-if __name__ == '__main__':
-    r = JobState(0, StrictRedis(db=0))
-    with r as state:
-        r.set("Run failed")
-        r.error = "adfasdfas"
-        r.test = "Test"
-    r.delete()
+        return self.backend.subscribe('jobs')
@@ -0,0 +1,212 @@
+"""Materialization of job run folders from deployed modules.
+
+Each job runs in its own folder under users/, populated from the deployed
+module. Copying the whole module for every run duplicates compiled binaries
+and source trees that jobs never modify, so modules may declare in
+config/onramp_metadata.cfg which paths their jobs modify, and how the rest of
+the module should be placed in run folders:
+
+    [run_dir]
+    # One of: copy, hardlink, symlink.
+    strategy = hardlink
+    # Files and folders (globs relative to the module root) that jobs modify.
+    # These are always copied.
+    mutable = src/HPL.dat, results
+
+Strategies:
+    copy: Copy every file. Copies are reflinks (copy-on-write clones) where
+        the filesystem supports them. This is the default, and is used for
+        modules without a [run_dir] section.
+    hardlink: Hard link files that are not mutable. Falls back to copy where
+        links are not possible, e.g. across filesystems.
+    symlink: Symlink files, and whole folders that contain no mutable paths.
+
+Hard linked and symlinked files are shared with the module and every other
+run, so jobs must never modify them in place. Files the PCE itself writes in
+run folders (see always_mutable) are always copied.
+
+Exports:
+    materialize_run_dir: Populate a run folder from a deployed module.
+"""
+import errno
+import fcntl
+import glob
+import logging
+import os
+import shutil
+
+from configobj import ConfigObj
+
+_logger = logging.getLogger('onramp')
+
+strategies = ['copy', 'hardlink', 'symlink']
+
+# Paths written by the PCE in every run folder.
+always_mutable = ['log', 'onramp_runparams.cfg', 'script.sh', 'output.txt']
+
+# ioctl request cloning a file on Linux (btrfs, XFS, ...).
+_FICLONE = 0x40049409
+
+
+class _Materializer(object):
+    """Populate one run folder. Tracks counts of materialized files."""
+
+    def __init__(self, src_root, dest_root, strategy, mutable):
+        self.src_root = src_root
+        self.dest_root = dest_root
+        self.strategy = strategy
+        self.mutable = mutable
+        self.reflink_ok = True
+        self.link_ok = True
+        self.stats = {
+            'copied': 0,
+            'reflinked': 0,
+            'hardlinked': 0,
+            'symlinked': 0,
+            'bytes_copied': 0
+        }
+
+    def _is_mutable(self, rel_path):
+        """Return True if rel_path is, or is inside, a mutable path."""
+        for path in self.mutable:
+            if rel_path == path or rel_path.startswith(path + '/'):
+                return True
+        return False
+
+    def _contains_mutable(self, rel_dir):
+        """Return True if a mutable path is inside rel_dir."""
+        prefix = rel_dir + '/' if rel_dir else ''
+        for path in self.mutable:
+            if path.startswith(prefix):
+                return True
+        return False
+
+    def _reflink(self, src, dest):
+        """Clone src to dest. Return False if not supported."""
+        if not self.reflink_ok:
+            return False
+        with open(src, 'rb') as src_f:
+            with open(dest, 'wb') as dest_f:
+                try:
+                    fcntl.ioctl(dest_f.fileno(), _FICLONE, src_f.fileno())
+                except (IOError, OSError):
+                    # Not supported by this filesystem (or kernel). Don't
+                    # try again for this run folder.
+                    self.reflink_ok = False
+        if not self.reflink_ok:
+            os.remove(dest)
+            return False
+        shutil.copystat(src, dest)
+        return True
+
+    def _copy(self, src, dest):
+        if self._reflink(src, dest):
+            self.stats['reflinked'] += 1
+            return
+        shutil.copy2(src, dest)
+        self.stats['copied'] += 1
+        self.stats['bytes_copied'] += os.path.getsize(dest)
+
+    def _hardlink(self, src, dest):
+        if self.link_ok:
+            try:
+                os.link(src, dest)
+                self.stats['hardlinked'] += 1
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                self.link_ok = False
+        self._copy(src, dest)
+
+    def _symlink(self, src, dest):
+        os.symlink(src, dest)
+        self.stats['symlinked'] += 1
+
+    def _place_file(self, rel_path):
+        src = os.path.realpath(os.path.join(self.src_root, rel_path))
+        dest = os.path.join(self.dest_root, rel_path)
+        if self.strategy == 'copy' or self._is_mutable(rel_path):
+            self._copy(src, dest)
+        elif self.strategy == 'hardlink':
+            self._hardlink(src, dest)
+        else:
+            self._symlink(src, dest)
+
+    def run(self, rel_dir=''):
+        """Materialize rel_dir of the module, recursively."""
+        src_dir = os.path.join(self.src_root, rel_dir)
+        dest_dir = os.path.join(self.dest_root, rel_dir)
+        os.mkdir(dest_dir)
+        shutil.copystat(src_dir, dest_dir)
+        for name in sorted(os.listdir(src_dir)):
+            rel_path = os.path.join(rel_dir, name)
+            src = os.path.join(src_dir, name)
+            if os.path.isdir(src):
+                if (self.strategy == 'symlink'
+                    and not self._is_mutable(rel_path)
+                    and not self._contains_mutable(rel_path)):
+                    self._symlink(os.path.realpath(src),
+                                  os.path.join(self.dest_root, rel_path))
+                else:
+                    self.run(rel_path)
+            else:
+                self._place_file(rel_path)
+
+
+def _read_manifest(mod_dir):
+    """Return (strategy, list of mutable globs) declared by the module."""
+    cfg_file = os.path.join(mod_dir, 'config/onramp_metadata.cfg')
+    try:
+        conf = ConfigObj(cfg_file, file_error=True)
+    except (IOError, SyntaxError):
+        return ('copy', [])
+    if 'run_dir' not in conf.keys():
+        return ('copy', [])
+
+    strategy = conf['run_dir'].get('strategy', 'copy')
+    if strategy not in strategies:
+        _logger.warn('Unknown run dir strategy %s in %s. Copying instead.'
+                     % (strategy, cfg_file))
+        strategy = 'copy'
+    mutable = conf['run_dir'].get('mutable', [])
+    if isinstance(mutable, basestring):
+        mutable = [mutable]
+    return (strategy, mutable)
+
+def materialize_run_dir(mod_dir, run_dir):
+    """Populate a run folder from a deployed module.
+
+    Files are placed according to the [run_dir] section of the module's
+    config/onramp_metadata.cfg (see the module docstring).
+
+    Args:
+        mod_dir (str): Absolute path of the deployed module.
+        run_dir (str): Absolute path of the run folder to create. Must not
+            exist.
+
+    Returns:
+        Dict counting files 'copied', 'reflinked', 'hardlinked' and
+        'symlinked', and 'bytes_copied'.
+
+    Raises:
+        OSError: run_dir exists or could not be populated.
+    """
+    if os.path.lexists(run_dir):
+        raise OSError(errno.EEXIST, 'Run folder exists', run_dir)
+
+    strategy, globs = _read_manifest(mod_dir)
+    mutable = set(always_mutable)
+    for entry in globs:
+        for path in glob.glob(os.path.join(mod_dir, entry)):
+            mutable.add(os.path.relpath(path, mod_dir))
+
+    materializer = _Materializer(mod_dir, run_dir, strategy, mutable)
+    try:
+        materializer.run()
+    except:
+        shutil.rmtree(run_dir, ignore_errors=True)
+        raise
+    _logger.debug('Materialized %s (%s): %s'
+                  % (run_dir, strategy, materializer.stats))
+    return materializer.stats
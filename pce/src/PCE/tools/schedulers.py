@@ -74,6 +74,24 @@ class _BatchScheduler(object):
         """
         pass
 
+    def check_status_many(self, scheduler_job_nums):
+        """Return status from scheduler for several jobs at once.
+
+        Subclasses should override this when the scheduler can report on many
+        jobs in a single call. The default implementation calls check_status()
+        once per job.
+
+        Args:
+            scheduler_job_nums (list of int): Job numbers of the jobs to check
+                state on as given by the scheduler, not as given by OnRamp.
+
+        Returns:
+            Dict mapping each given job number to a 2-tuple as returned by
+            check_status().
+        """
+        return dict((job_num, self.check_status(job_num))
+                    for job_num in scheduler_job_nums)
+
     def cancel_job(self, scheduler_job_num):
         """Cancel the given job.
     
@@ -154,19 +172,16 @@ class SLURMScheduler(_BatchScheduler):
                 status_code: Status code
                 status_msg: String giving detailed status info.
         """
-        ret_dir = os.getcwd()
-        os.chdir(proj_loc)
         try:
-            batch_output = check_output(['sbatch', 'script.sh'], stderr=STDOUT)
+            batch_output = check_output(['sbatch', 'script.sh'], stderr=STDOUT,
+                                        cwd=proj_loc)
         except CalledProcessError as e:
             msg = 'Job scheduling call failed'
-            os.chdir(ret_dir)
             return {
                 'status_code': e.returncode,
                 'msg': '%s: %s' % (msg, e.output),
                 'status_msg': '%s: %s' % (msg, e.output)
             }
-        os.chdir(ret_dir)
         output_fields = batch_output.strip().split()
 
         if 'Submitted batch job' != ' '.join(output_fields[:-1]):
@@ -213,6 +228,81 @@ class SLURMScheduler(_BatchScheduler):
             return (-1, msg)
 
         job_state = job_info.split('JobState=')[1].split()[0]
+        return self._get_status(job_state)
+
+    def check_status_many(self, scheduler_job_nums):
+        """Return status from scheduler for several jobs at once.
+
+        A single sacct call is used to query all jobs. Jobs not yet known to
+        accounting fall back to check_status(). If accounting is not
+        available, a single squeue call for the given jobs, in all states, is
+        used instead, and jobs squeue no longer knows about are reported as
+        'No info'.
+
+        Args:
+            scheduler_job_nums (list of int): Job numbers of the jobs to check
+                state on as given by the scheduler, not as given by OnRamp.
+
+        Returns:
+            Dict mapping each given job number to a 2-tuple as returned by
+            check_status().
+        """
+        if not scheduler_job_nums:
+            return {}
+        job_nums = dict((str(job_num), job_num)
+                        for job_num in scheduler_job_nums)
+
+        try:
+            job_info = check_output(['sacct', '--parsable2', '--noheader',
+                                     '--allocations',
+                                     '--format=JobID,State',
+                                     '--jobs=%s' % ','.join(job_nums.keys())],
+                                    stderr=STDOUT)
+            default = None
+        except (CalledProcessError, OSError) as e:
+            self.logger.debug('sacct unavailable, falling back to squeue')
+            try:
+                job_info = check_output(['squeue', '--noheader',
+                                         '--states=all', '--format=%i|%T',
+                                         '--jobs=%s' % ','.join(job_nums.keys())],
+                                        stderr=STDOUT)
+            except (CalledProcessError, OSError) as e:
+                if 'Invalid job id' not in (getattr(e, 'output', None) or ''):
+                    msg = 'Job info call failed'
+                    self.logger.error(msg)
+                    return dict((job_num, (-1, msg))
+                                for job_num in scheduler_job_nums)
+                # None of the jobs are known to slurmctld any more.
+                job_info = ''
+            default = (0, 'No info')
+
+        results = {}
+        for line in job_info.strip().split('\n'):
+            fields = line.strip().split('|')
+            if len(fields) < 2 or fields[0] not in job_nums.keys():
+                continue
+            job_state = fields[1].split()[0] if fields[1].strip() else ''
+            results[job_nums[fields[0]]] = self._get_status(job_state)
+
+        for job_num in scheduler_job_nums:
+            if job_num not in results.keys():
+                if default:
+                    results[job_num] = default
+                else:
+                    # Not yet recorded by accounting. Ask slurmctld directly.
+                    results[job_num] = self.check_status(job_num)
+        return results
+
+    def _get_status(self, job_state):
+        """Translate a SLURM job state into an OnRamp status tuple.
+
+        Args:
+            job_state (str): Job state as reported by SLURM, e.g. 'RUNNING'.
+
+        Returns:
+            2-Tuple with 0th item being error code and 1st item being a string
+            giving detailed status info.
+        """
         if job_state == 'RUNNING':
             return (0, 'Running')
         elif job_state == 'COMPLETED':
@@ -302,18 +392,15 @@ class PBSScheduler(_BatchScheduler):
                 status_code: Status code
                 status_msg: String giving detailed status info.
         """
-        ret_dir = os.getcwd()
-        os.chdir(proj_loc)
         try:
-            batch_output = check_output(['qsub', 'script.sh'], stderr=STDOUT)
+            batch_output = check_output(['qsub', 'script.sh'], stderr=STDOUT,
+                                        cwd=proj_loc)
         except CalledProcessError as e:
             msg = 'Job scheduling call failed'
-            os.chdir(ret_dir)
             return {
                 'returncode': e.returncode,
                 'msg': '%s: %s' % (msg, e.output)
             }
-        os.chdir(ret_dir)
         output_fields = batch_output.strip().split('.')
 
         try:
@@ -0,0 +1,1136 @@
+"""Storage backends for PCE module and job state.
+
+JobState and ModState handle locking and delegate storage of state parameters
+to the backend configured by cluster.state_backend in onramp_pce_config.cfg.
+
+Exports:
+    FileStateBackend: One JSON file per job/module under src/state.
+    SQLiteStateBackend: Indexed SQLite database under src/state.
+    RedisStateBackend: Redis hashes with per-field secondary index sets.
+    StateBackend: Generic instantiator for all implemented backends.
+    get_state_backend: Return the process-wide configured backend.
+    migrate_state: Copy all state from one backend to another.
+"""
+import errno
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    from redis import StrictRedis, WatchError
+except ImportError:
+    # Only required by RedisStateBackend.
+    StrictRedis = None
+
+from PCE.tools.config import get_config
+from PCE.tools.locks import lock_manager
+from PCEHelper import pce_root
+
+_state_root = os.path.join(pce_root, 'src/state')
+_logger = logging.getLogger('onramp')
+
+class _StateBackend(object):
+    """Superclass for state backend classes.
+
+    State is stored per kind ('jobs' or 'modules') and id. Subclasses must
+    override the non-magic methods defined here.
+    """
+    # Fields of each kind that may be used as list_ids()/load_many() filters.
+    indexed_fields = {
+        'jobs': ['state', 'username', 'mod_id', 'scheduler_job_num'],
+        'modules': ['state', 'mod_name']
+    }
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        backend type.
+
+        Args:
+            type (str): Backend type.
+
+        Returns:
+            True if class implements given backend type, False if not.
+        """
+        pass
+
+    def load(self, kind, id):
+        """Return stored state for the given id.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Dict of state parameters, or None if no state is stored.
+        """
+        pass
+
+    def save(self, kind, id, data):
+        """Store state for the given id, replacing any stored state.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+            data (dict): State parameters to store.
+        """
+        pass
+
+    def delete(self, kind, id):
+        """Remove stored state for the given id, if any.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+        """
+        pass
+
+    def load_many(self, kind, **filters):
+        """Return stored state for all ids matching the given filters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: Field/value pairs from indexed_fields[kind] that state
+                must match. A list value matches any of its items.
+
+        Returns:
+            Dict mapping id (as str) to dict of state parameters.
+        """
+        pass
+
+    def list_ids(self, kind, **filters):
+        """Return sorted ids (as str) of all stored state matching filters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: As for load_many().
+        """
+        return sorted(self.load_many(kind, **filters).keys(), key=_id_key)
+
+    def signature(self, kind, id):
+        """Return a value that changes whenever state for id is saved.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Hashable signature, or None if no state is stored.
+        """
+        pass
+
+    def changed_since(self, kind, version=0):
+        """Return ids whose state was saved after the given state version.
+
+        Each save bumps the state version of its kind, a counter that only
+        increases. Changes are tracked by passing the version returned by one
+        call to the next. Deleted ids are not reported.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            version (int): State version to report changes after. 0 reports
+                all stored state.
+
+        Returns:
+            Tuple (sorted list of ids (as str), current state version).
+        """
+        pass
+
+    def version(self, kind):
+        """Return the current state version of kind.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+        """
+        pass
+
+    def wait_for_change(self, kind, version, timeout, interval=0.5):
+        """Block until the state version of kind is greater than version.
+
+        The state version is read every interval seconds. Subclasses able to
+        be notified of saves override this.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            version (int): State version to wait to be exceeded.
+            timeout (float): Maximum number of seconds to wait.
+
+        Kwargs:
+            interval (float): Seconds between reads of the state version.
+
+        Returns:
+            Current state version. It is not greater than version if timeout
+            passed first.
+        """
+        deadline = time.time() + timeout
+        current = self.version(kind)
+        while current <= version:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            time.sleep(min(interval, remaining))
+            current = self.version(kind)
+        return current
+
+    def __init__(self, state_root):
+        """Set the folder state is kept under and return the instance.
+
+        Args:
+            state_root (str): Folder to keep state under.
+        """
+        self.state_root = state_root
+
+
+def _id_key(id):
+    """Sort key ordering numeric ids numerically."""
+    try:
+        return (0, int(id))
+    except ValueError:
+        return (1, id)
+
+def _matches(data, filters):
+    """Return True if data matches all of the given filters."""
+    for field, value in filters.items():
+        if isinstance(value, (list, tuple, set)):
+            if data.get(field) not in value:
+                return False
+        elif data.get(field) != value:
+            return False
+    return True
+
+
+class FileStateBackend(_StateBackend):
+    """Store state as one JSON file per id in src/state/{jobs,modules}.
+
+    The state version of each kind is kept in the hidden file .version in its
+    folder, and the version a state file was saved at is stored in the file
+    under the key '_state_version'. Saves of a kind are serialized by a lock
+    on .version.lock so the version and state files never disagree.
+    """
+    version_field = '_state_version'
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        backend type.
+
+        Args:
+            type (str): Backend type.
+
+        Returns:
+            True if class implements given backend type, False if not.
+        """
+        return type == 'file'
+
+    def _path(self, kind, id):
+        return os.path.join(self.state_root, kind, str(id))
+
+    def _read(self, kind, id):
+        """Return the stored JSON for id, including its state version."""
+        try:
+            with open(self._path(kind, id), 'r') as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            # Invalid json. Ignore (will be overwritten on next save).
+            return {}
+
+    def _write(self, path, data):
+        """Atomically replace the file at path with data as JSON."""
+        # Write to a hidden temp file and rename it over the state file, so
+        # readers never see a partially written file.
+        fd, tmp_path = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path),
+                                        suffix='.tmp',
+                                        dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.chmod(tmp_path, 0644)
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _version_lock(self, kind, shared=False):
+        return lock_manager.acquire(os.path.join(self.state_root, kind,
+                                                 '.version.lock'),
+                                    shared=shared)
+
+    def _read_version(self, kind):
+        try:
+            with open(os.path.join(self.state_root, kind, '.version')) as f:
+                return int(f.read())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    def load(self, kind, id):
+        """Return stored state for the given id.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Dict of state parameters, or None if no state is stored.
+        """
+        data = self._read(kind, id)
+        if data:
+            data.pop(self.version_field, None)
+        return data
+
+    def save(self, kind, id, data):
+        """Store state for the given id, replacing any stored state.
+
+        The file is replaced atomically.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+            data (dict): State parameters to store.
+        """
+        with self._version_lock(kind):
+            version = self._read_version(kind) + 1
+            data = dict(data)
+            data[self.version_field] = version
+            self._write(self._path(kind, id), data)
+            self._write(os.path.join(self.state_root, kind, '.version'),
+                        version)
+
+    def delete(self, kind, id):
+        """Remove stored state for the given id, if any.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+        """
+        try:
+            os.remove(self._path(kind, id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def load_many(self, kind, **filters):
+        """Return stored state for all ids matching the given filters.
+
+        Every state file is read, so filtering is linear in the number of
+        stored jobs/modules.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: Field/value pairs that state must match. A list value
+                matches any of its items.
+
+        Returns:
+            Dict mapping id (as str) to dict of state parameters.
+        """
+        results = {}
+        # Need to filter out hidden files because of .nfs* and lock files.
+        for id in filter(lambda x: not x.startswith('.'),
+                         os.listdir(os.path.join(self.state_root, kind))):
+            data = self.load(kind, id)
+            if data is not None and _matches(data, filters):
+                results[id] = data
+        return results
+
+    def list_ids(self, kind, **filters):
+        """Return sorted ids (as str) of all stored state matching filters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: As for load_many().
+        """
+        if filters:
+            return super(FileStateBackend, self).list_ids(kind, **filters)
+        return sorted(filter(lambda x: not x.startswith('.'),
+                             os.listdir(os.path.join(self.state_root, kind))),
+                      key=_id_key)
+
+    def signature(self, kind, id):
+        """Return a value that changes whenever state for id is saved.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Hashable signature, or None if no state is stored.
+        """
+        try:
+            st = os.stat(self._path(kind, id))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return (st.st_ino, st.st_mtime, st.st_size)
+
+    def version(self, kind):
+        """Return the current state version of kind.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+        """
+        return self._read_version(kind)
+
+    def changed_since(self, kind, version=0):
+        """Return ids whose state was saved after the given state version.
+
+        Every state file is read, so this is linear in the number of stored
+        jobs/modules.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            version (int): State version to report changes after. 0 reports
+                all stored state.
+
+        Returns:
+            Tuple (sorted list of ids (as str), current state version).
+        """
+        # Saves in progress finish with a later version than the one read
+        # here, so none are missed by the next call.
+        with self._version_lock(kind, shared=True):
+            current = self._read_version(kind)
+        if version <= 0:
+            # Includes state saved before state versions were kept.
+            return (self.list_ids(kind), current)
+        ids = []
+        for id in filter(lambda x: not x.startswith('.'),
+                         os.listdir(os.path.join(self.state_root, kind))):
+            data = self._read(kind, id)
+            if data and data.get(self.version_field, 0) > version:
+                ids.append(id)
+        return (sorted(ids, key=_id_key), current)
+
+
+class _SingleFileBackend(FileStateBackend):
+    """FileStateBackend storing the state of a single id at a given path.
+
+    Used for state kept outside src/state, e.g. by onramp_pce_service.py
+    modtest.
+    """
+    def __init__(self, filename):
+        """Set the state file and return the instance.
+
+        Args:
+            filename (str): Path of the state file.
+        """
+        super(_SingleFileBackend, self).__init__(os.path.dirname(filename))
+        self.filename = filename
+
+    def _path(self, kind, id):
+        return self.filename
+
+    def save(self, kind, id, data):
+        """Store state, replacing any stored state. No state version is
+        kept.
+
+        Args:
+            kind (str): Unused.
+            id (int): Unused.
+            data (dict): State parameters to store.
+        """
+        self._write(self.filename, data)
+
+
+class SQLiteStateBackend(_StateBackend):
+    """Store state in the SQLite database src/state/onramp_state.db.
+
+    The database runs in WAL mode so readers never block the writer. The full
+    state of each job/module is stored as JSON alongside indexed copies of the
+    fields in indexed_fields, so listing by those fields is an index lookup.
+    Each save is its own transaction, which also bumps the state version of
+    its kind (kept in the state_versions table) and records it in the
+    indexed changed column.
+    """
+    db_name = 'onramp_state.db'
+    busy_timeout = 30
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        backend type.
+
+        Args:
+            type (str): Backend type.
+
+        Returns:
+            True if class implements given backend type, False if not.
+        """
+        return type == 'sqlite'
+
+    def __init__(self, state_root):
+        """Set the folder state is kept under and return the instance.
+
+        Args:
+            state_root (str): Folder to keep the database in.
+        """
+        super(SQLiteStateBackend, self).__init__(state_root)
+        self.db_file = os.path.join(state_root, self.db_name)
+        self._local = threading.local()
+        self._create_schema()
+
+    def _connect(self):
+        """Return the connection for the calling thread and process."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Connections must not be shared across fork.
+            conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _create_schema(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS state_versions ('
+                         'kind TEXT PRIMARY KEY, '
+                         'version INTEGER NOT NULL)')
+            for kind, fields in self.indexed_fields.items():
+                conn.execute('CREATE TABLE IF NOT EXISTS %s ('
+                             'id INTEGER PRIMARY KEY, %s, '
+                             'version INTEGER NOT NULL, '
+                             'changed INTEGER NOT NULL DEFAULT 0, '
+                             'data TEXT NOT NULL)'
+                             % (kind, ', '.join(fields)))
+                columns = [row[1] for row in
+                           conn.execute('PRAGMA table_info(%s)' % kind)]
+                if 'changed' not in columns:
+                    # Database created before state versions were kept.
+                    conn.execute('ALTER TABLE %s ADD COLUMN changed INTEGER '
+                                 'NOT NULL DEFAULT 0' % kind)
+                for field in fields + ['changed']:
+                    conn.execute('CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)'
+                                 % (kind, field, kind, field))
+                conn.execute('INSERT OR IGNORE INTO state_versions '
+                             '(kind, version) VALUES (?, 0)', (kind,))
+
+    def load(self, kind, id):
+        """Return stored state for the given id.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Dict of state parameters, or None if no state is stored.
+        """
+        row = self._connect().execute('SELECT data FROM %s WHERE id = ?'
+                                      % kind, (int(id),)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def save(self, kind, id, data):
+        """Store state for the given id, replacing any stored state.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+            data (dict): State parameters to store.
+        """
+        fields = self.indexed_fields[kind]
+        values = [data.get(field) for field in fields]
+        conn = self._connect()
+        with conn:
+            conn.execute('UPDATE state_versions SET version = version + 1 '
+                         'WHERE kind = ?', (kind,))
+            changed = conn.execute('SELECT version FROM state_versions '
+                                   'WHERE kind = ?', (kind,)).fetchone()[0]
+            cursor = conn.execute(
+                'UPDATE %s SET %s, version = version + 1, changed = ?, '
+                'data = ? WHERE id = ?'
+                % (kind, ', '.join('%s = ?' % field for field in fields)),
+                values + [changed, json.dumps(data), int(id)])
+            if cursor.rowcount == 0:
+                conn.execute('INSERT INTO %s (id, %s, version, changed, data) '
+                             'VALUES (?, %s, 1, ?, ?)'
+                             % (kind, ', '.join(fields),
+                                ', '.join('?' for field in fields)),
+                             [int(id)] + values + [changed, json.dumps(data)])
+
+    def delete(self, kind, id):
+        """Remove stored state for the given id, if any.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+        """
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM %s WHERE id = ?' % kind, (int(id),))
+
+    def _where(self, kind, filters):
+        """Return WHERE clause and parameters for the given filters."""
+        clauses = []
+        params = []
+        for field, value in sorted(filters.items()):
+            if field not in self.indexed_fields[kind]:
+                raise ValueError('%s is not an indexed field of %s'
+                                 % (field, kind))
+            if isinstance(value, (list, tuple, set)):
+                value = list(value)
+                if not value:
+                    clauses.append('0')
+                    continue
+                clauses.append('%s IN (%s)'
+                               % (field, ', '.join('?' for item in value)))
+                params += value
+            elif value is None:
+                clauses.append('%s IS NULL' % field)
+            else:
+                clauses.append('%s = ?' % field)
+                params.append(value)
+        if not clauses:
+            return ('', params)
+        return (' WHERE ' + ' AND '.join(clauses), params)
+
+    def load_many(self, kind, **filters):
+        """Return stored state for all ids matching the given filters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: Field/value pairs from indexed_fields[kind] that state
+                must match. A list value matches any of its items.
+
+        Returns:
+            Dict mapping id (as str) to dict of state parameters.
+        """
+        where, params = self._where(kind, filters)
+        rows = self._connect().execute('SELECT id, data FROM %s%s'
+                                       % (kind, where), params)
+        return dict((str(row[0]), json.loads(row[1])) for row in rows)
+
+    def list_ids(self, kind, **filters):
+        """Return sorted ids (as str) of all stored state matching filters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: As for load_many().
+        """
+        where, params = self._where(kind, filters)
+        rows = self._connect().execute('SELECT id FROM %s%s ORDER BY id'
+                                       % (kind, where), params)
+        return [str(row[0]) for row in rows]
+
+    def signature(self, kind, id):
+        """Return a value that changes whenever state for id is saved.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Hashable signature, or None if no state is stored.
+        """
+        row = self._connect().execute('SELECT version FROM %s WHERE id = ?'
+                                      % kind, (int(id),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def version(self, kind):
+        """Return the current state version of kind.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+        """
+        return self._connect().execute('SELECT version FROM state_versions '
+                                       'WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def changed_since(self, kind, version=0):
+        """Return ids whose state was saved after the given state version.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            version (int): State version to report changes after. 0 reports
+                all stored state.
+
+        Returns:
+            Tuple (sorted list of ids (as str), current state version).
+        """
+        conn = self._connect()
+        # Read the version first: rows committed later have later versions.
+        current = self.version(kind)
+        if version <= 0:
+            # Includes rows saved before state versions were kept.
+            return (self.list_ids(kind), current)
+        rows = conn.execute('SELECT id FROM %s WHERE changed > ? ORDER BY id'
+                            % kind, (version,))
+        return ([str(row[0]) for row in rows], current)
+
+
+class RedisStateBackend(_StateBackend):
+    """Store state in Redis.
+
+    Keys used, where KIND is 'jobs' or 'modules':
+
+        onramp:KIND:ID                  Hash of JSON-encoded state parameters.
+        onramp:KIND                     Set of all ids.
+        onramp:KIND:index:FIELD:VALUE   Set of ids whose indexed FIELD has the
+                                        JSON-encoded VALUE.
+        onramp:KIND:version             State version of KIND.
+        onramp:KIND:changed             Sorted set of ids scored by the state
+                                        version they were last saved at.
+        onramp:KIND:changes             Channel each new state version is
+                                        published on.
+
+    Writes are applied as field-level updates in WATCH/MULTI transactions that
+    also maintain the index sets, so concurrent writers never clobber fields
+    they did not change and the indexes never disagree with the hashes. Each
+    change of the 'state' field is published as JSON ({"id": ..., "from":
+    ..., "to": ...}) on the channel onramp:KIND:transitions.
+    """
+    key_prefix = 'onramp'
+
+    @classmethod
+    def is_backend_for(cls, type):
+        """Return boolean indicating whether the class implements the given
+        backend type.
+
+        Args:
+            type (str): Backend type.
+
+        Returns:
+            True if class implements given backend type, False if not.
+        """
+        return type == 'redis'
+
+    def __init__(self, state_root, client=None, host='localhost', port=6379,
+                 db=0):
+        """Connect to Redis and return the instance.
+
+        Args:
+            state_root (str): Unused. Accepted for interface compatibility.
+
+        Kwargs:
+            client (StrictRedis): Client to use, e.g. a fakeredis instance. If
+                None, a client is created from host, port and db.
+            host (str): Redis server host.
+            port (int): Redis server port.
+            db (int): Redis database number.
+        """
+        super(RedisStateBackend, self).__init__(state_root)
+        if client is None:
+            if StrictRedis is None:
+                raise ImportError('The redis package is required by the '
+                                  'redis state backend')
+            client = StrictRedis(host=host, port=port, db=db)
+        self.redis = client
+
+    def _key(self, kind, *parts):
+        return ':'.join([self.key_prefix, kind] + [str(part) for part in parts])
+
+    def _index_key(self, kind, field, value):
+        return self._key(kind, 'index', field, json.dumps(value))
+
+    def transitions_channel(self, kind):
+        """Return the pub/sub channel state transitions of kind are published
+        on.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+        """
+        return self._key(kind, 'transitions')
+
+    def subscribe(self, kind):
+        """Return a redis PubSub object subscribed to state transitions.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+        """
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.transitions_channel(kind))
+        return pubsub
+
+    def _decode(self, raw):
+        """Return state parameters from a raw HGETALL result."""
+        if not raw:
+            return None
+        return dict((field, json.loads(value)) for field, value in raw.items()
+                    if field != '_version')
+
+    def load(self, kind, id):
+        """Return stored state for the given id.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Dict of state parameters, or None if no state is stored.
+        """
+        return self._decode(self.redis.hgetall(self._key(kind, id)))
+
+    def update(self, kind, id, fields, removed=()):
+        """Atomically set and remove individual state parameters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+            fields (dict): State parameters to set.
+
+        Kwargs:
+            removed (list of str): State parameters to remove.
+        """
+        self._transact(kind, id, lambda current: (fields, removed))
+
+    def save(self, kind, id, data):
+        """Store state for the given id, replacing any stored state.
+
+        Only fields that differ from the stored state are written.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+            data (dict): State parameters to store.
+        """
+        def diff(current):
+            changed = dict((field, value) for field, value in data.items()
+                           if field not in current
+                           or current[field] != value)
+            removed = [field for field in current.keys()
+                       if field not in data]
+            return (changed, removed)
+        self._transact(kind, id, diff)
+
+    def delete(self, kind, id):
+        """Remove stored state for the given id, if any.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+        """
+        self._transact(kind, id, None)
+
+    def _transact(self, kind, id, get_changes):
+        """Apply changes to the state of id in a WATCH/MULTI transaction.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+            get_changes (function/None): Called with the current state
+                parameters (possibly empty), returns (fields to set, fields to
+                remove). None deletes the state.
+        """
+        key = self._key(kind, id)
+        version_key = self._key(kind, 'version')
+        with self.redis.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key, version_key)
+                    version = int(pipe.get(version_key) or 0)
+                    current = self._decode(pipe.hgetall(key)) or {}
+                    if get_changes is None:
+                        changed, removed = {}, current.keys()
+                    else:
+                        changed, removed = get_changes(current)
+                    removed = [field for field in removed
+                               if field in current and field not in changed]
+                    if not (changed or removed or current):
+                        pipe.reset()
+                        return
+                    pipe.multi()
+                    self._queue_changes(pipe, kind, id, current, changed,
+                                        removed, get_changes is None,
+                                        version + 1)
+                    pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def _queue_changes(self, pipe, kind, id, current, changed, removed,
+                       delete, version):
+        """Queue writes of a transaction on pipe."""
+        key = self._key(kind, id)
+        new = dict(current)
+        new.update(changed)
+        for field in removed:
+            new.pop(field, None)
+
+        if delete:
+            pipe.delete(key)
+            pipe.srem(self._key(kind), id)
+            pipe.zrem(self._key(kind, 'changed'), id)
+            new = {}
+        else:
+            if changed:
+                pipe.hmset(key, dict((field, json.dumps(value))
+                                     for field, value in changed.items()))
+            if removed:
+                pipe.hdel(key, *removed)
+            pipe.hincrby(key, '_version', 1)
+            pipe.sadd(self._key(kind), id)
+            pipe.set(self._key(kind, 'version'), version)
+            pipe.zadd(self._key(kind, 'changed'), version, id)
+            pipe.publish(self._key(kind, 'changes'), version)
+
+        for field in self.indexed_fields[kind]:
+            old_value = current.get(field)
+            new_value = new.get(field)
+            if field in current and (delete or old_value != new_value
+                                     or field not in new):
+                pipe.srem(self._index_key(kind, field, old_value), id)
+            if field in new and (old_value != new_value
+                                 or field not in current):
+                pipe.sadd(self._index_key(kind, field, new_value), id)
+
+        if current.get('state') != new.get('state'):
+            pipe.publish(self.transitions_channel(kind),
+                         json.dumps({'id': str(id),
+                                     'from': current.get('state'),
+                                     'to': new.get('state')}))
+
+    def _match_ids(self, kind, filters):
+        """Return set of ids (as str) matching filters using the indexes."""
+        if not filters:
+            return set(self.redis.smembers(self._key(kind)))
+
+        pipe = self.redis.pipeline(transaction=False)
+        fields = []
+        for field, value in sorted(filters.items()):
+            if field not in self.indexed_fields[kind]:
+                raise ValueError('%s is not an indexed field of %s'
+                                 % (field, kind))
+            if not isinstance(value, (list, tuple, set)):
+                value = [value]
+            fields.append(len(value))
+            for item in value:
+                pipe.smembers(self._index_key(kind, field, item))
+        results = pipe.execute()
+
+        ids = None
+        for count in fields:
+            matched = set()
+            for members in results[:count]:
+                matched |= set(members)
+            results = results[count:]
+            ids = matched if ids is None else ids & matched
+        return ids
+
+    def load_many(self, kind, **filters):
+        """Return stored state for all ids matching the given filters.
+
+        Matching ids are found from the index sets, and their state is read
+        with a single pipelined round trip.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: Field/value pairs from indexed_fields[kind] that state
+                must match. A list value matches any of its items.
+
+        Returns:
+            Dict mapping id (as str) to dict of state parameters.
+        """
+        return self.load_ids(kind, self._match_ids(kind, filters))
+
+    def load_ids(self, kind, ids):
+        """Return stored state for the given ids in a single round trip.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            ids (list): Ids of the jobs/modules.
+
+        Returns:
+            Dict mapping id (as str) to dict of state parameters. Ids with no
+            stored state are omitted.
+        """
+        ids = [str(id) for id in ids]
+        pipe = self.redis.pipeline(transaction=False)
+        for id in ids:
+            pipe.hgetall(self._key(kind, id))
+        results = {}
+        for id, raw in zip(ids, pipe.execute()):
+            data = self._decode(raw)
+            if data is not None:
+                results[id] = data
+        return results
+
+    def list_ids(self, kind, **filters):
+        """Return sorted ids (as str) of all stored state matching filters.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            **filters: As for load_many().
+        """
+        return sorted(self._match_ids(kind, filters), key=_id_key)
+
+    def signature(self, kind, id):
+        """Return a value that changes whenever state for id is saved.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            id (int): Id of the job/module.
+
+        Returns:
+            Hashable signature, or None if no state is stored.
+        """
+        version = self.redis.hget(self._key(kind, id), '_version')
+        if version is None:
+            return None
+        return int(version)
+
+    def version(self, kind):
+        """Return the current state version of kind.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+        """
+        return int(self.redis.get(self._key(kind, 'version')) or 0)
+
+    def wait_for_change(self, kind, version, timeout, interval=0.5):
+        """Block until the state version of kind is greater than version.
+
+        Waits on the onramp:KIND:changes channel rather than reading the
+        state version repeatedly.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+            version (int): State version to wait to be exceeded.
+            timeout (float): Maximum number of seconds to wait.
+
+        Kwargs:
+            interval (float): Maximum seconds to block on the channel at once.
+
+        Returns:
+            Current state version. It is not greater than version if timeout
+            passed first.
+        """
+        deadline = time.time() + timeout
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self._key(kind, 'changes'))
+        try:
+            # Subscribed first, so no save after this read is missed.
+            current = self.version(kind)
+            while current <= version:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                message = pubsub.get_message(timeout=min(interval, remaining))
+                if message is not None:
+                    current = max(current, int(message['data']))
+        finally:
+            pubsub.close()
+        return current
+
+    def changed_since(self, kind, version=0):
+        """Return ids whose state was saved after the given state version.
+
+        Args:
+            kind (str): 'jobs' or 'modules'.
+
+        Kwargs:
+            version (int): State version to report changes after. 0 reports
+                all stored state.
+
+        Returns:
+            Tuple (sorted list of ids (as str), current state version).
+        """
+        # Read the version first: ids saved later have later versions.
+        current = self.version(kind)
+        if version <= 0:
+            # Includes state saved before state versions were kept.
+            return (self.list_ids(kind), current)
+        ids = self.redis.zrangebyscore(self._key(kind, 'changed'),
+                                       '(%d' % version, '+inf')
+        return (sorted(ids, key=_id_key), current)
+
+
+def StateBackend(type, state_root=_state_root, **options):
+    """Instantiate the appropriate state backend class for given type.
+
+    Args:
+        type (str): Identifier for backend type.
+
+    Kwargs:
+        state_root (str): Folder to keep state under.
+        **options: Backend specific options, e.g. the redis connection
+            settings.
+
+    Returns:
+        Instance of a _StateBackend for given type.
+    """
+    for cls in _StateBackend.__subclasses__():
+        if cls.is_backend_for(type):
+            return cls(state_root, **options)
+    raise ValueError
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_state_backend():
+    """Return the state backend configured in onramp_pce_config.cfg.
+
+    The backend is instantiated once per process.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            cfg = get_config()
+            type = cfg['cluster']['state_backend']
+            options = {}
+            if type == 'redis':
+                options = dict(cfg.get('redis', {}))
+            _backend = StateBackend(type, **options)
+    return _backend
+
+def migrate_state(source, dest):
+    """Copy all module and job state from one backend to another.
+
+    State already present in dest for the same id is replaced. Nothing is
+    removed from source.
+
+    Args:
+        source (_StateBackend): Backend to copy state from.
+        dest (_StateBackend): Backend to copy state to.
+
+    Returns:
+        Dict mapping kind to the number of records copied.
+    """
+    counts = {}
+    for kind in ['modules', 'jobs']:
+        counts[kind] = 0
+        for id, data in source.load_many(kind).items():
+            if not data:
+                _logger.warn('Skipping empty or invalid %s state for %s'
+                             % (kind, id))
+                continue
+            dest.save(kind, id, data)
+            counts[kind] += 1
+    return counts
@@ -0,0 +1,169 @@
+"""Cached lookup of the files in a job run folder that are visible to clients.
+
+Modules list the files clients may fetch from a run folder as globs in the
+visible entry of the [onramp] section of config/onramp_metadata.cfg. Rather
+than parse the metadata and glob the folder on every file request and job
+GET, the globs are compiled once per run folder and matched against the folder
+with fnmatch. The resulting set of visible files is kept together with the
+mtimes of the metadata file and of every folder that was scanned, and is only
+rebuilt when one of those changes (that is, when the metadata is edited or a
+file is created, removed, or renamed in a scanned folder).
+
+Exports:
+    VisibilityIndex: The visible files of one run folder.
+    get_visibility_index: Return the current VisibilityIndex of a run folder.
+    clear_visibility_cache: Drop all cached VisibilityIndex instances.
+"""
+import fnmatch
+import glob
+import os
+import threading
+from collections import OrderedDict
+
+from configobj import ConfigObj
+
+_max_entries = 1024
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class VisibilityIndex(object):
+    """The visible files of one run folder.
+
+    Attributes:
+        run_dir (str): Absolute path of the run folder.
+        patterns (list): Visible globs, each split into path segments.
+        files (set): Paths of visible files, relative to run_dir.
+    """
+
+    def __init__(self, run_dir, globs):
+        """Compile globs and scan run_dir for matching files.
+
+        Args:
+            run_dir (str): Absolute path of the run folder.
+            globs (list of str): Visible globs, relative to run_dir.
+        """
+        self.run_dir = run_dir
+        self.cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
+        self.cfg_mtime = None
+        self.patterns = [
+            [segment for segment in entry.split('/') if segment]
+            for entry in globs
+        ]
+        self.files = set()
+        self._dir_mtimes = {}
+        for segments in self.patterns:
+            if segments and '..' not in segments:
+                self._scan('', segments)
+
+    def _scan(self, rel_dir, segments):
+        """Add files under rel_dir matching the pattern segments."""
+        abs_dir = os.path.join(self.run_dir, rel_dir)
+        if abs_dir not in self._dir_mtimes:
+            self._dir_mtimes[abs_dir] = _mtime(abs_dir)
+        segment = segments[0]
+        if glob.has_magic(segment):
+            try:
+                names = os.listdir(abs_dir)
+            except OSError:
+                return
+            if not segment.startswith('.'):
+                # Like glob, wildcards don't match hidden files.
+                names = [name for name in names if not name.startswith('.')]
+            names = fnmatch.filter(names, segment)
+        else:
+            names = [segment]
+
+        for name in names:
+            rel_path = os.path.join(rel_dir, name)
+            abs_path = os.path.join(self.run_dir, rel_path)
+            if len(segments) == 1:
+                if os.path.isfile(abs_path):
+                    self.files.add(rel_path)
+            elif os.path.isdir(abs_path):
+                self._scan(rel_path, segments[1:])
+
+    def is_current(self):
+        """Return True if neither the metadata nor any scanned folder has
+        changed since the index was built.
+        """
+        if _mtime(self.cfg_file) != self.cfg_mtime:
+            return False
+        for path, mtime in self._dir_mtimes.iteritems():
+            if _mtime(path) != mtime:
+                return False
+        return True
+
+    def is_visible(self, filename):
+        """Return True if filename, relative to the run folder, is visible."""
+        return os.path.normpath(filename) in self.files
+
+
+def _build_index(run_dir):
+    """Return a new VisibilityIndex for run_dir, or None if its metadata is
+    missing or badly formed.
+    """
+    cfg_file = os.path.join(run_dir, 'config/onramp_metadata.cfg')
+    # Take the mtime first, so a concurrent edit leaves the index stale
+    # rather than wrongly current.
+    cfg_mtime = _mtime(cfg_file)
+    try:
+        conf = ConfigObj(cfg_file, file_error=True)
+    except (IOError, SyntaxError):
+        return None
+
+    if 'onramp' in conf.keys() and 'visible' in conf['onramp'].keys():
+        globs = conf['onramp']['visible']
+        if isinstance(globs, basestring):
+            # Globs is only a single string. Convert to list.
+            globs = [globs]
+    else:
+        globs = []
+
+    index = VisibilityIndex(run_dir, globs)
+    index.cfg_mtime = cfg_mtime
+    return index
+
+def get_visibility_index(run_dir):
+    """Return the current VisibilityIndex of a run folder.
+
+    The index is rebuilt if the run folder's metadata or any scanned folder
+    has changed since it was cached.
+
+    Args:
+        run_dir (str): Absolute path of the run folder.
+
+    Returns:
+        VisibilityIndex, or None if config/onramp_metadata.cfg is missing or
+        badly formed.
+    """
+    with _cache_lock:
+        index = _cache.pop(run_dir, None)
+        if index is not None:
+            # Reinsert as most recently used.
+            _cache[run_dir] = index
+
+    if index is not None and index.is_current():
+        return index
+
+    index = _build_index(run_dir)
+    with _cache_lock:
+        if index is None:
+            _cache.pop(run_dir, None)
+        else:
+            _cache[run_dir] = index
+            while len(_cache) > _max_entries:
+                _cache.popitem(last=False)
+    return index
+
+def clear_visibility_cache():
+    """Drop all cached VisibilityIndex instances."""
+    with _cache_lock:
+        _cache.clear()
@@ -0,0 +1,421 @@
+"""Bounded worker pool for long-running PCE tasks.
+
+Launching, scheduling and postprocessing jobs, and installing and deploying
+modules, run the module's bin/onramp_*.py scripts and may take minutes. Rather
+than forking a process per request, such tasks are submitted to a persistent
+queue (src/state/onramp_tasks.db) and run by the service's worker pool, which
+runs at most a configured number of tasks of each stage at once in its worker
+threads. Tasks left running when the service stopped are run again when it
+next starts.
+
+Functions are made available as tasks with the worker_task decorator:
+
+    @worker_task('postprocess')
+    def job_postprocess(job_id):
+        ...
+
+    submit('job_postprocess', 47)
+
+Exports:
+    QueueFull: Raised when a task is rejected because its stage's queue is
+        full.
+    OwnerQueueFull: Raised when a task is rejected because its owner has too
+        many tasks queued.
+    worker_task: Decorator registering a function as a task.
+    TaskQueue: Persistent task queue.
+    WorkerPool: Runs queued tasks in a bounded number of worker threads.
+    start_pool: Start the process-wide worker pool.
+    stop_pool: Stop the process-wide worker pool.
+    submit: Queue a task on the process-wide queue.
+    get_queue_depths: Return the number of queued and running tasks per stage.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from PCE.tools.config import get_config
+from PCEHelper import pce_root
+
+_queue_file = os.path.join(pce_root, 'src/state/onramp_tasks.db')
+_logger = logging.getLogger('onramp')
+
+stages = ['preprocess', 'schedule', 'postprocess', 'deploy']
+
+# Registered tasks: name -> (stage, function).
+_tasks = {}
+
+
+class QueueFull(Exception):
+    """Raised when a task is rejected because its stage's queue is full."""
+
+    def __init__(self, stage, depth, msg=None):
+        """Initialize the exception.
+
+        Args:
+            stage (str): Stage of the rejected task.
+            depth (int): Number of tasks queued for the stage.
+
+        Kwargs:
+            msg (str/None): Message, if not the default.
+        """
+        if msg is None:
+            msg = 'The %s queue is full (%d tasks queued)' % (stage, depth)
+        Exception.__init__(self, msg)
+        self.stage = stage
+        self.depth = depth
+
+
+class OwnerQueueFull(QueueFull):
+    """Raised when a task is rejected because its owner has too many tasks
+    queued.
+    """
+
+    def __init__(self, stage, depth, owner):
+        """Initialize the exception.
+
+        Args:
+            stage (str): Stage of the rejected task.
+            depth (int): Number of tasks queued for the stage.
+            owner (str): Owner of the rejected task.
+        """
+        QueueFull.__init__(self, stage, depth,
+                           'User %s has too many tasks queued' % owner)
+        self.owner = owner
+
+
+def worker_task(stage):
+    """Return a decorator registering a function as a task of the given stage.
+
+    The task is submitted by the function's name. Its arguments must be JSON
+    serializable.
+
+    Args:
+        stage (str): One of the stages in workers.stages.
+    """
+    if stage not in stages:
+        raise ValueError('Unknown stage %s' % stage)
+    def register(func):
+        _tasks[func.__name__] = (stage, func)
+        return func
+    return register
+
+def _get_stage(name):
+    try:
+        return _tasks[name][0]
+    except KeyError:
+        raise ValueError('Unknown task %s' % name)
+
+
+class TaskQueue(object):
+    """Persistent queue of tasks kept in an SQLite database.
+
+    Safe for use from multiple threads and processes.
+    """
+    _schema = [
+        'CREATE TABLE IF NOT EXISTS tasks ('
+        ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+        ' stage TEXT NOT NULL,'
+        ' name TEXT NOT NULL,'
+        ' args TEXT NOT NULL,'
+        ' owner TEXT,'
+        ' state TEXT NOT NULL,'
+        ' queued_at REAL NOT NULL,'
+        ' started_at REAL)',
+        'CREATE INDEX IF NOT EXISTS tasks_stage_state '
+        'ON tasks (stage, state, id)'
+    ]
+
+    def __init__(self, filename=_queue_file):
+        """Return a TaskQueue kept in the given database file.
+
+        Kwargs:
+            filename (str): Path of the database file.
+        """
+        self.filename = filename
+        self._local = threading.local()
+        with self._transaction() as conn:
+            for statement in self._schema:
+                conn.execute(statement)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.filename, timeout=30,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    class _Transaction(object):
+        def __init__(self, conn):
+            self.conn = conn
+
+        def __enter__(self):
+            self.conn.execute('BEGIN IMMEDIATE')
+            return self.conn
+
+        def __exit__(self, e_type, e_value, e_traceback):
+            if e_type:
+                self.conn.execute('ROLLBACK')
+            else:
+                self.conn.execute('COMMIT')
+            return False
+
+    def _transaction(self):
+        return self._Transaction(self._conn())
+
+    def put(self, stage, name, args, owner=None, max_depth=None,
+            max_owner_depth=None):
+        """Queue a task.
+
+        Args:
+            stage (str): Stage of the task.
+            name (str): Name of the task.
+            args (list): Arguments to call the task with.
+
+        Kwargs:
+            owner (str/None): User the task is run for.
+            max_depth (int/None): Reject the task if this many tasks of the
+                stage are already queued. None for no limit.
+            max_owner_depth (int/None): Reject the task if owner already has
+                this many tasks of the stage queued. None for no limit.
+
+        Returns:
+            Id of the queued task.
+
+        Raises:
+            QueueFull: The stage's queue is full.
+            OwnerQueueFull: owner has too many tasks queued.
+        """
+        with self._transaction() as conn:
+            depth = conn.execute("SELECT COUNT(*) FROM tasks "
+                                 "WHERE stage = ? AND state = 'queued'",
+                                 (stage,)).fetchone()[0]
+            if max_depth is not None and depth >= max_depth:
+                raise QueueFull(stage, depth)
+            if owner is not None and max_owner_depth is not None:
+                owner_depth = conn.execute(
+                    "SELECT COUNT(*) FROM tasks WHERE stage = ? "
+                    "AND state = 'queued' AND owner = ?",
+                    (stage, owner)).fetchone()[0]
+                if owner_depth >= max_owner_depth:
+                    raise OwnerQueueFull(stage, depth, owner)
+            cursor = conn.execute(
+                "INSERT INTO tasks (stage, name, args, owner, state, "
+                "queued_at) VALUES (?, ?, ?, ?, 'queued', ?)",
+                (stage, name, json.dumps(args), owner, time.time()))
+            return cursor.lastrowid
+
+    def claim(self, stage):
+        """Mark the oldest queued task of the stage as running and return it.
+
+        Args:
+            stage (str): Stage to claim a task of.
+
+        Returns:
+            Tuple of (task id, task name, list of args), or None if no task
+            is queued.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT id, name, args FROM tasks "
+                               "WHERE stage = ? AND state = 'queued' "
+                               "ORDER BY id LIMIT 1", (stage,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE tasks SET state = 'running', started_at = ? "
+                         "WHERE id = ?", (time.time(), row[0]))
+            return (row[0], row[1], json.loads(row[2]))
+
+    def finish(self, task_id):
+        """Remove a finished task.
+
+        Args:
+            task_id (int): Id of the task.
+        """
+        with self._transaction() as conn:
+            conn.execute('DELETE FROM tasks WHERE id = ?', (task_id,))
+
+    def requeue_running(self):
+        """Mark all running tasks as queued again.
+
+        Returns:
+            Number of tasks requeued.
+        """
+        with self._transaction() as conn:
+            return conn.execute("UPDATE tasks SET state = 'queued', "
+                                "started_at = NULL "
+                                "WHERE state = 'running'").rowcount
+
+    def depths(self):
+        """Return the number of queued and running tasks per stage.
+
+        Returns:
+            Dict mapping each stage to a dict with 'queued' and 'running'
+            counts.
+        """
+        results = dict((stage, {'queued': 0, 'running': 0})
+                       for stage in stages)
+        rows = self._conn().execute('SELECT stage, state, COUNT(*) '
+                                    'FROM tasks GROUP BY stage, state')
+        for stage, state, count in rows:
+            results.setdefault(stage, {'queued': 0, 'running': 0})
+            results[stage][state] = count
+        return results
+
+
+class WorkerPool(object):
+    """Run queued tasks in worker threads, with at most a given number of
+    tasks of each stage running at once.
+
+    Tasks run in the pool's threads, so they must not change process-wide
+    state such as the working directory.
+    """
+
+    def __init__(self, queue, concurrency, poll_interval=1):
+        """Return an initialized, stopped WorkerPool.
+
+        Args:
+            queue (TaskQueue): Queue to take tasks from.
+            concurrency (dict): Maps each stage to the number of tasks of that
+                stage that may run at once.
+
+        Kwargs:
+            poll_interval (float): Seconds between checks of the queue for
+                tasks queued by other processes.
+        """
+        self.queue = queue
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._cond = threading.Condition()
+        self._running = False
+        self._threads = []
+
+    def start(self):
+        """Requeue tasks interrupted by a previous shutdown and start the
+        workers.
+        """
+        requeued = self.queue.requeue_running()
+        if requeued:
+            _logger.info('Requeued %d interrupted task(s)' % requeued)
+        self._running = True
+        for stage in stages:
+            for i in range(self.concurrency.get(stage, 1)):
+                thread = threading.Thread(target=self._work, args=(stage,),
+                                          name='Worker-%s-%d' % (stage, i))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Stop taking tasks and wait for running tasks to finish."""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def notify(self):
+        """Wake idle workers to check the queue."""
+        with self._cond:
+            self._cond.notify_all()
+
+    def _work(self, stage):
+        while self._running:
+            try:
+                task = self.queue.claim(stage)
+            except sqlite3.Error as e:
+                _logger.error('Could not read the task queue: %s' % e)
+                task = None
+            if task is None:
+                with self._cond:
+                    if self._running:
+                        self._cond.wait(self.poll_interval)
+                continue
+
+            task_id, name, args = task
+            if name not in _tasks:
+                _logger.error('Dropping unknown task %s' % name)
+                self.queue.finish(task_id)
+                continue
+            _logger.debug('Running task %d: %s%s' % (task_id, name,
+                                                     tuple(args)))
+            try:
+                _tasks[name][1](*args)
+            except Exception as e:
+                _logger.exception('Task %d (%s) failed: %s'
+                                  % (task_id, name, e))
+            self.queue.finish(task_id)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+_pool = None
+
+def _get_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = TaskQueue()
+    return _queue
+
+def start_pool():
+    """Start the process-wide worker pool with the concurrency configured in
+    onramp_pce_config.cfg.
+    """
+    global _pool
+    cfg = get_config()['workers']
+    _pool = WorkerPool(_get_queue(),
+                       dict((stage, cfg[stage]) for stage in stages))
+    _pool.start()
+
+def stop_pool():
+    """Stop the process-wide worker pool, waiting for running tasks."""
+    global _pool
+    if _pool is not None:
+        _pool.stop()
+        _pool = None
+
+def submit(name, *args, **kwargs):
+    """Queue a task on the process-wide queue.
+
+    Args:
+        name (str): Name of a function registered with worker_task.
+        *args: Arguments to call the task with.
+
+    Kwargs:
+        owner (str/None): User the task is run for. Used to limit the number
+            of tasks queued per user.
+        force (bool): If True, queue the task regardless of queue limits. Used
+            for tasks continuing work that was already accepted.
+
+    Raises:
+        QueueFull: The queue for the task's stage is full.
+        OwnerQueueFull: owner has too many tasks queued.
+    """
+    owner = kwargs.get('owner')
+    force = kwargs.get('force', False)
+    stage = _get_stage(name)
+    cfg = get_config()['workers']
+    if force:
+        max_depth = max_owner_depth = None
+    else:
+        max_depth = cfg['max_queue_depth']
+        max_owner_depth = cfg['max_user_queue_depth']
+    task_id = _get_queue().put(stage, name, list(args), owner=owner,
+                               max_depth=max_depth,
+                               max_owner_depth=max_owner_depth)
+    _logger.debug('Queued task %d: %s%s' % (task_id, name, args))
+    if _pool is not None:
+        _pool.notify()
+    return task_id
+
+def get_queue_depths():
+    """Return the number of queued and running tasks per stage. See
+    TaskQueue.depths().
+    """
+    return _get_queue().depths()
@@ -9,14 +9,102 @@ import socket
 import sys
 
 import cherrypy
-from cherrypy.process.plugins import Daemonizer, PIDFile
-from configobj import ConfigObj
-from validate import Validator
+from cherrypy.lib import encoding
+from cherrypy.process.plugins import Daemonizer, Monitor, PIDFile, \
+                                     SimplePlugin
 
 from PCE.dispatchers import APIMap, ClusterInfo, ClusterPing, Files, Jobs, \
                             Modules
+from PCE.tools.config import check_config, get_config, reload_config
+from PCE.tools.jobs import poll_jobs
+from PCE.tools.locks import get_lock_stats, remove_stale_lock_files
+from PCE.tools.workers import start_pool, stop_pool
 from PCEHelper import pce_root
 
+# Seconds between checks of onramp_pce_config.cfg for modifications.
+_config_check_interval = 5
+
+# Settings only applied on a restart, as in effect when the server started.
+_running_settings = None
+
+# Content types that may be gzip compressed.
+_gzip_mime_types = ['application/json', 'text/*']
+
+_log_levels = {
+    'DEBUG': logging.DEBUG,
+    'INFO': logging.INFO,
+    'WARNING': logging.WARNING,
+    'ERROR': logging.ERROR,
+    'CRITICAL': logging.CRITICAL
+}
+
+
+class JobPoller(Monitor):
+    """CherryPy engine plugin that refreshes the scheduler state of active jobs
+    in a background thread.
+    """
+    def __init__(self, bus, frequency):
+        """Initialize the poller.
+
+        Args:
+            bus (cherrypy.process.wspbus.Bus): Engine to subscribe to.
+            frequency (int): Seconds between polls.
+        """
+        Monitor.__init__(self, bus, poll_jobs, frequency=frequency,
+                         name='JobPoller')
+
+class WorkerPool(SimplePlugin):
+    """CherryPy engine plugin that runs the worker pool executing queued
+    launch, schedule, postprocess and deploy tasks.
+    """
+    def start(self):
+        """Start the worker pool."""
+        start_pool()
+    # Start after the Daemonizer has forked, so the workers run in the
+    # daemon.
+    start.priority = 75
+
+    def stop(self):
+        """Stop the worker pool, waiting for running tasks to finish."""
+        stop_pool()
+
+class ConfigWatcher(Monitor):
+    """CherryPy engine plugin that reloads onramp_pce_config.cfg in a
+    background thread when the file is modified.
+    """
+    def __init__(self, bus, frequency):
+        """Initialize the watcher.
+
+        Args:
+            bus (cherrypy.process.wspbus.Bus): Engine to subscribe to.
+            frequency (int): Seconds between checks.
+        """
+        Monitor.__init__(self, bus, self.check, frequency=frequency,
+                         name='ConfigWatcher')
+
+    def check(self):
+        """Reload the configuration if modified. Errors are logged, as an
+        exception would stop the watcher thread.
+
+        Changes to settings that need a restart are not applied here. They
+        are logged, and applied on the next SIGHUP.
+        """
+        try:
+            if check_config():
+                _apply_log_level()
+                if _restart_needed():
+                    logging.getLogger('onramp').warn(
+                        'Changes to the server section, poll_interval or '
+                        'state_backend take effect on restart (SIGHUP)')
+        except Exception as e:
+            logging.getLogger('onramp').exception(e)
+
+def _apply_log_level():
+    """Set the onramp logger to the level in the current configuration."""
+    cfg = get_config()
+    if 'cluster' in cfg.keys() and 'log_level' in cfg['cluster'].keys():
+        logger = logging.getLogger('onramp')
+        logger.setLevel(_log_levels[cfg['cluster']['log_level']])
 
 def _CORS():
     """Set HTTP Access Control Header to allow cross-site HTTP requests from
@@ -24,6 +112,27 @@ def _CORS():
     """
     cherrypy.response.headers['Access-Control-Allow-Origin'] = '*'
 
+def _gzip():
+    """Gzip the response body if the client accepts gzip and the body is at
+    least compression.min_size bytes.
+
+    See cherrypy.lib.encoding.gzip(). Partial content (range) responses are
+    never compressed.
+    """
+    cfg = get_config()['compression']
+    response = cherrypy.serving.response
+    if not cfg['enabled'] or 'Content-Range' in response.headers:
+        return
+
+    size = response.headers.get('Content-Length')
+    if size is None and not response.stream:
+        # Buffered responses (e.g. JSON) are collapsed in finalize anyway.
+        size = len(response.collapse_body())
+    if size is not None and int(size) < cfg['min_size']:
+        return
+
+    encoding.gzip(compress_level=cfg['level'], mime_types=_gzip_mime_types)
+
 def _term_handler(signal, frame):
     """Gracefully shutdown the server and exit.
 
@@ -31,23 +140,44 @@ def _term_handler(signal, frame):
     """
     logger = logging.getLogger('onramp')
     logger.info('Shutting down server')
+    logger.info('State lock stats: %s' % str(get_lock_stats()))
 
     cherrypy.engine.exit()
     logger.info('Exiting')
     sys.exit(0)
 
+def _restart_settings(cfg):
+    """Return the settings of cfg that only take effect on a restart."""
+    return (dict(cfg.get('server', {})), cfg['cluster']['poll_interval'],
+            cfg['cluster']['state_backend'])
+
+def _restart_needed():
+    """Return True if the current configuration changes settings that only
+    take effect on a restart.
+    """
+    return _restart_settings(get_config()) != _running_settings
+
 def _restart_handler(signal, frame):
-    """Restart the server.
+    """Reload onramp_pce_config.cfg, restarting the server if needed.
+
+    The server is only restarted if settings that can't be changed in a
+    running server (the server section, poll_interval and state_backend)
+    differ from those it was started with, whether changed now or already
+    reloaded by the ConfigWatcher. Other changes take effect immediately.
 
     This function is intended to be registered as a SIGHUP handler.
     """
     logger = logging.getLogger('onramp')
-    logger.info('Restarting server')
-    # FIXME: This needs to reload the config, including attrs in
-    # onramp_pce_config.cfg.
-    cherrypy.engine.restart()
-    logger.debug('Blocking cherrypy engine')
-    cherrypy.engine.block()
+    logger.info('Reloading configuration')
+    if not reload_config():
+        return
+    _apply_log_level()
+
+    if _restart_needed():
+        logger.info('Restarting server')
+        cherrypy.engine.restart()
+    else:
+        cherrypy.engine.graceful()
 
 if __name__ == '__main__':
     # Default conf. Some of these can/will be overrided by attrs in
@@ -66,7 +196,8 @@ if __name__ == '__main__':
 
         '/': {
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
-            'tools.CORS.on': True
+            'tools.CORS.on': True,
+            'tools.compress.on': True
         },
 
         'internal': {
@@ -78,10 +209,8 @@ if __name__ == '__main__':
 
     # Load onramp_pce_config.cfg and integrate appropriate attrs into cherrpy
     # conf.
-    cfg = ConfigObj(os.path.join(pce_root, 'bin', 'onramp_pce_config.cfg'),
-                    configspec=os.path.join(pce_root, 'src', 'configspecs',
-                                            'onramp_pce_config.cfgspec'))
-    cfg.validate(Validator())
+    cfg = get_config()
+    _running_settings = _restart_settings(cfg)
     if 'server' in cfg.keys():
         for k in cfg['server']:
             conf['global']['server.' + k] = cfg['server'][k]
@@ -98,16 +227,9 @@ if __name__ == '__main__':
     cherrypy.config.update(conf)
 
     # Set up logging.
-    log_levels = {
-        'DEBUG': logging.DEBUG,
-        'INFO': logging.INFO,
-        'WARNING': logging.WARNING,
-        'ERROR': logging.ERROR,
-        'CRITICAL': logging.CRITICAL
-    }
     log_name = 'onramp'
     logger = logging.getLogger(log_name)
-    logger.setLevel(log_levels[conf['internal']['log_level']])
+    logger.setLevel(_log_levels[conf['internal']['log_level']])
     handler = logging.FileHandler(conf['internal']['onramp_log_file'])
     handler.setFormatter(
         logging.Formatter('[%(asctime)s] %(levelname)s %(message)s'))
@@ -115,11 +237,22 @@ if __name__ == '__main__':
     logger.info('Logging at %s to %s' % (conf['internal']['log_level'],
                                          conf['internal']['onramp_log_file']))
 
+    # Locks are now held with lockf() and released by the kernel when their
+    # holder dies. Clear any lock files left by the old O_EXCL scheme.
+    remove_stale_lock_files(os.path.join(pce_root, 'src/state/jobs'))
+    remove_stale_lock_files(os.path.join(pce_root, 'src/state/modules'))
+
     # Log the PID
     PIDFile(cherrypy.engine, conf['internal']['PIDfile']).subscribe()
 
     Daemonizer(cherrypy.engine).subscribe()
+    ConfigWatcher(cherrypy.engine, _config_check_interval).subscribe()
+    WorkerPool(cherrypy.engine).subscribe()
+    if cfg['cluster']['poll_interval'] > 0:
+        JobPoller(cherrypy.engine, cfg['cluster']['poll_interval']).subscribe()
     cherrypy.tools.CORS = cherrypy.Tool('before_finalize', _CORS)
+    cherrypy.tools.compress = cherrypy.Tool('before_finalize', _gzip,
+                                            priority=80)
     cherrypy.tree.mount(Modules(cfg, log_name), '/modules', conf)
     cherrypy.tree.mount(Jobs(cfg, log_name), '/jobs', conf)
     cherrypy.tree.mount(ClusterInfo(cfg, log_name), '/cluster/info', conf)
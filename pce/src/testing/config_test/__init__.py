@@ -0,0 +1,60 @@
+"""Unit testing for PCE.tools.config."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from PCE.tools.config import ConfigService
+from PCE.tools.schedulers import PBSScheduler, SLURMScheduler
+
+_cfg_spec = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '../../configspecs/onramp_pce_config.cfgspec')
+_cfg = """[server]
+socket_host = 127.0.0.1
+socket_port = 9091
+
+[cluster]
+batch_scheduler = %s
+log_level = DEBUG
+log_file = log/onramp.log
+"""
+
+class ConfigServiceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cfg_file = os.path.join(self.tmp_dir, 'onramp_pce_config.cfg')
+        self.write_cfg(_cfg % 'SLURM', 1000)
+        self.config = ConfigService(self.cfg_file, _cfg_spec)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_cfg(self, contents, mtime):
+        with open(self.cfg_file, 'w') as f:
+            f.write(contents)
+        os.utime(self.cfg_file, (mtime, mtime))
+
+    def test_load(self):
+        cfg = self.config.get()
+        self.assertIs(self.config.get(), cfg)
+        self.assertEqual(cfg['cluster']['poll_interval'], 10)
+        self.assertIsInstance(self.config.get_scheduler(), SLURMScheduler)
+        self.assertIs(self.config.get_scheduler(),
+                      self.config.get_scheduler())
+        self.assertFalse(self.config.check())
+
+    def test_reload(self):
+        cfg = self.config.get()
+
+        # Invalid config is not loaded.
+        self.write_cfg(_cfg % 'LSF', 2000)
+        self.assertFalse(self.config.check())
+        self.assertIs(self.config.get(), cfg)
+
+        # Modified config is.
+        self.write_cfg(_cfg % 'PBS', 3000)
+        self.assertTrue(self.config.check())
+        self.assertEqual(self.config.get()['cluster']['batch_scheduler'],
+                         'PBS')
+        self.assertIsInstance(self.config.get_scheduler(), PBSScheduler)
+        self.assertTrue(self.config.reload())
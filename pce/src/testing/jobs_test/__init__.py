@@ -0,0 +1,163 @@
+"""Unit testing for PCE.tools.jobs."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from cherrypy.process.wspbus import Bus
+
+from PCE.tools import jobs, state_backends
+from PCE.tools.jobs import get_job_changes, get_jobs, poll_jobs
+from PCE.tools.state_backends import StateBackend
+from RESTservice import JobPoller
+
+class FakeScheduler(object):
+    """Reports the status set in statuses for each job number."""
+    def __init__(self):
+        self.statuses = {}
+        self.calls = 0
+
+    def check_status(self, scheduler_job_num):
+        self.calls += 1
+        return self.statuses[scheduler_job_num]
+
+    def check_status_many(self, scheduler_job_nums):
+        self.calls += 1
+        return dict((job_num, self.statuses[job_num])
+                    for job_num in scheduler_job_nums)
+
+class JobChangesTest(unittest.TestCase):
+    def setUp(self):
+        self.state_root = tempfile.mkdtemp()
+        self.saved_backend = state_backends._backend
+        self.backend = StateBackend('sqlite', state_root=self.state_root)
+        state_backends._backend = self.backend
+        self.saved_lock_dir = jobs._job_state_dir
+        jobs._job_state_dir = os.path.join(self.state_root, 'jobs')
+        os.mkdir(jobs._job_state_dir)
+        jobs._job_cache.clear()
+        for id, username in [(1, 'alice'), (2, 'bob'), (3, 'alice')]:
+            self.save_job(id, username)
+
+    def tearDown(self):
+        jobs._job_cache.clear()
+        jobs._job_state_dir = self.saved_lock_dir
+        state_backends._backend = self.saved_backend
+        shutil.rmtree(self.state_root)
+
+    def save_job(self, id, username, **attrs):
+        job = {'job_id': id, 'state': 'Done', 'username': username,
+               'mod_id': 1, 'mod_name': 'testmodule', 'run_name': 'run%d' % id}
+        job.update(attrs)
+        self.backend.save('jobs', id, job)
+
+    def job_ids(self, jobs):
+        return sorted(job['job_id'] for job in jobs)
+
+    def test_changes(self):
+        jobs, version = get_job_changes(0, cached=True)
+        self.assertEqual(self.job_ids(jobs), [1, 2, 3])
+        self.assertEqual(get_job_changes(version, cached=True), ([], version))
+
+        self.save_job(2, 'bob', error='Failed')
+        jobs, version2 = get_job_changes(version, cached=True)
+        self.assertEqual(self.job_ids(jobs), [2])
+        self.assertEqual(version2, version + 1)
+
+    def test_changes_with_ids(self):
+        jobs, version = get_job_changes(0, cached=True, job_ids=[1, 2])
+        self.assertEqual(self.job_ids(jobs), [1, 2])
+
+        for id in [1, 3]:
+            self.save_job(id, 'alice', error='Failed')
+        jobs, _ = get_job_changes(version, cached=True, job_ids=[1, 2])
+        self.assertEqual(self.job_ids(jobs), [1])
+        jobs, _ = get_job_changes(version, cached=True, job_ids=[2])
+        self.assertEqual(jobs, [])
+        jobs, _ = get_job_changes(version, cached=True, job_ids=[1, 3],
+                                  username='alice')
+        self.assertEqual(self.job_ids(jobs), [1, 3])
+
+class JobPollerTest(unittest.TestCase):
+    def setUp(self):
+        self.state_root = tempfile.mkdtemp()
+        self.saved_backend = state_backends._backend
+        self.backend = StateBackend('sqlite', state_root=self.state_root)
+        state_backends._backend = self.backend
+        self.saved_lock_dir = jobs._job_state_dir
+        jobs._job_state_dir = os.path.join(self.state_root, 'jobs')
+        os.mkdir(jobs._job_state_dir)
+        self.saved_get_scheduler = jobs.get_scheduler
+        self.scheduler = FakeScheduler()
+        jobs.get_scheduler = lambda: self.scheduler
+        jobs._job_cache.clear()
+
+        for id, job_num in [(1, 101), (2, 102)]:
+            self.backend.save('jobs', id, {
+                'job_id': id, 'state': 'Queued', 'username': 'alice',
+                'mod_id': 1, 'mod_name': 'testmodule',
+                'run_name': 'run%d' % id, 'scheduler_job_num': job_num,
+                '_marked_for_del': False})
+            self.scheduler.statuses[job_num] = (0, 'Queued')
+
+    def tearDown(self):
+        jobs._job_cache.clear()
+        jobs.get_scheduler = self.saved_get_scheduler
+        jobs._job_state_dir = self.saved_lock_dir
+        state_backends._backend = self.saved_backend
+        shutil.rmtree(self.state_root)
+
+    def test_poll_jobs(self):
+        poll_jobs()
+        self.assertEqual(self.scheduler.calls, 1)
+        self.assertEqual(sorted(jobs._job_cache.keys()), ['1', '2'])
+
+        # Polling stores the new scheduler state and refreshes the cache.
+        self.scheduler.statuses[102] = (-1, 'Job failed')
+        poll_jobs()
+        self.assertEqual(self.scheduler.calls, 2)
+        self.assertEqual(self.backend.load('jobs', 2)['state'], 'Job failed')
+        self.assertEqual(jobs._job_cache['2'][1]['state'], 'Job failed')
+
+        # Deleted jobs are dropped from the cache.
+        self.backend.delete('jobs', 1)
+        poll_jobs()
+        self.assertEqual(jobs._job_cache.keys(), ['2'])
+
+    def test_cached_reads(self):
+        poll_jobs()
+        calls = self.scheduler.calls
+        self.scheduler.statuses[101] = (-1, 'Job failed')
+        self.assertEqual(get_jobs(1, cached=True)['state'], 'Queued')
+        self.assertEqual([job['state'] for job in get_jobs(cached=True)],
+                         ['Queued', 'Queued'])
+
+        # Saved state is read from the backend, still without the scheduler.
+        self.backend.save('jobs', 1, dict(self.backend.load('jobs', 1),
+                                          state='Done'))
+        self.assertEqual(get_jobs(1, cached=True)['state'], 'Done')
+        jobs._job_cache.clear()
+        self.assertEqual(get_jobs(2, cached=True)['state'], 'Queued')
+        self.assertEqual(self.scheduler.calls, calls)
+
+        # Uncached reads ask the scheduler.
+        self.assertEqual(get_jobs(2)['state'], 'Queued')
+        self.assertEqual(self.scheduler.calls, calls + 1)
+
+    def test_poller_stops(self):
+        bus = Bus()
+        poller = JobPoller(bus, 0.05)
+        poller.subscribe()
+        bus.start()
+        try:
+            deadline = time.time() + 5
+            while self.scheduler.calls < 2 and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertGreaterEqual(self.scheduler.calls, 2)
+        finally:
+            bus.exit()
+        self.assertIsNone(poller.thread)
+        calls = self.scheduler.calls
+        time.sleep(0.2)
+        self.assertEqual(self.scheduler.calls, calls)
@@ -0,0 +1,61 @@
+"""Unit testing for PCE.tools.locks."""
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from PCE.tools.locks import LockManager, LockTimeout
+
+class LockManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.lock_file = os.path.join(self.tmp_dir, '.1.lock')
+        self.manager = LockManager()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared(self):
+        lock1 = self.manager.acquire(self.lock_file, shared=True)
+        lock2 = self.manager.acquire(self.lock_file, shared=True, timeout=.1)
+        lock1.release()
+        lock2.release()
+        stats = self.manager.get_stats()
+        self.assertEqual(stats['acquired'], 2)
+        self.assertEqual(stats['shared_acquired'], 2)
+        self.assertEqual(stats['held'], 0)
+        self.assertTrue(os.path.isfile(self.lock_file))
+
+    def test_exclusive(self):
+        with self.manager.acquire(self.lock_file):
+            self.assertRaises(LockTimeout, self.manager.acquire,
+                              self.lock_file, timeout=.05)
+            self.assertRaises(LockTimeout, self.manager.acquire,
+                              self.lock_file, shared=True, timeout=.05)
+        with self.manager.acquire(self.lock_file, timeout=.05):
+            pass
+        stats = self.manager.get_stats()
+        self.assertEqual(stats['timeouts'], 2)
+        self.assertEqual(stats['held'], 0)
+
+    def test_blocking_wait(self):
+        lock = self.manager.acquire(self.lock_file)
+        acquired = []
+
+        def waiter():
+            with self.manager.acquire(self.lock_file):
+                acquired.append(time.time())
+
+        t = threading.Thread(target=waiter)
+        t.start()
+        time.sleep(.1)
+        self.assertEqual(acquired, [])
+        lock.release()
+        t.join(5)
+        self.assertEqual(len(acquired), 1)
+        stats = self.manager.get_stats()
+        self.assertEqual(stats['contended'], 1)
+        self.assertTrue(stats['max_wait_time'] >= .1)
+        self.assertTrue(stats['max_hold_time'] >= .1)
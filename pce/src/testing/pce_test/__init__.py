@@ -9,6 +9,7 @@ Exports:
     JobsTest: Unit tests for the PCE jobs resource.
     ClusterTest: Unit tests for the PCE cluster resource.
 """
+import hashlib
 import json
 import os
 import requests
@@ -982,7 +983,13 @@ class ModuleJobFlowTest(PCEBase):
         self.assertEqual(job['run_name'], run_name)
         self.assertEqual(job['mod_id'], mod_id)
         self.assertEqual(job['mod_status_output'], mod_status_output)
-        self.assertEqual(job['output'], output)
+        if output is None:
+            self.assertIsNone(job['output_size'])
+            self.assertIsNone(job['output_digest'])
+        else:
+            self.assertEqual(job['output_size'], len(output))
+            self.assertEqual(job['output_digest'],
+                             hashlib.sha256(output).hexdigest())
         if check_scheduler_job_num:
             self.assertTrue(isinstance(job['scheduler_job_num'], int))
         else:
@@ -1295,6 +1302,22 @@ class ModuleJobFlowTest(PCEBase):
                   'deterministic output!')
         self.check_job(d['job'], state='Done',
                        check_scheduler_job_num=True, error=None, output=output)
+
+        r = pce_get('jobs/1/output', offset=6, limit=10)
+        self.assertEqual(r.status_code, 200)
+        d = r.json()
+        self.check_json(d, good=True)
+        self.assertEqual(d['output'], output[6:16])
+        self.assertEqual(d['offset'], 6)
+        self.assertEqual(d['next_offset'], 16)
+        self.assertEqual(d['size'], len(output))
+        self.assertEqual(d['state'], 'Done')
+        r = pce_get('jobs/1/output', offset=d['size'])
+        d = r.json()
+        self.assertEqual(d['output'], '')
+        self.assertEqual(d['next_offset'], len(output))
+        r = pce_get('jobs/1/output', offset='x')
+        self.assertEqual(r.status_code, 400)
         self.assertIn('visible_files', d['job'].keys())
         visible_files = d['job']['visible_files']
         self.assertEqual(len(visible_files), 3)
@@ -1315,7 +1338,26 @@ class ModuleJobFlowTest(PCEBase):
         fname = os.path.join(pce_root,
                              'users/testuser/testmodule_1/testrun1/output.txt')
         with open(fname) as f:
-            self.assertEqual(r.text, f.read())
+            contents = f.read()
+        self.assertEqual(r.text, contents)
+        self.assertTrue(r.headers['content-type'].startswith('text/plain'))
+        self.assertEqual(int(r.headers['content-length']), len(contents))
+        # Weak, as the same ETag is sent with gzip compressed bodies.
+        self.assertTrue(r.headers['etag'].startswith('W/"'))
+        self.assertIn('last-modified', r.headers.keys())
+        # Below compression.min_size, so sent uncompressed.
+        self.assertIsNone(r.headers.get('content-encoding'))
+
+        url = pce_url('files/testuser/testmodule_1/testrun1/output.txt')
+        r2 = requests.get(url, headers={'Range': 'bytes=5-'})
+        self.assertEqual(r2.status_code, 206)
+        self.assertEqual(r2.text, contents[5:])
+        r2 = requests.get(url, headers={'If-None-Match': r.headers['etag']})
+        self.assertEqual(r2.status_code, 304)
+        r2 = requests.get(url, headers={
+            'If-Modified-Since': r.headers['last-modified']
+        })
+        self.assertEqual(r2.status_code, 304)
 
         r = pce_get('files/testuser/testmodule_1/testrun1/onramp_runparams.cfg')
         self.assertEqual(r.status_code, 403)
@@ -0,0 +1,74 @@
+"""Unit testing for PCE.tools.rundirs."""
+import os
+import shutil
+import tempfile
+import unittest
+
+from PCE.tools.rundirs import materialize_run_dir
+
+
+class RunDirsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.mod_dir = os.path.join(self.tmp_dir, 'mod')
+        self.run_dir = os.path.join(self.tmp_dir, 'run')
+        for path in ['bin', 'src', 'config', 'results']:
+            os.makedirs(os.path.join(self.mod_dir, path))
+        for path in ['bin/onramp_run.py', 'src/hello', 'src/input.dat',
+                     'results/out.dat', 'onramp_runparams.cfg']:
+            with open(os.path.join(self.mod_dir, path), 'w') as f:
+                f.write(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_manifest(self, strategy):
+        with open(os.path.join(self.mod_dir, 'config/onramp_metadata.cfg'),
+                  'w') as f:
+            f.write('[run_dir]\nstrategy = %s\n' % strategy)
+            f.write('mutable = src/*.dat, results\n')
+
+    def assert_contents(self):
+        for path in ['bin/onramp_run.py', 'src/hello', 'src/input.dat',
+                     'results/out.dat', 'onramp_runparams.cfg']:
+            with open(os.path.join(self.run_dir, path)) as f:
+                self.assertEqual(f.read(), path)
+
+    def is_shared(self, path):
+        return os.path.samefile(os.path.join(self.mod_dir, path),
+                                os.path.join(self.run_dir, path))
+
+    def test_copy(self):
+        stats = materialize_run_dir(self.mod_dir, self.run_dir)
+        self.assert_contents()
+        self.assertEqual(stats['copied'] + stats['reflinked'], 5)
+        self.assertFalse(self.is_shared('bin/onramp_run.py'))
+        self.assertRaises(OSError, materialize_run_dir, self.mod_dir,
+                          self.run_dir)
+        self.assert_contents()
+
+    def test_hardlink(self):
+        self.write_manifest('hardlink')
+        stats = materialize_run_dir(self.mod_dir, self.run_dir)
+        self.assert_contents()
+        self.assertEqual(stats['hardlinked'], 3)
+        self.assertTrue(self.is_shared('bin/onramp_run.py'))
+        self.assertTrue(self.is_shared('src/hello'))
+        self.assertFalse(self.is_shared('src/input.dat'))
+        self.assertFalse(self.is_shared('results/out.dat'))
+        self.assertFalse(self.is_shared('onramp_runparams.cfg'))
+
+    def test_symlink(self):
+        self.write_manifest('symlink')
+        materialize_run_dir(self.mod_dir, self.run_dir)
+        self.assert_contents()
+        self.assertTrue(os.path.islink(os.path.join(self.run_dir, 'bin')))
+        self.assertFalse(os.path.islink(os.path.join(self.run_dir, 'src')))
+        self.assertTrue(os.path.islink(os.path.join(self.run_dir,
+                                                    'src/hello')))
+        self.assertFalse(self.is_shared('src/input.dat'))
+        self.assertFalse(os.path.islink(os.path.join(self.run_dir,
+                                                     'results')))
+        shutil.rmtree(self.run_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.mod_dir,
+                                                    'bin/onramp_run.py')))
@@ -0,0 +1,84 @@
+"""Unit testing for PCE.tools.schedulers."""
+import unittest
+from subprocess import CalledProcessError
+
+from PCE.tools import schedulers
+from PCE.tools.schedulers import Scheduler
+
+class SLURMStatusTest(unittest.TestCase):
+    def setUp(self):
+        self.check_output = schedulers.check_output
+        schedulers.check_output = self.fake_check_output
+        self.calls = []
+        # Output, or exception raised, by each command
+        self.outputs = {}
+        self.scheduler = Scheduler('SLURM')
+
+    def tearDown(self):
+        schedulers.check_output = self.check_output
+
+    def fake_check_output(self, args, **kwargs):
+        self.calls.append(args)
+        result = self.outputs[args[0]]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def test_sacct(self):
+        self.outputs['sacct'] = ('101|RUNNING\n'
+                                 '101.batch|RUNNING\n'
+                                 '101.extern|RUNNING\n'
+                                 '102|COMPLETED\n'
+                                 '102.batch|COMPLETED\n'
+                                 '103|PENDING\n'
+                                 '104|CANCELLED by 123\n'
+                                 '105|FAILED\n'
+                                 '999|RUNNING\n')
+        self.assertEqual(
+            self.scheduler.check_status_many([101, 102, 103, 104, 105]),
+            {101: (0, 'Running'), 102: (0, 'Done'), 103: (0, 'Queued'),
+             104: (-2, 'Unexpected job state from scheduler'),
+             105: (-1, 'Job failed')})
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(self.calls[0][-1][len('--jobs='):].split(',')),
+                         ['101', '102', '103', '104', '105'])
+
+        # Jobs not yet in accounting are asked of slurmctld.
+        self.outputs['scontrol'] = 'JobId=106 JobState=PENDING Reason=None'
+        self.assertEqual(self.scheduler.check_status_many([101, 106]),
+                         {101: (0, 'Running'), 106: (0, 'Queued')})
+        self.assertEqual(self.calls[-1], ['scontrol', 'show', 'job', '106'])
+
+        self.assertEqual(self.scheduler.check_status_many([]), {})
+
+    def test_squeue_fallback(self):
+        for error in (CalledProcessError(1, 'sacct',
+                                         output='accounting disabled'),
+                      OSError(2, 'No such file or directory')):
+            self.calls = []
+            self.outputs['sacct'] = error
+            self.outputs['squeue'] = '101|RUNNING\n102|COMPLETED\n'
+            self.assertEqual(self.scheduler.check_status_many([101, 102, 103]),
+                             {101: (0, 'Running'), 102: (0, 'Done'),
+                              103: (0, 'No info')})
+            self.assertEqual([args[0] for args in self.calls],
+                             ['sacct', 'squeue'])
+            self.assertIn('--states=all', self.calls[1])
+
+    def test_squeue_invalid_job_id(self):
+        self.outputs['sacct'] = OSError(2, 'No such file or directory')
+        self.outputs['squeue'] = CalledProcessError(
+            1, 'squeue', output='slurm_load_jobs error: Invalid job id '
+                                'specified\n')
+        self.assertEqual(self.scheduler.check_status_many([101, 102]),
+                         {101: (0, 'No info'), 102: (0, 'No info')})
+
+    def test_failure(self):
+        self.outputs['sacct'] = OSError(2, 'No such file or directory')
+        for error in (CalledProcessError(1, 'squeue',
+                                         output='Unable to contact slurm'),
+                      OSError(2, 'No such file or directory')):
+            self.outputs['squeue'] = error
+            self.assertEqual(self.scheduler.check_status_many([101, 102]),
+                             {101: (-1, 'Job info call failed'),
+                              102: (-1, 'Job info call failed')})
@@ -0,0 +1,180 @@
+"""Unit testing for PCE.tools.state_backends."""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+from PCE.tools import jobs
+from PCE.tools.state_backends import StateBackend, migrate_state
+
+class StateBackendsTest(unittest.TestCase):
+    def setUp(self):
+        self.state_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.state_root, 'jobs'))
+        os.mkdir(os.path.join(self.state_root, 'modules'))
+        # State locks are taken next to the state.
+        self.saved_lock_dir = jobs._job_state_dir
+        jobs._job_state_dir = os.path.join(self.state_root, 'jobs')
+        self.jobs = {
+            1: {'job_id': 1, 'state': 'Running', 'username': 'alice',
+                'mod_id': 3, 'scheduler_job_num': 101},
+            2: {'job_id': 2, 'state': 'Done', 'username': 'bob',
+                'mod_id': 3, 'scheduler_job_num': 102},
+            3: {'job_id': 3, 'state': 'Queued', 'username': 'alice',
+                'mod_id': 4, 'scheduler_job_num': 103}
+        }
+
+    def tearDown(self):
+        jobs._job_state_dir = self.saved_lock_dir
+        shutil.rmtree(self.state_root)
+
+    def check_backend(self, backend):
+        for id, data in self.jobs.items():
+            backend.save('jobs', id, data)
+
+        self.assertEqual(backend.list_ids('jobs'), ['1', '2', '3'])
+        self.assertEqual(backend.list_ids('jobs', username='alice'),
+                         ['1', '3'])
+        self.assertEqual(backend.list_ids('jobs', state=['Running', 'Queued'],
+                                          mod_id=3), ['1'])
+        self.assertEqual(backend.load('jobs', 2), self.jobs[2])
+        self.assertIsNone(backend.load('jobs', 4))
+
+        ids, version = backend.changed_since('jobs')
+        self.assertEqual(ids, ['1', '2', '3'])
+        self.assertEqual(backend.changed_since('jobs', version), ([], version))
+
+        signature = backend.signature('jobs', 1)
+        self.assertIsNotNone(signature)
+        backend.save('jobs', 1, dict(self.jobs[1], state='Done'))
+        self.assertNotEqual(backend.signature('jobs', 1), signature)
+        self.assertEqual(backend.list_ids('jobs', state='Done'), ['1', '2'])
+        self.assertEqual(backend.load('jobs', 1)['state'], 'Done')
+        self.assertEqual(backend.changed_since('jobs', version),
+                         (['1'], version + 1))
+        self.assertEqual(backend.changed_since('modules'), ([], 0))
+
+        backend.delete('jobs', 1)
+        self.assertIsNone(backend.load('jobs', 1))
+        self.assertIsNone(backend.signature('jobs', 1))
+        self.assertEqual(backend.list_ids('jobs'), ['2', '3'])
+        self.assertEqual(backend.changed_since('jobs', version)[0], [])
+
+        # Waiting ends at the timeout, or as soon as state is saved.
+        version = backend.version('jobs')
+        start = time.time()
+        self.assertEqual(backend.wait_for_change('jobs', version, 0.1, 0.02),
+                         version)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        timer = threading.Timer(0.1, backend.save, ('jobs', 2, self.jobs[2]))
+        timer.start()
+        start = time.time()
+        self.assertEqual(backend.wait_for_change('jobs', version, 10, 0.02),
+                         version + 1)
+        self.assertLess(time.time() - start, 5)
+        timer.join()
+
+    def test_file(self):
+        backend = StateBackend('file', self.state_root)
+        self.check_backend(backend)
+
+        # Each save bumps the version kept next to the state files.
+        version = backend.version('jobs')
+        backend.save('jobs', 3, self.jobs[3])
+        self.assertEqual(backend.version('jobs'), version + 1)
+        self.assertEqual(StateBackend('file', self.state_root).changed_since(
+            'jobs', version), (['3'], version + 1))
+
+        # Lock and .nfs files are not state.
+        open(os.path.join(self.state_root, 'jobs', '.2.lock'), 'w').close()
+        self.assertEqual(backend.list_ids('jobs'), ['2', '3'])
+
+    def test_file_state_writes(self):
+        from PCE.tools.jobs import JobState
+        state_file = os.path.join(self.state_root, 'jobs', '1')
+        backend = StateBackend('file', self.state_root)
+        with JobState(1, state_file) as job_state:
+            job_state.update(self.jobs[1])
+        signature = backend.signature('jobs', 1)
+        self.assertEqual(backend.list_ids('jobs'), ['1'])
+
+        # Unchanged and read-only state is not rewritten.
+        with JobState(1, state_file) as job_state:
+            job_state['state'] = 'Running'
+        with JobState(1, state_file, read_only=True) as job_state:
+            job_state['state'] = 'Done'
+        self.assertEqual(backend.signature('jobs', 1), signature)
+        self.assertEqual(backend.load('jobs', 1)['state'], 'Running')
+
+        with JobState(1, state_file) as job_state:
+            job_state['state'] = 'Done'
+        self.assertNotEqual(backend.signature('jobs', 1), signature)
+        self.assertEqual(backend.load('jobs', 1)['state'], 'Done')
+
+    def test_sqlite(self):
+        self.check_backend(StateBackend('sqlite', self.state_root))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis not installed')
+    def test_redis(self):
+        redis = fakeredis.FakeStrictRedis()
+        redis.flushall()
+        self.check_backend(StateBackend('redis', self.state_root,
+                                        client=redis))
+
+    @unittest.skipIf(fakeredis is None, 'fakeredis not installed')
+    def test_redis_updates(self):
+        from PCE.tools.new_jobs import JobHandler, JobState
+        redis = fakeredis.FakeStrictRedis()
+        redis.flushall()
+        handler = JobHandler(redis)
+        transitions = handler.subscribe()
+        handler.backend.save('jobs', 1, self.jobs[1])
+        handler.backend.save('jobs', 2, self.jobs[2])
+
+        # Writers only write the fields they change.
+        first = JobState(1, handler.backend).__enter__()
+        with JobState(1, handler.backend) as job_state:
+            job_state.error = 'Something went wrong'
+        first.set('Done')
+        first.__exit__(None, None, None)
+        self.assertEqual(handler.get_state(1)['error'], 'Something went wrong')
+        self.assertEqual(handler.get_state(1)['state'], 'Done')
+        self.assertRaises(ValueError, first.set, 'Not a state')
+
+        self.assertEqual([job['job_id'] for job in handler.get_states()],
+                         [1, 2])
+        self.assertEqual([job['job_id'] for job
+                          in handler.get_states([2, 3], state='Done')], [2])
+        self.assertEqual(handler.backend.list_ids('jobs', state='Running'), [])
+
+        messages = []
+        for i in range(5):
+            message = transitions.get_message()
+            if message is not None:
+                messages.append(json.loads(message['data']))
+        self.assertEqual(messages, [
+            {'id': '1', 'from': None, 'to': 'Running'},
+            {'id': '2', 'from': None, 'to': 'Done'},
+            {'id': '1', 'from': 'Running', 'to': 'Done'}
+        ])
+
+    def test_migrate(self):
+        source = StateBackend('file', self.state_root)
+        for id, data in self.jobs.items():
+            source.save('jobs', id, data)
+        source.save('modules', 3, {'mod_id': 3, 'state': 'Module ready',
+                                   'mod_name': 'AUC'})
+
+        dest = StateBackend('sqlite', self.state_root)
+        self.assertEqual(migrate_state(source, dest),
+                         {'jobs': 3, 'modules': 1})
+        self.assertEqual(dest.load('modules', 3)['mod_name'], 'AUC')
+        self.assertEqual(dest.list_ids('jobs', username='alice'), ['1', '3'])
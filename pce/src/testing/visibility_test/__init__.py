@@ -0,0 +1,63 @@
+"""Unit testing for PCE.tools.visibility."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from PCE.tools.visibility import clear_visibility_cache, get_visibility_index
+
+
+class VisibilityTest(unittest.TestCase):
+    def setUp(self):
+        clear_visibility_cache()
+        self.run_dir = tempfile.mkdtemp()
+        for path in ['config', 'bin', 'results']:
+            os.mkdir(os.path.join(self.run_dir, path))
+        for path in ['output.txt', '.hidden.txt', 'script.sh',
+                     'bin/onramp_status.py', 'results/a.dat']:
+            self.touch(path)
+        self.write_metadata('output.txt, *.txt, bin/onramp_status.py, '
+                            'results/*.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.run_dir)
+
+    def touch(self, path):
+        with open(os.path.join(self.run_dir, path), 'w') as f:
+            f.write(path)
+
+    def bump_mtime(self, path):
+        # Make changes visible on filesystems with coarse mtimes.
+        path = os.path.join(self.run_dir, path)
+        later = os.stat(path).st_mtime + 1
+        os.utime(path, (later, later))
+
+    def write_metadata(self, visible):
+        with open(os.path.join(self.run_dir, 'config/onramp_metadata.cfg'),
+                  'w') as f:
+            f.write('[onramp]\nvisible = %s\n' % visible)
+
+    def test_index(self):
+        index = get_visibility_index(self.run_dir)
+        self.assertEqual(index.files, set(['output.txt',
+                                           'bin/onramp_status.py',
+                                           'results/a.dat']))
+        self.assertTrue(index.is_visible('results/a.dat'))
+        self.assertTrue(index.is_visible('./output.txt'))
+        self.assertFalse(index.is_visible('script.sh'))
+        self.assertFalse(index.is_visible('.hidden.txt'))
+        self.assertIs(get_visibility_index(self.run_dir), index)
+
+        self.touch('results/b.dat')
+        self.bump_mtime('results')
+        index = get_visibility_index(self.run_dir)
+        self.assertTrue(index.is_visible('results/b.dat'))
+
+        self.write_metadata('*.sh')
+        self.bump_mtime('config/onramp_metadata.cfg')
+        index = get_visibility_index(self.run_dir)
+        self.assertEqual(index.files, set(['script.sh']))
+
+        os.remove(os.path.join(self.run_dir, 'config/onramp_metadata.cfg'))
+        self.assertIsNone(get_visibility_index(self.run_dir))
@@ -0,0 +1,60 @@
+"""Unit testing for PCE.tools.workers."""
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from PCE.tools.workers import OwnerQueueFull, QueueFull, TaskQueue, \
+                              WorkerPool, worker_task
+
+@worker_task('deploy')
+def append_to_file(filename):
+    with open(filename, 'a') as f:
+        f.write('x')
+
+
+class WorkersTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = TaskQueue(os.path.join(self.tmp_dir, 'tasks.db'))
+        self.out_file = os.path.join(self.tmp_dir, 'out')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_limits(self):
+        self.queue.put('deploy', 'append_to_file', [self.out_file])
+        self.assertRaises(QueueFull, self.queue.put, 'deploy',
+                          'append_to_file', [self.out_file], max_depth=1)
+        self.queue.put('deploy', 'append_to_file', [self.out_file],
+                       owner='alice', max_owner_depth=1)
+        self.assertRaises(OwnerQueueFull, self.queue.put, 'deploy',
+                          'append_to_file', [self.out_file], owner='alice',
+                          max_owner_depth=1)
+        self.queue.put('deploy', 'append_to_file', [self.out_file],
+                       owner='bob', max_owner_depth=1)
+        self.assertEqual(self.queue.depths()['deploy'],
+                         {'queued': 3, 'running': 0})
+
+    def test_pool(self):
+        for i in range(4):
+            self.queue.put('deploy', 'append_to_file', [self.out_file])
+
+        # Interrupted tasks are run again.
+        self.queue.claim('deploy')
+        self.assertEqual(self.queue.depths()['deploy'],
+                         {'queued': 3, 'running': 1})
+
+        pool = WorkerPool(self.queue, {'deploy': 2}, poll_interval=.05)
+        pool.start()
+        deadline = time.time() + 10
+        while (self.queue.depths()['deploy']['queued']
+               and time.time() < deadline):
+            time.sleep(.05)
+        pool.stop()
+
+        self.assertEqual(self.queue.depths()['deploy'],
+                         {'queued': 0, 'running': 0})
+        with open(self.out_file) as f:
+            self.assertEqual(f.read(), 'xxxx')
@@ -2,6 +2,7 @@ PCE_STATES = {
     0 : "Running",
     1 : "Establishing Connection",
     2 : "Down",
+    3 : "Degraded",
     -1 : "Error: Undefined",
 }
 
@@ -0,0 +1,117 @@
+""" Paginated job listings, shared by the job listing views
+
+Jobs are listed newest first, a page at a time. Each page carries a cursor
+for the next one (the job_id of its last job), so later pages cost the same
+as the first no matter how many jobs there are. The total number of matching
+jobs is counted once and cached for COUNT_CACHE_SECONDS.
+
+Before a page is read, the PCEs running active jobs in the listing are asked
+for the jobs changed since they were last asked, one request per PCE (see
+PCEAccess.refresh_jobs()).
+
+Request parameters (all optional):
+    page_size: Jobs per page (default DEFAULT_PAGE_SIZE, at most MAX_PAGE_SIZE).
+    cursor: next_cursor of the previous page.
+    fields: Comma separated JOB_FIELDS to return (default DEFAULT_FIELDS).
+        job_id is always returned.
+    state, pce_id, module_id: Only jobs with one of these comma separated
+        values.
+"""
+import hashlib
+
+from django.core.cache import cache
+
+from core.pce_connect import ACTIVE_JOB_STATES, refresh_jobs
+from ui.admin.models import job
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Seconds a count of matching jobs is reused
+COUNT_CACHE_SECONDS = 30
+
+JOB_FIELDS = ('job_id', 'user_id', 'workspace_id', 'pce_id', 'module_id',
+              'job_name', 'state', 'output_file')
+DEFAULT_FIELDS = ('job_id', 'user_id', 'workspace_id', 'pce_id', 'module_id',
+                  'job_name', 'state')
+
+# Request parameters jobs can be filtered by
+FILTERS = ('state', 'pce_id', 'module_id')
+
+
+def _int_param(params, name, default=None, minimum=0):
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError('Invalid {}: {}'.format(name, value))
+    if value < minimum:
+        raise ValueError('Invalid {}: {}'.format(name, value))
+    return value
+
+def _list_param(params, name):
+    try:
+        return [int(value) for value in params[name].split(',')]
+    except ValueError:
+        raise ValueError('Invalid {}: {}'.format(name, params[name]))
+
+def _count(filters):
+    """Return the number of jobs matching filters, cached."""
+    key = 'job_count:' + hashlib.md5(repr(sorted(filters.items()))).hexdigest()
+    total = cache.get(key)
+    if total is None:
+        total = job.objects.filter(**filters).count()
+        cache.set(key, total, COUNT_CACHE_SECONDS)
+    return total
+
+def request_params(request):
+    """ Return the GET and POST parameters of a request as one dict. """
+    params = request.GET.dict()
+    params.update(request.POST.dict())
+    return params
+
+def list_jobs(params, **scope):
+    """ Return one page of jobs.
+
+    :param params: Request parameters (see the module docstring).
+    :param scope: Filters set by the view, e.g. user_id=3.
+    :return: Dict with 'jobs' (list of dicts of the selected fields),
+        'next_cursor' (None on the last page) and 'total' (number of jobs
+        matching, on all pages).
+    :raises ValueError: A parameter is invalid.
+    """
+    page_size = min(_int_param(params, 'page_size', DEFAULT_PAGE_SIZE, 1),
+                    MAX_PAGE_SIZE)
+    cursor = _int_param(params, 'cursor')
+
+    fields = DEFAULT_FIELDS
+    if params.get('fields'):
+        fields = params['fields'].split(',')
+        for field in fields:
+            if field not in JOB_FIELDS:
+                raise ValueError('Invalid field: {}'.format(field))
+        if 'job_id' not in fields:
+            fields.insert(0, 'job_id')
+
+    filters = dict(scope)
+    for name in FILTERS:
+        if params.get(name):
+            filters[name + '__in'] = _list_param(params, name)
+
+    active = dict(filters)
+    active['state__in'] = ACTIVE_JOB_STATES
+    refresh_jobs(job.objects.filter(**active).values_list('pce_id', flat=True).distinct())
+
+    query = job.objects.filter(**filters).order_by('-job_id').values(*fields)
+    if cursor is not None:
+        query = query.filter(job_id__lt=cursor)
+    # One extra row tells us whether there is a next page
+    jobs = list(query[:page_size + 1])
+    next_cursor = None
+    if len(jobs) > page_size:
+        jobs = jobs[:page_size]
+        next_cursor = jobs[-1]['job_id']
+
+    return {'jobs': jobs, 'next_cursor': next_cursor, 'total': _count(filters)}
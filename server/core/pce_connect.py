@@ -1,13 +1,26 @@
 """ Module for making requests to a PCE
 
 """
+from django.core.cache import cache
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 from django.forms import model_to_dict
 from ui.admin.models import pce, module, module_to_pce, job
 from django.contrib.auth.models import User
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import errno
+import gzip
+import hashlib
 import logging
 import json
 import os
+import threading
+import time
+
+# Job outputs of at least this many bytes are stored gzip-compressed.
+COMPRESS_MIN_SIZE = 4096
 
 JOB_STATES = {
     0 : "Unknown job id",
@@ -25,6 +38,223 @@ JOB_STATES = {
     -99 : "Error: Undefined",
 }
 
+# Folders for local copies of PCE modules/job output (tmp) and for the log.
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TMP_DIR = os.path.join(SERVER_DIR, "tmp")
+LOG_FILE = os.path.join(SERVER_DIR, "log", "pce_connect.log")
+
+# Connections kept open to each PCE.
+POOL_SIZE = 10
+# Seconds to wait for a PCE to accept a connection, and to send a response.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+# Idempotent requests (GET, DELETE, ...) that fail to connect or get a 502 or
+# 504 are retried this many times, backing off exponentially from
+# RETRY_BACKOFF seconds.
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+# After CIRCUIT_THRESHOLD consecutive failed requests a PCE is marked degraded
+# and requests to it fail immediately. Every CIRCUIT_RESET seconds one request
+# is let through to test whether it has recovered.
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_RESET = 30
+PCE_STATE_DEGRADED = 3
+
+# Pooled sessions by PCE URL and circuit breakers by PCE id, shared by all
+# PCEAccess instances in the process.
+_sessions = {}
+_breakers = {}
+_pool_lock = threading.Lock()
+
+# Shared PCEAccess instances by PCE id. See get_pce_access().
+_registry = {}
+_registry_generation = 0
+_registry_lock = threading.Lock()
+_logging_configured = False
+
+
+class _CircuitBreaker(object):
+    """Track consecutive failed requests to one PCE."""
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request may be sent to the PCE."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= CIRCUIT_RESET:
+                # Let this request through to test the PCE. Others keep
+                # failing fast until it succeeds.
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record(self, ok):
+        """Record the outcome of a request.
+
+        Returns:
+            True if the breaker opened or closed as a result, else False.
+        """
+        with self._lock:
+            if ok:
+                changed = self.opened_at is not None
+                self.failures = 0
+                self.opened_at = None
+                return changed
+            self.failures += 1
+            if self.opened_at is None and self.failures >= CIRCUIT_THRESHOLD:
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+def _get_session(url):
+    """Return the pooled session for the PCE at url."""
+    with _pool_lock:
+        if url not in _sessions:
+            retry = Retry(total=RETRIES, read=0, backoff_factor=RETRY_BACKOFF,
+                          status_forcelist=[502, 504])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[url] = session
+        return _sessions[url]
+
+
+def _get_breaker(pce_id):
+    """Return the circuit breaker for the PCE with the given id."""
+    with _pool_lock:
+        if pce_id not in _breakers:
+            _breakers[pce_id] = _CircuitBreaker()
+        return _breakers[pce_id]
+
+
+def _get_logger(pce_id):
+    """Return the logger for the PCE with the given id. The log file is set
+    up on first use.
+    """
+    global _logging_configured
+    with _registry_lock:
+        if not _logging_configured:
+            FORMAT = '%(asctime)-15s %(levelname)-3s %(module)s: %(message)s'
+            logging.basicConfig(filename=LOG_FILE, level=logging.DEBUG,
+                                format=FORMAT)
+            _logging_configured = True
+    return logging.getLogger("[PCEAccess: {}]".format(pce_id))
+
+
+def _makedirs(path):
+    """Create path and any missing parents, unless path exists."""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def get_pce_access(pce_id):
+    """Return the shared PCEAccess for a PCE, creating it on first use.
+
+    Instances are shared by all threads of the process and live until
+    invalidate_pce_access() is called for the PCE.
+
+    Args:
+        pce_id (int): Id of the PCE.
+
+    Returns:
+        PCEAccess for the PCE.
+
+    Raises:
+        ValueError: No PCE with the given id exists.
+    """
+    pce_id = int(pce_id)
+    with _registry_lock:
+        access = _registry.get(pce_id)
+        generation = _registry_generation
+    if access is not None:
+        return access
+
+    # Built outside the lock, so a slow database doesn't hold up requests
+    # for other PCEs. Concurrent first requests may build more than one
+    # instance; all but one are discarded.
+    access = PCEAccess(pce_id)
+    with _registry_lock:
+        if generation != _registry_generation:
+            # Invalidated while building. The instance may be stale, so use
+            # it for this request only.
+            return access
+        return _registry.setdefault(pce_id, access)
+
+
+def refresh_jobs(pce_ids):
+    """Pull job states changed on each of the given PCEs into the DB, one
+    request per PCE. PCEs that can't be reached, or no longer exist, are
+    skipped; their jobs keep the states last pulled.
+
+    Each PCE is asked at most once every JOB_REFRESH_SECONDS by all server
+    processes sharing the cache. PCEs asked more recently are skipped.
+
+    Args:
+        pce_ids (iterable): Ids of the PCEs.
+    """
+    for pce_id in pce_ids:
+        # add() only stores the key if no refresh of the PCE started within
+        # JOB_REFRESH_SECONDS.
+        if not cache.add('job_refresh:%d' % int(pce_id), True,
+                         JOB_REFRESH_SECONDS):
+            continue
+        try:
+            access = get_pce_access(pce_id)
+        except ValueError:
+            continue
+        access.refresh_jobs()
+
+
+def invalidate_pce_access(pce_id=None):
+    """Discard the shared PCEAccess for a PCE, so the next get_pce_access()
+    rebuilds it from the pce table. Call after editing or deleting a PCE.
+
+    Args:
+        pce_id (int): Id of the PCE. 'None' to discard all instances.
+    """
+    global _registry_generation
+    with _registry_lock:
+        if pce_id is None:
+            _registry.clear()
+        else:
+            _registry.pop(int(pce_id), None)
+        _registry_generation += 1
+
+
+# PCE job state strings to state ids stored in the job table.
+_JOB_STATE_IDS = dict((name, state_id) for state_id, name in JOB_STATES.items()
+                      if state_id not in (0, -99))
+
+# State ids of jobs that may still change on the PCE.
+ACTIVE_JOB_STATES = [1, 2, 3, 4, 5, 6]
+
+# Least seconds between two refresh_jobs() requests to one PCE
+JOB_REFRESH_SECONDS = 10
+
+# PCE module state strings to state ids stored in the module_to_pce table.
+_MODULE_STATE_IDS = {
+    "Does not exist": 0,
+    "Available": 1,
+    "Checkout in progress": 2,
+    "Checkout failed": -2,
+    "Installed": 3,
+    "Deploy in progress": 4,
+    "Deploy failed": -4,
+    "Admin required": 5,
+    "Module ready": 6,
+}
+
 class PCEAccess(object):
     """Client-side interface to OnRamp PCE server.
 
@@ -37,6 +267,9 @@ class PCEAccess(object):
         deploy_module: Initiate module deployment actions.
         delete_module: Delete given module from PCE.
         get_jobs: Return the requested jobs.
+        update_jobs_in_db: Pull state of many jobs into the DB at once.
+        refresh_jobs: Pull state of jobs changed since the last refresh into
+            the DB.
         launch_job: Initiate job launch.
         delete_job: Delete given job from PCE.
         check_connection: Ping the server to see if it is still available.
@@ -46,21 +279,21 @@ class PCEAccess(object):
     def __init__(self, pce_id):
         """Initialize PCEAccess instance.
 
+        Views should use get_pce_access() rather than create instances.
+
         Args:
-            logger (logging.Logger): Logger for instance to use.
             pce_id (int): Id of PCE instance should provide interface to.
+
+        Raises:
+            ValueError: No PCE with the given id exists.
         """
         self._pce_id = pce_id
 
-        # Change working directory
-        os.chdir(os.path.dirname(os.path.realpath(__file__)))
-        self._cur_dir = os.getcwd()
-
         # Fails presumably to permission error
-        self._logger = self._get_logger(pce_id)
+        self._logger = _get_logger(pce_id)
 
         # Create paths for tmp, pce, module, and jobs directories
-        self._tmp_dir = "/".join(self._cur_dir.split("/")[:-1])+"/tmp"
+        self._tmp_dir = TMP_DIR
         self._pce_dir = os.path.join(self._tmp_dir, "pce", str(self._pce_id))
         self._pce_module_dir = os.path.join(self._pce_dir, "modules")
         self._pce_job_dir = os.path.join(self._pce_dir, "jobs")
@@ -68,21 +301,20 @@ class PCEAccess(object):
         # Create those directories if they do not already exist
 
         # Currently throws OSError(13, 'Permission Denied')
-        if not os.path.exists(self._pce_dir):
-            os.makedirs(self._pce_dir)
-        if not os.path.exists(self._pce_module_dir):
-            os.makedirs(self._pce_module_dir)
-        if not os.path.exists(self._pce_job_dir):
-            os.makedirs(self._pce_job_dir)
+        _makedirs(self._pce_module_dir)
+        _makedirs(self._pce_job_dir)
 
         pce_info = self._get_pce_info()
-        #if pce_info is None: 
-            #raise ValueError("PCE id: {} does not exist".format(self._pce_id))
-        #else:
+        if pce_info is None:
+            raise ValueError("PCE id: {} does not exist".format(self._pce_id))
         self._url = self._get_url(pce_info.ip_addr, pce_info.ip_port)
         self._port = pce_info.ip_port
         self._name = pce_info.pce_name
 
+        # PCE state version of the last refresh_jobs()
+        self._job_state_version = 0
+        self._refresh_lock = threading.Lock()
+
     def _get_url(self, host, port):
         if port:
             # if the port is not 0 we assume we need it to
@@ -93,12 +325,6 @@ class PCEAccess(object):
             return "http://{}".format(host)
 
 
-    def _get_logger(self, pce_id):
-        FORMAT = '%(asctime)-15s %(levelname)-3s %(module)s: %(message)s'
-        logfile = "/".join(self._cur_dir.split("/")[:-1])+"/log/pce_connect.log"
-        logging.basicConfig(filename=logfile, level=logging.DEBUG, format=FORMAT)
-        return logging.getLogger("[PCEAccess: {}]".format(pce_id))
-
     def _get_pce_info(self):
         """ Gets information from the Database about the PCE
 
@@ -266,7 +492,10 @@ class PCEAccess(object):
             HTTP response code from PCE ping request.
         """
         endpoint = "cluster/ping"
-        return self._pce_get(endpoint, raw=True).status_code
+        r = self._request("GET", endpoint)
+        if r is None:
+            return None
+        return r.status_code
 
     def check_connection(self):
         """Ping the server to see if it still available. Record status in given
@@ -277,7 +506,7 @@ class PCEAccess(object):
         """
         status_code = self.ping()
 
-        self._logger.debug("%scheck_connection() %d from %s"
+        self._logger.debug("%scheck_connection() %s from %s"
                            % (self._name, status_code, self._url))
 
         pce_row = pce.objects.get(pce_id=self._pce_id)
@@ -317,60 +546,152 @@ class PCEAccess(object):
         self._refresh_modules_in_db(prefix, module_id)
 
     def _refresh_modules_in_db(self, prefix, module_id=None, avail=False):
+        """Bring the module_to_pce rows of this PCE up to date with the
+        modules on the PCE.
+
+        Args:
+            prefix (str): Prefix for log messages.
+            module_id (int/None): If given, only refresh this module. Its
+                installed state is fetched from the PCE first, and only if it
+                is not installed is the list of available modules fetched.
+            avail (bool): When refreshing all modules, refresh the modules
+                available on the PCE instead of those installed.
+
+        Returns:
+            'True' on success, 'False' if the PCE could not be reached or the
+            module does not exist on it.
+        """
+        start = time.time()
         if module_id is None:
             if avail is True:
                 self._logger.debug("%s Get all available modules" % prefix)
-                avail_mods = self.get_modules_avail()
+                mods = self.get_modules_avail()
             else:
                 self._logger.debug("%s Get all modules" % prefix)
-                avail_mods = self.get_modules()
+                mods = self.get_modules()
         else:
-            self._logger.debug("%s Get module info for %s" % (prefix, str(module_id)))
-            # JJH the below does not work as expected, so intead grab the whole
-            #     list and extract just the one we care about
-            #avail_mods = self.get_modules( int(module_id) )
             module_id = int(module_id)
-            all_mods = self.get_modules()
-            avail_mods = None
-            for m in all_mods:
-                m_id = module.objects.get(module_name=m['mod_name']).module_id
-                if m_id == module_id:
-                    avail_mods = m
-                    #self._logger.debug("%s TESTING (1): %s" % (prefix, str(avail_mods)))
-                    # JJH confirm this is the proper behavior
-                    avail_mods = self.get_modules( int(module_id) )
-                    #self._logger.debug("%s TESTING (2): %s" % (prefix, str(avail_mods)))
-                    self._logger.debug("%s Get module info for %s: Found (I)" % (prefix, str(module_id)))
-                    break
-
-            if avail_mods is None:
-                self._logger.debug("%s Get module info for %s: Searching Available" % (prefix, str(module_id)))
-                all_mods = self.get_modules_avail()
-                avail_mods = None
-                for m in all_mods:
-                    m_id = module.objects.get(module_name=m['mod_name']).module_id
-                    if m_id == module_id:
-                        avail_mods = m
-                        self._logger.debug("%s Get module info for %s: Found (A)" % (prefix, str(module_id)))
-                        break
-
+            mods = self._fetch_module(prefix, module_id)
+            if mods is not None:
+                if mods['state'] == "Does not exist":
+                    self._logger.error("%s Module %d does not exist on the PCE"
+                                       % (prefix, module_id))
+                    module_to_pce.objects.filter(
+                        pce_id=self._pce_id, module_id=module_id).update(state=0)
+                    return False
+                mods = [mods]
+        fetched = time.time()
 
-        if avail_mods is None:
+        if mods is None:
             pce_row = pce.objects.get(pce_id=self._pce_id)
             pce_row.state = 2
             pce_row.save()
             return False
 
+        self._sync_modules(prefix, mods, start, fetched)
+        return True
 
-        if module_id is None:
-            for mod in avail_mods:
-                rtn = self._update_module_in_db(prefix, mod)
-                if rtn is False:
-                    return False
-        else:
-            return self._update_module_in_db(prefix, avail_mods)
+    def _fetch_module(self, prefix, module_id):
+        """Return the PCE's module data for a server module.
 
-        return True
+        Installed modules are stored on the PCE under the server's module id,
+        so that is tried first. Otherwise the module is looked up by name in
+        the installed, then available, module lists.
+
+        Returns:
+            JSON-formatted module object, one in state "Does not exist" if
+            the PCE does not have the module, or 'None' on error.
+        """
+        names = list(module.objects.filter(module_id=module_id)
+                     .values_list('module_name', flat=True)[:1])
+        name = names[0] if names else None
+
+        mod = self.get_modules(module_id)
+        if mod is None:
+            return None
+        if mod['state'] != "Does not exist" and mod['mod_name'] == name:
+            self._logger.debug("%s Get module info for %d: Found (I)"
+                               % (prefix, module_id))
+            return mod
+
+        self._logger.debug("%s Get module info for %d: Searching by name"
+                           % (prefix, module_id))
+        for mods in (self.get_modules(), self.get_modules_avail()):
+            if mods is None:
+                return None
+            for m in mods:
+                if m['mod_name'] == name:
+                    return m
+        return {'mod_id': module_id, 'mod_name': name,
+                'state': "Does not exist"}
+
+    def _sync_modules(self, prefix, mods, start, fetched):
+        """Write the given PCE modules to the module and module_to_pce tables.
+
+        Module names are resolved to ids, and missing module and
+        module_to_pce rows are created, with one query each. Changed states
+        are written with one UPDATE per distinct state, all in one
+        transaction.
+
+        Args:
+            prefix (str): Prefix for log messages.
+            mods (list): JSON-formatted module objects from the PCE.
+            start (float): Time the refresh started, for logging.
+            fetched (float): Time the modules were fetched, for logging.
+        """
+        mods = [m for m in mods if m['state'] != "Does not exist"]
+        names = set(m['mod_name'] for m in mods)
+
+        with transaction.atomic():
+            ids = dict(module.objects.filter(module_name__in=names)
+                       .values_list('module_name', 'module_id'))
+            missing = names - set(ids.keys())
+            if missing:
+                module.objects.bulk_create(
+                    [module(module_name=name) for name in missing])
+                # bulk_create doesn't set primary keys on all databases.
+                ids.update(module.objects.filter(module_name__in=missing)
+                           .values_list('module_name', 'module_id'))
+            resolved = time.time()
+
+            pairs = dict(module_to_pce.objects
+                         .filter(pce_id=self._pce_id,
+                                 module_id__in=ids.values())
+                         .values_list('module_id', 'state'))
+            new_pairs = []
+            by_state = {}
+            for m in mods:
+                module_id = ids[m['mod_name']]
+                state = _MODULE_STATE_IDS.get(m['state'], -99)
+                if module_id not in pairs:
+                    location = m.get('source_location') or {}
+                    new_pairs.append(module_to_pce(
+                        pce_id=self._pce_id, module_id=module_id, state=state,
+                        src_location_type=location.get('type', 'local'),
+                        src_location_path=location.get('path', '')))
+                    pairs[module_id] = state
+                elif pairs[module_id] != state:
+                    by_state.setdefault(state, []).append(module_id)
+
+            module_to_pce.objects.bulk_create(new_pairs)
+            for state, module_ids in by_state.items():
+                module_to_pce.objects.filter(
+                    pce_id=self._pce_id,
+                    module_id__in=module_ids).update(state=state)
+        written = time.time()
+
+        for m in mods:
+            if m.get('uioptions') is not None:
+                self._save_uioptions(ids[m['mod_name']], m['uioptions'])
+            if m.get('metadata') is not None:
+                self._save_metadata(ids[m['mod_name']], m['metadata'])
+
+        self._logger.debug(
+            "%s Synced %d modules (%d new modules, %d new pairs, %d updated): "
+            "fetch %.3fs, resolve %.3fs, write %.3fs, files %.3fs"
+            % (prefix, len(mods), len(missing), len(new_pairs),
+               sum(len(v) for v in by_state.values()), fetched - start,
+               resolved - fetched, written - resolved, time.time() - written))
 
     def _save_job_output(self, job_id, output):
         prefix = ("%ssave_job_output(%s)" % (self._name, str(job_id)))
@@ -382,13 +703,118 @@ class PCEAccess(object):
 
         job_dir = os.path.join(self._pce_job_dir, str(job_id))
 
-        if not os.path.exists(job_dir):
-            os.makedirs(job_dir)
+        _makedirs(job_dir)
 
         # Write it out
-        output_file = os.path.join(job_dir, "output.txt")
-        with open(output_file, 'w') as f:
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        output_file = self._job_output_file(job_id, len(output))
+        tmp_file = self._part_file(output_file)
+        with self._open_job_output(tmp_file, output_file) as f:
             f.write(output)
+        self._replace_job_output(tmp_file, output_file)
+
+        return True
+
+    def _job_output_file(self, job_id, size):
+        """Return the path to store job output of the given size at. Outputs
+        of at least COMPRESS_MIN_SIZE bytes are stored gzip-compressed.
+        """
+        name = "output.txt.gz" if size >= COMPRESS_MIN_SIZE else "output.txt"
+        return os.path.join(self._pce_job_dir, str(job_id), name)
+
+    def _part_file(self, output_file):
+        """Return a path to write output destined for output_file to. Paths
+        differ per thread, as instances are shared by threads.
+        """
+        return "%s.%d.%d.part" % (output_file, os.getpid(),
+                                  threading.current_thread().ident)
+
+    def _open_job_output(self, tmp_file, output_file):
+        """Open tmp_file for writing output destined for output_file."""
+        if output_file.endswith(".gz"):
+            return gzip.open(tmp_file, 'wb')
+        return open(tmp_file, 'wb')
+
+    def _replace_job_output(self, tmp_file, output_file):
+        """Move written output into place and remove any copy stored with the
+        other encoding.
+        """
+        os.rename(tmp_file, output_file)
+        if output_file.endswith(".gz"):
+            other_file = output_file[:-len(".gz")]
+        else:
+            other_file = output_file + ".gz"
+        if os.path.exists(other_file):
+            os.remove(other_file)
+
+    def _fetch_job_output(self, job_id, digest):
+        """Fetch the output of a finished job from the PCE into the local job
+        folder, unless the local copy already has the given digest. The
+        digest is stored in output.sha256 only if the fetched output has it.
+
+        Output is read from the PCE's jobs/JOB_ID/output endpoint in chunks.
+
+        Args:
+            job_id (int): Id of the job.
+            digest (str): SHA-256 hex digest of the job output reported by the
+                PCE. 'None' if the job has no output yet.
+
+        Returns:
+            'True' if the local copy is current, 'False' on error.
+        """
+        prefix = ("%sfetch_job_output(%s)" % (self._name, str(job_id)))
+
+        if digest is None:
+            return True
+
+        job_dir = os.path.join(self._pce_job_dir, str(job_id))
+        digest_file = os.path.join(job_dir, "output.sha256")
+
+        if os.path.exists(digest_file):
+            with open(digest_file, 'r') as f:
+                if f.read() == digest:
+                    return True
+
+        _makedirs(job_dir)
+
+        self._logger.debug("%s Fetching Job output..." % prefix)
+        response = self._pce_get("jobs/%d/output" % job_id)
+        if not response or response.get('status_code') != 0:
+            self._logger.error("%s Failed to fetch output" % prefix)
+            return False
+
+        output_file = self._job_output_file(job_id, response['size'])
+        tmp_file = self._part_file(output_file)
+        offset = 0
+        # Digest of the bytes written, to check against the PCE's digest
+        sha256 = hashlib.sha256()
+        with self._open_job_output(tmp_file, output_file) as f:
+            while True:
+                data = response['output'].encode('utf-8')
+                sha256.update(data)
+                f.write(data)
+                next_offset = response['next_offset']
+                if next_offset == offset or next_offset >= response['size']:
+                    break
+                offset = next_offset
+                response = self._pce_get("jobs/%d/output" % job_id,
+                                         offset=offset)
+                if not response or response.get('status_code') != 0:
+                    self._logger.error("%s Failed to fetch output at offset %d"
+                                       % (prefix, offset))
+                    return False
+
+        self._replace_job_output(tmp_file, output_file)
+        if sha256.hexdigest() != digest:
+            # Without output.sha256 the output is fetched again next time.
+            self._logger.error("%s Output digest %s doesn't match the PCE's %s"
+                               % (prefix, sha256.hexdigest(), digest))
+            if os.path.exists(digest_file):
+                os.remove(digest_file)
+            return False
+        with open(digest_file, 'w') as f:
+            f.write(digest)
 
         return True
 
@@ -402,6 +828,8 @@ class PCEAccess(object):
             return None
 
         abs_output_file = os.path.join(job_dir, "output.txt")
+        if os.path.exists(abs_output_file + ".gz"):
+            abs_output_file += ".gz"
 
         return abs_output_file
 
@@ -414,6 +842,9 @@ class PCEAccess(object):
         output = self.get_job_output(job_id)
         if not output:
             return ""
+        if output.endswith(".gz"):
+            with gzip.open(output, 'rb') as f:
+                return f.read()
         with open(output, 'r') as f:
             return f.read()
 
@@ -424,8 +855,7 @@ class PCEAccess(object):
 
         module_dir = os.path.join(self._pce_module_dir, str(module_id))
 
-        if not os.path.exists(module_dir):
-            os.makedirs(module_dir)
+        _makedirs(module_dir)
 
         # Write it out to a file
         uioptions_file = os.path.join(module_dir, "uioptions.json")
@@ -440,8 +870,7 @@ class PCEAccess(object):
 
         module_dir = os.path.join(self._pce_module_dir, str(module_id))
 
-        if not os.path.exists(module_dir):
-            os.makedirs(module_dir)
+        _makedirs(module_dir)
 
         # Write it out to a file
         metadata_file = os.path.join(module_dir, "metadata.json")
@@ -513,102 +942,43 @@ class PCEAccess(object):
 
         return module_metadata
 
-    def _update_module_in_db(self, prefix, module_data):
-        if module_data['state'] == "Does not exist":
-            self._logger.error("%s Asking to update a module that does not exist. %s" % (prefix, str(module_data)))
-            try:
-                pm_pair = module_to_pce.objects.filter(module_id=module_data['mod_id'], pce_id=self._pce_id)
-                pm_pair.state = 0
-                pm_pair.save()
-            except Exception:
-                # This means the pair does not exist
-                pass
-            return False
-
-        self._logger.debug("%s Add Module: %s" % (prefix, module_data['mod_name']))
-
-        mod_info, created = module.objects.get_or_create(
-                                module_name=module_data['mod_name'])
-        module_id = int(mod_info.module_id)
-
-        # Add it to the PCE/Module pair table (if not already there)
-        self._logger.debug("---------------------------------------------------")
-        self._logger.debug("%s Add Module to PCE: %d module %d"
-                           % (prefix, self._pce_id, module_id))
-
-        if 'uioptions' in module_data and module_data["uioptions"] is not None:
-            self._save_uioptions(module_id, module_data["uioptions"])
-
-        if 'metadata' in module_data and module_data["metadata"] is not None:
-            self._save_metadata(module_id, module_data["metadata"])
-
-        pm_row, created = module_to_pce.objects.get_or_create(
-            pce_id=self._pce_id, module_id=module_id,
-            defaults={
-                "src_location_type": module_data['source_location']['type'],
-                "src_location_path": module_data['source_location']['path']
-            })
-
-        self._logger.debug("%s Add Module to PCE: %d module %d : State = %s"
-                           % (prefix, self._pce_id, module_id, str(module_data['state'])))
-        state = -99
-        if module_data['state'] == "Does not exist":
-            state = 0
-        elif module_data['state'] == "Available":
-            state = 1
-        elif module_data['state'] == "Checkout in progress":
-            state = 2
-        elif module_data['state'] == "Checkout failed":
-            state = -2
-        elif module_data['state'] == "Installed":
-            state = 3
-        elif module_data['state'] == "Deploy in progress":
-            state = 4
-        elif module_data['state'] == "Deploy failed":
-            state = -4
-        elif module_data['state'] == "Admin required":
-            state = 5
-        elif module_data['state'] == "Module ready":
-            state = 6
-        pm_row.state = state
-        pm_row.save()
-
     def install_and_deploy_module(self, module_id):
         prefix = ("%sinstall_deploy()" % self._name)
 
         #
         # Make sure this ID is available on the PCE
         #
-        if self._refresh_modules_in_db(prefix) is False:
+        if self._refresh_modules_in_db(prefix, module_id) is False:
             return {'error_msg': "Module with id %d does not exist on the PCE" % (module_id)}
 
         # Get module info from db
-        module_info = module_to_pce.objects.get(pce_id=self._pce_id, module_id=module_id)
-        self._logger.debug("%s Module state %d (%s)" % (prefix, module_info["state"], module_info["state_str"]))
+        module_info = module_to_pce.objects.select_related('module').get(
+            pce_id=self._pce_id, module_id=module_id)
+        self._logger.debug("%s Module state %d" % (prefix, module_info.state))
 
         #
         # Install the module (if it is not already installed)
         #
-        if module_info["state"] <= 1:
-            rtn = self.add_module(module_info["module_id"], module_info["module_name"],
-                                  module_info["src_location_type"], module_info["src_location_path"])
+        if module_info.state <= 1:
+            rtn = self.add_module(module_info.module_id, module_info.module.module_name,
+                                  module_info.src_location_type, module_info.src_location_path)
             if rtn is False:
                 return {'error_msg': "Failed to install the module"}
             self._logger.debug("%s Module %d installed" % (prefix, module_id))
         else:
-            self._logger.debug("%s Module %d already installed (state=%d)" % (prefix, module_id, module_info["state"]))
+            self._logger.debug("%s Module %d already installed (state=%d)" % (prefix, module_id, module_info.state))
 
         #
         # Deploy the module (if it is not already deployed successfully)
         #
-        if module_info["state"] not in [4, 5, 6]:
+        if module_info.state not in [4, 5, 6]:
             rtn = self.deploy_module(int(module_id))
             if rtn is False:
                 return {'error_msg': "Failed to deploy the module"}
             self._logger.debug("%s Module %d deployed" % (prefix, module_id))
         else:
             self._logger.debug(
-                "%s Module %d already deploy(ing) (state=%d)" % (prefix, module_id, module_info["state"]))
+                "%s Module %d already deploy(ing) (state=%d)" % (prefix, module_id, module_info.state))
 
         #
         # Update the DB
@@ -631,40 +1001,21 @@ class PCEAccess(object):
         # This is a temp fix (though after analysis may prove to be THE fix). #
         if 'job_id' not in job_info:
             job_info['job_id'] = job_id
-        if 'output' not in job_info:
-            job_info['output'] = None
         if 'state' not in job_info:
             job_info['state'] = 'Setting up launch'
         #######################################################################
 
         self._logger.debug("%s job RAW %s" % (prefix, str(job)))
-        self._save_job_output(job_info["job_id"], job_info["output"])
+        if 'output' in job_info:
+            # PCEs without the jobs/ID/output endpoint return output inline.
+            self._save_job_output(job_info["job_id"], job_info["output"])
+        else:
+            self._fetch_job_output(job_info["job_id"],
+                                   job_info.get("output_digest"))
 
         self._logger.debug("%s Response: ID = %d/%d, State = %s"
                            % (prefix, job_info["job_id"], job_id, job_info["state"]))
-        state = -99
-        if job_info['state'] == "Setting up launch":
-            state = 1
-        elif job_info['state'] == "Launch failed":
-            state = -1
-        elif job_info['state'] == "Preprocessing":
-            state = 2
-        elif job_info['state'] == "Preprocess failed":
-            state = -2
-        elif job_info['state'] == "Scheduled":
-            state = 3
-        elif job_info['state'] == "Schedule failed":
-            state = -3
-        elif job_info['state'] == "Queued":
-            state = 4
-        elif job_info['state'] == "Running":
-            state = 5
-        elif job_info['state'] == "Run failed":
-            state = -5
-        elif job_info['state'] == "Postprocessing":
-            state = 6
-        elif job_info['state'] == "Done":
-            state = 7
+        state = _JOB_STATE_IDS.get(job_info['state'], -99)
         # Update the database
         job_row = job.objects.get(job_id=job_id)
         job_row.state = state
@@ -672,6 +1023,83 @@ class PCEAccess(object):
 
         return state
 
+    def update_jobs_in_db(self, job_ids=None, since=None, wait=None):
+        """Pull the state of many jobs from the PCE into the DB.
+
+        All jobs are fetched in one request to the PCE, and the job table is
+        updated in one transaction.
+
+        Args:
+            job_ids (list/None): Ids of the jobs to update. None for all jobs
+                on the PCE.
+            since (int/None): If given, only update jobs whose state changed
+                on the PCE after this PCE state version.
+            wait (int/None): With since, seconds the PCE may wait for a job
+                to change before responding, so that callers can wait for
+                changes instead of polling.
+
+        Returns:
+            Tuple (dict mapping job id to new state id, PCE state version) on
+            success, 'None' on error. The state version is only returned
+            when since is given; pass it as since of the next call to get
+            only jobs changed in between.
+        """
+        prefix = ("%supdate_jobs_in_db()" % self._name)
+
+        params = {}
+        if job_ids is not None:
+            if not job_ids:
+                return ({}, None)
+            params['ids'] = ','.join(str(int(job_id)) for job_id in job_ids)
+        if since is not None:
+            params['since'] = int(since)
+            if wait:
+                params['wait'] = int(wait)
+        response = self._pce_get("jobs", **params)
+        if not response or "jobs" not in response.keys():
+            self._logger.error("%s Failed to get jobs" % prefix)
+            return None
+
+        states = {}
+        for job_info in response["jobs"]:
+            job_id = int(job_info["job_id"])
+            if 'output' in job_info:
+                self._save_job_output(job_id, job_info["output"])
+            else:
+                self._fetch_job_output(job_id, job_info.get("output_digest"))
+            states[job_id] = _JOB_STATE_IDS.get(job_info.get('state'), -99)
+
+        # One UPDATE per distinct state rather than one per job.
+        by_state = {}
+        for job_id, state in states.items():
+            by_state.setdefault(state, []).append(job_id)
+        with transaction.atomic():
+            for state, ids in by_state.items():
+                job.objects.filter(pce=self._pce_id,
+                                   job_id__in=ids).update(state=state)
+
+        self._logger.debug("%s Updated %d jobs" % (prefix, len(states)))
+        return (states, response.get("state_version"))
+
+    def refresh_jobs(self):
+        """Pull the state of jobs changed on the PCE since the last refresh
+        into the DB, in one request.
+
+        Refreshes are serialized, so concurrent callers don't fetch the same
+        changes twice.
+
+        Returns:
+            Dict mapping job id to new state id on success, 'None' on error.
+        """
+        with self._refresh_lock:
+            result = self.update_jobs_in_db(since=self._job_state_version)
+            if result is None:
+                return None
+            states, version = result
+            # PCEs without state versions return every job each time.
+            self._job_state_version = version or 0
+            return states
+
     def check_on_job(self, job_id):
         job_id = int(job_id)
         prefix = ("%scheck_on_job()" % self._name)
@@ -753,6 +1181,52 @@ class PCEAccess(object):
         return {'exists': exists, 'job_id': job_id, 'state': state_id,
                 'state_str': JOB_STATES.get(state_id)}
 
+    def _request(self, method, endpoint, **kwargs):
+        """Send a request to the PCE over its pooled session.
+
+        Requests time out after CONNECT_TIMEOUT/READ_TIMEOUT seconds unless
+        kwargs give a timeout. Failures count toward the PCE's circuit
+        breaker, and while it is open requests fail without being sent.
+
+        Args:
+            method (str): HTTP method.
+            endpoint (str): API URL endpoint for request. Must not have leading
+                or trailing slashes.
+
+        Kwargs:
+            Passed to requests.Session.request().
+
+        Returns:
+            requests.Response, or 'None' if no response was received.
+        """
+        url = "%s/%s/" % (self._url, endpoint)
+        breaker = _get_breaker(self._pce_id)
+        if not breaker.allow():
+            self._logger.error('%s PCE degraded. Not sending %s %s'
+                               % (self._name, method, url))
+            return None
+
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        try:
+            r = _get_session(self._url).request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self._logger.error('%s Error: %s from %s %s'
+                               % (self._name, e, method, url))
+            r = None
+
+        ok = r is not None and r.status_code not in (502, 504)
+        if breaker.record(ok):
+            if ok:
+                self._logger.info('%s PCE recovered' % self._name)
+                pce.objects.filter(pce_id=self._pce_id,
+                                   state=PCE_STATE_DEGRADED).update(state=0)
+            else:
+                self._logger.error('%s PCE degraded after %d failed requests'
+                                   % (self._name, breaker.failures))
+                pce.objects.filter(pce_id=self._pce_id).update(
+                    state=PCE_STATE_DEGRADED)
+        return r
+
     def _pce_get(self, endpoint, raw=False, **kwargs):
         """Execute GET request to PCE endpoint.
 
@@ -769,13 +1243,17 @@ class PCEAccess(object):
         Returns:
             JSON response object on success, 'None' on error.
         """
-        s = requests.Session()
-        url = "%s/%s/" % (self._url, endpoint)
-        r = s.get(url, params=kwargs)
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        if 'wait' in kwargs:
+            # Long-poll: the PCE holds the response for up to wait seconds.
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT + int(kwargs['wait']))
+        r = self._request("GET", endpoint, params=kwargs, timeout=timeout)
 
+        if r is None:
+            return None
         if r.status_code != 200:
             self._logger.error('%s Error: %d from GET %s: %s'
-                               % (self._name, r.status_code, url, r.text))
+                               % (self._name, r.status_code, r.url, r.text))
             return None
         else:
             if raw:
@@ -799,15 +1277,15 @@ class PCEAccess(object):
             'True' if request was successfully processed by RXing PCE, 'False'
             if not.
         """
-        s = requests.Session()
-        url = "%s/%s/" % (self._url, endpoint)
         data = json.dumps(kwargs)
         headers = {"content-type": "application/json"}
-        r = s.post(url, data=data, headers=headers)
+        r = self._request("POST", endpoint, data=data, headers=headers)
 
+        if r is None:
+            return False
         if r.status_code != 200:
             self._logger.error('%s Error: %d from POST %s: %s'
-                               % (self._name, r.status_code, url, r.text))
+                               % (self._name, r.status_code, r.url, r.text))
             return False
 
         response = r.json()
@@ -828,13 +1306,13 @@ class PCEAccess(object):
             'True' if request was successfully processed by RXing PCE, 'False'
             if not.
         """
-        s = requests.Session()
-        url = "%s/%s/" % (self._url, endpoint)
-        r = s.delete(url)
+        r = self._request("DELETE", endpoint)
 
+        if r is None:
+            return False
         if r.status_code != 200:
             self._logger.error('%s Error: %d from DELETE %s: %s'
-                               % (self._name, r.status_code, url, r.text))
+                               % (self._name, r.status_code, r.url, r.text))
             return False
         else:
             response = r.json()
@@ -0,0 +1,505 @@
+import BaseHTTPServer
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+import requests
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
+
+from core import job_listing, pce_connect
+from core.job_listing import list_jobs
+from ui.admin.models import workspace, pce, module, module_to_pce, job
+from ui.admin.pces import views as pce_views
+
+
+class JobListingTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create(username='user')
+        self.other = User.objects.create(username='other')
+        self.workspace = workspace.objects.create(workspace_name='ws', description='')
+        self.pces = [pce.objects.create(pce_name='pce{}'.format(i)) for i in range(2)]
+        self.modules = [module.objects.create(module_name='mod{}'.format(i)) for i in range(2)]
+        # Finished states only, so listing doesn't ask any PCE for changes
+        self.states = [7, -5, -1]
+        self.add_jobs(25)
+
+    def add_jobs(self, count, user=None):
+        job.objects.bulk_create([
+            job(user=user or self.user, workspace=self.workspace,
+                pce=self.pces[i % 2], module=self.modules[i % 2],
+                job_name='job{}'.format(i), state=self.states[i % 3])
+            for i in range(count)])
+
+    def job_ids(self, **filters):
+        return list(job.objects.filter(user=self.user, **filters)
+                    .order_by('-job_id').values_list('job_id', flat=True))
+
+    def test_default_page_size(self):
+        self.add_jobs(3, self.other)
+        result = list_jobs({}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']], self.job_ids())
+        self.assertIsNone(result['next_cursor'])
+        self.assertEqual(result['total'], 25)
+
+        self.add_jobs(job_listing.DEFAULT_PAGE_SIZE)
+        result = list_jobs({}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']],
+                         self.job_ids()[:job_listing.DEFAULT_PAGE_SIZE])
+        self.assertEqual(result['next_cursor'], result['jobs'][-1]['job_id'])
+
+    def test_cursor_paging(self):
+        pages = []
+        params = {'page_size': '10'}
+        while True:
+            result = list_jobs(params, user_id=self.user.id)
+            pages.append([row['job_id'] for row in result['jobs']])
+            self.assertEqual(result['total'], 25)
+            if result['next_cursor'] is None:
+                break
+            params['cursor'] = str(result['next_cursor'])
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(sum(pages, []), self.job_ids())
+
+        # Without page_size, pages have the default size
+        result = list_jobs({'cursor': str(pages[0][-1])}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']], pages[1] + pages[2])
+        self.assertIsNone(result['next_cursor'])
+
+    def test_page_size_bounds(self):
+        for page_size in ('0', '-1', 'ten'):
+            self.assertRaises(ValueError, list_jobs, {'page_size': page_size})
+        self.assertRaises(ValueError, list_jobs, {'cursor': '-1'})
+
+        self.add_jobs(job_listing.MAX_PAGE_SIZE)
+        result = list_jobs({'page_size': str(job_listing.MAX_PAGE_SIZE + 1)})
+        self.assertEqual(len(result['jobs']), job_listing.MAX_PAGE_SIZE)
+        self.assertIsNotNone(result['next_cursor'])
+        result = list_jobs({'page_size': '1'})
+        self.assertEqual(len(result['jobs']), 1)
+
+    def test_fields(self):
+        result = list_jobs({'page_size': '1'}, user_id=self.user.id)
+        self.assertEqual(set(result['jobs'][0]), set(job_listing.DEFAULT_FIELDS))
+
+        # job_id is always returned
+        result = list_jobs({'page_size': '1', 'fields': 'job_name,output_file'},
+                           user_id=self.user.id)
+        self.assertEqual(set(result['jobs'][0]), set(['job_id', 'job_name', 'output_file']))
+
+        for fields in ('job_name,bogus', 'user__password'):
+            self.assertRaises(ValueError, list_jobs, {'fields': fields})
+
+    def test_filters(self):
+        self.add_jobs(3, self.other)
+        result = list_jobs({'state': '7'}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']], self.job_ids(state=7))
+
+        result = list_jobs({'state': '7,-5'}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']],
+                         self.job_ids(state__in=[7, -5]))
+
+        pce_id = self.pces[1].pce_id
+        result = list_jobs({'pce_id': str(pce_id), 'page_size': '100'}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']], self.job_ids(pce_id=pce_id))
+        self.assertEqual(result['total'], 12)
+
+        module_id = self.modules[0].module_id
+        result = list_jobs({'module_id': str(module_id), 'state': '-1'}, user_id=self.user.id)
+        self.assertEqual([row['job_id'] for row in result['jobs']],
+                         self.job_ids(module_id=module_id, state=-1))
+
+        # Filters narrow the scope, they don't widen it
+        result = list_jobs({'pce_id': str(pce_id)}, user_id=self.other.id)
+        self.assertEqual(len(result['jobs']), 1)
+
+        self.assertRaises(ValueError, list_jobs, {'state': 'Done'})
+        self.assertRaises(ValueError, list_jobs, {'pce_id': '1,x'})
+
+    def test_cached_total(self):
+        params = {'page_size': '5', 'state': '7'}
+        self.assertEqual(list_jobs(params, user_id=self.user.id)['total'], 9)
+        self.add_jobs(3)
+
+        # Refresh check and the page; the count is reused
+        with self.assertNumQueries(2):
+            result = list_jobs(params, user_id=self.user.id)
+        self.assertEqual(result['total'], 9)
+        # Other filters are counted separately
+        self.assertEqual(list_jobs(dict(params, state='-5'), user_id=self.user.id)['total'], 9)
+
+        cache.clear()
+        self.assertEqual(list_jobs(params, user_id=self.user.id)['total'], 10)
+
+
+class FakePCEAccess(object):
+
+    def __init__(self, pce_id, refreshed):
+        self.pce_id = pce_id
+        self.refreshed = refreshed
+
+    def refresh_jobs(self):
+        self.refreshed.append(self.pce_id)
+        return {}
+
+
+class JobRefreshTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.refreshed = []
+        self.get_pce_access = pce_connect.get_pce_access
+        pce_connect.get_pce_access = lambda pce_id: FakePCEAccess(pce_id, self.refreshed)
+        user = User.objects.create(username='user')
+        ws = workspace.objects.create(workspace_name='ws', description='')
+        mod = module.objects.create(module_name='mod')
+        self.pces = [pce.objects.create(pce_name='pce{}'.format(i)) for i in range(3)]
+        # Active jobs on the first two PCEs, a finished job on the third
+        job.objects.bulk_create([
+            job(user=user, workspace=ws, pce=self.pces[i % 2], module=mod,
+                job_name='job{}'.format(i), state=3)
+            for i in range(10)] + [
+            job(user=user, workspace=ws, pce=self.pces[2], module=mod,
+                job_name='done', state=7)])
+
+    def tearDown(self):
+        pce_connect.get_pce_access = self.get_pce_access
+
+    def test_refresh_once_per_pce(self):
+        for i in range(3):
+            list_jobs({'page_size': '5'})
+        self.assertEqual(sorted(self.refreshed),
+                         sorted(p.pce_id for p in self.pces[:2]))
+
+        # Asked again once the refresh interval has passed
+        cache.delete('job_refresh:%d' % self.pces[0].pce_id)
+        list_jobs({'pce_id': str(self.pces[0].pce_id)})
+        list_jobs({})
+        self.assertEqual(self.refreshed.count(self.pces[0].pce_id), 2)
+        self.assertEqual(self.refreshed.count(self.pces[1].pce_id), 1)
+
+
+logging.getLogger('onramp.test').addHandler(logging.NullHandler())
+
+
+class JobOutputTest(TestCase):
+    """ PCEAccess storage of job output fetched from the PCE """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.access = pce_connect.PCEAccess.__new__(pce_connect.PCEAccess)
+        self.access._pce_job_dir = self.tmp_dir
+        self.access._name = '[test] '
+        self.access._logger = logging.getLogger('onramp.test')
+        self.responses = []
+        self.access._pce_get = lambda endpoint, **kwargs: self.responses.pop(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch(self, output, digest, chunk=1000):
+        self.responses = [
+            {'status_code': 0, 'size': len(output), 'output': output[i:i + chunk],
+             'next_offset': min(i + chunk, len(output))}
+            for i in range(0, len(output), chunk)]
+        return self.access._fetch_job_output(1, digest)
+
+    def digest_file(self):
+        return os.path.join(self.tmp_dir, '1', 'output.sha256')
+
+    def output_files(self):
+        return sorted(name for name in os.listdir(os.path.join(self.tmp_dir, '1'))
+                      if name.startswith('output.txt'))
+
+    def test_round_trip(self):
+        small = u'x' * (pce_connect.COMPRESS_MIN_SIZE - 1)
+        large = u'y' * pce_connect.COMPRESS_MIN_SIZE
+        for save in (self.access._save_job_output,
+                     lambda job_id, output: self.fetch(
+                         output, hashlib.sha256(output.encode('utf-8')).hexdigest())):
+            save(1, small)
+            self.assertEqual(self.output_files(), ['output.txt'])
+            self.assertEqual(self.access.read_job_output(1), small)
+
+            # Stored compressed, and the uncompressed copy is removed
+            save(1, large)
+            self.assertEqual(self.output_files(), ['output.txt.gz'])
+            with open(self.access.get_job_output(1), 'rb') as f:
+                self.assertEqual(f.read(2), b'\x1f\x8b')
+            self.assertEqual(self.access.read_job_output(1), large)
+
+            save(1, small)
+            self.assertEqual(self.output_files(), ['output.txt'])
+            self.assertEqual(self.access.read_job_output(1), small)
+
+    def test_digest_checked(self):
+        output = u'line 1\nline 2\n'
+        digest = hashlib.sha256(output.encode('utf-8')).hexdigest()
+        self.assertTrue(self.fetch(output, digest, chunk=3))
+        self.assertEqual(self.access.read_job_output(1), output)
+        with open(self.digest_file()) as f:
+            self.assertEqual(f.read(), digest)
+
+        # Output that doesn't have the PCE's digest is fetched again next time
+        self.assertFalse(self.fetch(u'truncated', 'f' * 64))
+        self.assertFalse(os.path.exists(self.digest_file()))
+        self.assertTrue(self.fetch(output, digest))
+        self.assertEqual(self.access.read_job_output(1), output)
+
+
+class FakeSession(object):
+    """ Stands in for a pooled requests.Session, answering each request with
+    the next of responses (a status code, or an exception to raise) """
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        result = self.responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        response = requests.Response()
+        response.status_code = result
+        response._content = b'{}'
+        return response
+
+
+class CountingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers every request with status, counting requests per method """
+    status = 502
+    hits = {}
+
+    def respond(self):
+        CountingHandler.hits[self.command] = CountingHandler.hits.get(self.command, 0) + 1
+        self.send_response(CountingHandler.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class PCEConnectionTest(TestCase):
+    """ Timeouts, retries and the circuit breaker of PCE requests """
+
+    def setUp(self):
+        self.pce = pce.objects.create(pce_name='pce')
+        self.access = pce_connect.PCEAccess.__new__(pce_connect.PCEAccess)
+        self.access._pce_id = self.pce.pce_id
+        self.access._url = 'http://pce.test'
+        self.access._name = '[test] '
+        self.access._logger = logging.getLogger('onramp.test')
+        self.sessions = dict(pce_connect._sessions)
+        self.breakers = dict(pce_connect._breakers)
+        pce_connect._sessions.clear()
+        pce_connect._breakers.clear()
+
+    def tearDown(self):
+        pce_connect._sessions.clear()
+        pce_connect._sessions.update(self.sessions)
+        pce_connect._breakers.clear()
+        pce_connect._breakers.update(self.breakers)
+
+    def fake_session(self, *responses):
+        session = FakeSession(list(responses))
+        pce_connect._sessions[self.access._url] = session
+        return session
+
+    def pce_state(self):
+        return pce.objects.get(pce_id=self.pce.pce_id).state
+
+    def test_timeouts(self):
+        session = self.fake_session(200, 200, requests.Timeout('read timed out'))
+        self.access._pce_get('jobs')
+        self.assertEqual(session.requests[0][2]['timeout'],
+                         (pce_connect.CONNECT_TIMEOUT, pce_connect.READ_TIMEOUT))
+
+        # Long polls may take wait seconds longer to answer
+        self.access._pce_get('jobs', since=1, wait=20)
+        self.assertEqual(session.requests[1][2]['timeout'],
+                         (pce_connect.CONNECT_TIMEOUT, pce_connect.READ_TIMEOUT + 20))
+
+        self.assertIsNone(self.access._request('GET', 'jobs'))
+        self.assertEqual(pce_connect._get_breaker(self.pce.pce_id).failures, 1)
+
+    def test_circuit_breaker(self):
+        threshold = pce_connect.CIRCUIT_THRESHOLD
+        session = self.fake_session(*([502] * (threshold - 1) + [504, 200]))
+        for i in range(threshold - 1):
+            self.access._request('GET', 'jobs')
+            self.assertEqual(self.pce_state(), 0)
+        self.access._request('GET', 'jobs')
+        self.assertEqual(self.pce_state(), pce_connect.PCE_STATE_DEGRADED)
+
+        # Open: requests fail without being sent
+        self.assertIsNone(self.access._request('GET', 'jobs'))
+        self.assertEqual(len(session.requests), threshold)
+
+        # Half open after CIRCUIT_RESET: one request is let through to test
+        # the PCE, and the others keep failing fast until it succeeds
+        breaker = pce_connect._get_breaker(self.pce.pce_id)
+        breaker.opened_at -= pce_connect.CIRCUIT_RESET
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.opened_at -= pce_connect.CIRCUIT_RESET
+        self.assertEqual(self.access._request('GET', 'jobs').status_code, 200)
+        self.assertEqual(self.pce_state(), 0)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.failures, 0)
+
+    def test_failed_probe_reopens(self):
+        breaker = pce_connect._CircuitBreaker()
+        for i in range(pce_connect.CIRCUIT_THRESHOLD):
+            breaker.record(False)
+        breaker.opened_at -= pce_connect.CIRCUIT_RESET
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.record(False))
+        self.assertFalse(breaker.allow())
+
+    def test_retries(self):
+        retry = pce_connect._get_session('http://pce.test').get_adapter(
+            'http://pce.test/jobs/').max_retries
+        self.assertEqual(retry.total, pce_connect.RETRIES)
+        self.assertEqual(retry.read, 0)
+        self.assertEqual(retry.status_forcelist, [502, 504])
+
+        backoff = pce_connect.RETRY_BACKOFF
+        pce_connect.RETRY_BACKOFF = 0
+        server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), CountingHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            self.access._url = 'http://127.0.0.1:%d' % server.server_port
+            CountingHandler.hits = {}
+            # GETs are retried, POSTs (not idempotent) are sent once
+            self.assertIsNone(self.access._request('GET', 'jobs'))
+            self.assertEqual(self.access._request('POST', 'jobs').status_code, 502)
+            self.assertEqual(CountingHandler.hits,
+                             {'GET': pce_connect.RETRIES + 1, 'POST': 1})
+        finally:
+            pce_connect.RETRY_BACKOFF = backoff
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+
+class PCEAccessRegistryTest(TestCase):
+    """ Shared PCEAccess instances and their invalidation """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.saved = (pce_connect.TMP_DIR, pce_connect._logging_configured)
+        # Keep local copies and the log out of the server folder
+        pce_connect.TMP_DIR = self.tmp_dir
+        pce_connect._logging_configured = True
+        pce_connect.invalidate_pce_access()
+        self.admin = User.objects.create(username='admin', is_superuser=True)
+        self.pce = pce.objects.create(pce_name='pce', ip_addr='pce.test', ip_port=9071)
+
+    def tearDown(self):
+        pce_connect.invalidate_pce_access()
+        pce_connect.TMP_DIR, pce_connect._logging_configured = self.saved
+        shutil.rmtree(self.tmp_dir)
+
+    def post(self, view, **data):
+        request = RequestFactory().post('/', data)
+        request.user = self.admin
+        return view(request)
+
+    def test_shared(self):
+        access = pce_connect.get_pce_access(self.pce.pce_id)
+        self.assertIs(pce_connect.get_pce_access(str(self.pce.pce_id)), access)
+        other = pce.objects.create(pce_name='other')
+        self.assertIsNot(pce_connect.get_pce_access(other.pce_id), access)
+        self.assertRaises(ValueError, pce_connect.get_pce_access, other.pce_id + 1)
+
+    def test_edit_invalidates(self):
+        access = pce_connect.get_pce_access(self.pce.pce_id)
+        # Every field the view reads
+        self.post(pce_views.edit_pce, pce_id=self.pce.pce_id, pce_name='pce',
+                  ip_addr='moved.test', ip_port=9072, port=0, contact_info='',
+                  location='', description='', pce_username='onramp')
+        new_access = pce_connect.get_pce_access(self.pce.pce_id)
+        self.assertIsNot(new_access, access)
+        self.assertEqual(new_access._url, 'http://moved.test:9072')
+        self.assertIs(pce_connect.get_pce_access(self.pce.pce_id), new_access)
+
+    def test_delete_invalidates(self):
+        pce_connect.get_pce_access(self.pce.pce_id)
+        self.post(pce_views.delete_pce, id=self.pce.pce_id)
+        self.assertRaises(ValueError, pce_connect.get_pce_access, self.pce.pce_id)
+
+
+class ModuleSyncTest(TestCase):
+    """ Writing the PCE's module list to the module and module_to_pce tables """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.pce = pce.objects.create(pce_name='pce')
+        self.access = pce_connect.PCEAccess.__new__(pce_connect.PCEAccess)
+        self.access._pce_id = self.pce.pce_id
+        self.access._pce_module_dir = self.tmp_dir
+        self.access._name = '[test] '
+        self.access._logger = logging.getLogger('onramp.test')
+        self.pce_mods = []
+        self.access.get_modules = lambda: self.pce_mods
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def pair_states(self, prefix):
+        return dict(module_to_pce.objects
+                    .filter(pce=self.pce, module__module_name__startswith=prefix)
+                    .values_list('module__module_name', 'state'))
+
+    def sync(self, prefix, count):
+        """ Sync a PCE list of count unchanged, count updated and count new
+        modules, plus one that doesn't exist, returning the number of queries.
+        """
+        self.pce_mods = [{'mod_name': prefix + 'gone', 'state': 'Does not exist'}]
+        for i in range(count):
+            for name, old_state, state in (('same', 3, 'Installed'),
+                                           ('updated', 1, 'Installed'),
+                                           ('new', None, 'Available')):
+                name = '{}{}{}'.format(prefix, name, i)
+                if old_state is not None:
+                    mod = module.objects.create(module_name=name)
+                    module_to_pce.objects.create(pce=self.pce, module=mod, state=old_state)
+                self.pce_mods.append({'mod_name': name, 'state': state,
+                                      'source_location': {'type': 'git', 'path': name}})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(self.access._refresh_modules_in_db('[test]'))
+        return len(queries)
+
+    def test_sync(self):
+        # Savepoint, module ids, new modules, their ids, pairs, new pairs,
+        # one UPDATE for the one changed state, release
+        queries = self.sync('a', 2)
+        self.assertEqual(queries, 8)
+        self.assertEqual(self.pair_states('a'), {
+            'asame0': 3, 'asame1': 3, 'aupdated0': 3, 'aupdated1': 3,
+            'anew0': 1, 'anew1': 1})
+        pair = module_to_pce.objects.get(pce=self.pce, module__module_name='anew0')
+        self.assertEqual((pair.src_location_type, pair.src_location_path), ('git', 'anew0'))
+        self.assertFalse(module.objects.filter(module_name='agone').exists())
+
+        # Ten times the modules, the same queries
+        self.assertEqual(self.sync('b', 20), queries)
+        self.assertEqual(sorted(set(self.pair_states('b').values())), [1, 3])
+
+        # Nothing to write: only module ids and pairs are read
+        with self.assertNumQueries(4):
+            self.assertTrue(self.access._refresh_modules_in_db('[test]'))
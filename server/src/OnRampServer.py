@@ -10,11 +10,13 @@ import sys
 
 #from wsgi import application
 import cherrypy
-from cherrypy.process.plugins import Daemonizer, PIDFile
+from cherrypy.process.plugins import Daemonizer, Monitor, PIDFile
 from configobj import ConfigObj
 from validate import Validator
 
 from webapp.dispatchers import Root, Users, Workspaces, PCEs, Modules, Jobs, States, Login, Logout, Admin
+from webapp.onrampdb import take_request_stats
+from webapp.onrampsessions import SESSION_FLUSH_INTERVAL
 import webapp.onramppce
 
 def _CORS():
@@ -33,6 +35,27 @@ def _CORS():
     else:
         cherrypy.response.headers['Access-Control-Allow-Origin'] = '*'
 
+def _log_db_stats():
+    """Log the number of database statements and the time spent in the
+    database by the request.
+    """
+    queries, seconds = take_request_stats()
+    logging.getLogger('onramp').debug(
+        '[DB] %s %s: %d queries, %.1f ms'
+        % (cherrypy.request.method, cherrypy.request.path_info, queries,
+           seconds * 1000))
+
+class _DBStatsTool(cherrypy.Tool):
+    """Count database work per request, and log it when the request ends."""
+
+    def __init__(self):
+        # Drop counts from work done outside a request by this thread
+        cherrypy.Tool.__init__(self, 'on_start_resource', take_request_stats)
+
+    def _setup(self):
+        cherrypy.Tool._setup(self)
+        cherrypy.request.hooks.attach('on_end_request', _log_db_stats)
+
 def _term_handler(signal, frame):
     """Gracefully shutdown the server and exit.
 
@@ -80,7 +103,8 @@ if __name__ == '__main__':
             'tools.proxy.on': True,
             'tools.response_headers.on': True,
             'request.dispatch': cherrypy.dispatch.MethodDispatcher(),
-            'tools.CORS.on': True
+            'tools.CORS.on': True,
+            'tools.db_stats.on': True
         },
 
         'internal': {
@@ -145,8 +169,10 @@ if __name__ == '__main__':
     #cherrypy.tools.CORS = cherrypy.Tool('before_finalize', _CORS)
     #cherrypy.tools.CORS = cherrypy.Tool('before_handler', _CORS)
     cherrypy.tools.CORS = cherrypy._cptools.HandlerTool( _CORS )
+    cherrypy.tools.db_stats = _DBStatsTool()
 
-    cherrypy.tree.mount(Root(cfg),       '/',           conf)
+    root = Root(cfg)
+    cherrypy.tree.mount(root,            '/',           conf)
     cherrypy.tree.mount(Users(cfg),      '/users',      conf)
     cherrypy.tree.mount(Workspaces(cfg), '/workspaces', conf)
     cherrypy.tree.mount(PCEs(cfg),       '/pces',       conf)
@@ -157,6 +183,11 @@ if __name__ == '__main__':
     cherrypy.tree.mount(Logout(cfg),     '/logout',      conf)
     cherrypy.tree.mount(Admin(cfg),      '/admin',      conf)
 
+    # Write session activity kept by the session cache
+    Monitor(cherrypy.engine, root._db.flush_sessions,
+            frequency=SESSION_FLUSH_INTERVAL, name='SessionFlush').subscribe()
+    cherrypy.engine.subscribe('stop', root._db.flush_sessions)
+
     logger.info('Starting cherrypy engine')
     cherrypy.engine.start()
     logger.debug('Registering signal handlers')
@@ -100,6 +100,20 @@ CREATE TABLE job (
     FOREIGN KEY(module_id) REFERENCES module(module_id)
 );
 
+-- Job searches, which are in job_id order. SQLite appends the rowid (job_id)
+-- to every index, so each is also in job_id order within equal values: the
+-- single column indexes for a user's (workspace's, ...) jobs, and the (X, state)
+-- indexes for their jobs in one state. Other searches sort their matches.
+CREATE INDEX job_by_user ON job(user_id);
+CREATE INDEX job_by_workspace ON job(workspace_id);
+CREATE INDEX job_by_pce ON job(pce_id);
+CREATE INDEX job_by_module ON job(module_id);
+CREATE INDEX job_by_user_state ON job(user_id, state);
+CREATE INDEX job_by_workspace_state ON job(workspace_id, state);
+CREATE INDEX job_by_pce_state ON job(pce_id, state);
+CREATE INDEX job_by_module_state ON job(module_id, state);
+CREATE INDEX job_by_state ON job(state);
+
 -- Users that belong to a workspace
 CREATE TABLE user_to_worksapce (
     uw_pair_id integer primary key autoincrement not null,
@@ -162,3 +176,6 @@ CREATE TABLE auth_session (
    -- Constraints
     FOREIGN KEY(user_id) REFERENCES user(user_id)
 );
+
+-- Number of schema migrations included above (see onrampdb_sqlite.py)
+PRAGMA user_version = 2;
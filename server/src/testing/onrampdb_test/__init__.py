@@ -0,0 +1,115 @@
+"""Unit testing for job searches in webapp.onrampdb_sqlite."""
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from webapp import onrampdb, onrampdb_sqlite
+
+logging.getLogger('onramp.test').addHandler(logging.NullHandler())
+
+class JobSearchTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'onramp.db')
+        schema = os.path.join(os.path.dirname(onrampdb.__file__), '..', 'db',
+                              'onramp_schema_sqlite.sql')
+        conn = sqlite3.connect(self.filename)
+        with open(schema) as f:
+            conn.executescript(f.read())
+        # Jobs 1-2000: user 1 or 2 by parity, state 1-4 in turn.
+        conn.executemany("INSERT INTO job (user_id, workspace_id, pce_id, "
+                         "module_id, job_name, state) VALUES (?, 1, 1, 1, ?, ?)",
+                         [(i % 2 + 1, 'job%d' % i, i % 4 + 1)
+                          for i in range(1, 2001)])
+        conn.commit()
+        conn.close()
+        self.db = onrampdb_sqlite.Database_sqlite(
+            logging.getLogger('onramp.test'), {'filename': self.filename})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def job_ids(self, info):
+        return [row[0] for row in info['data']]
+
+    def test_empty_list(self):
+        info = self.db.get_job_info(search_params={'state': []})
+        self.assertEqual(info['data'], [])
+        info = self.db.get_user_jobs(1, {'state': []}, 10)
+        self.assertEqual(info['data'], [])
+        self.assertIsNone(info['next_after_job_id'])
+        self.assertIsNone(self.db.get_job_info(5, {'state': []})['data'])
+
+    def test_bound_list(self):
+        ids = range(2, 2 * onrampdb_sqlite.MAX_BOUND_LIST + 1, 2)
+        info = self.db.get_job_info(search_params={'job_id': ids})
+        self.assertEqual(self.job_ids(info), ids)
+        info = self.db.get_user_jobs(1, {'job_id': [1, 2, 3]})
+        self.assertEqual(self.job_ids(info), [2])
+
+    def test_long_list(self):
+        # More ids than SQLite allows parameters.
+        ids = range(1, 1501) + [5000]
+        info = self.db.get_job_info(search_params={'job_id': ids,
+                                                   'state': [1, 2]})
+        expected = [i for i in range(1, 1501) if i % 4 + 1 in (1, 2)]
+        self.assertEqual(self.job_ids(info), expected)
+        info = self.db.get_pce_jobs(1, {'job_id': ids}, 100, 1400)
+        self.assertEqual(self.job_ids(info), range(1401, 1501))
+        self.assertIsNone(info['next_after_job_id'])
+
+        # Only integers are written into the SQL.
+        self.assertRaises(ValueError, self.db.get_job_info, None,
+                          {'job_id': ids[:-1] + ['1 OR 1']})
+        self.assertRaises(ValueError, self.db.get_job_info, None,
+                          {'output_file': ['out%d' % i for i in range(1000)]})
+
+    def test_pages(self):
+        search = {'state': [2, 3]}
+        expected = [i for i in range(1, 2001)
+                    if i % 2 == 1 and i % 4 + 1 in (2, 3)]
+        self.assertEqual(len(expected), 500)
+
+        found = []
+        after = None
+        while True:
+            info = self.db.get_user_jobs(2, search, 120, after)
+            self.assertTrue(len(info['data']) <= 120)
+            found.extend(self.job_ids(info))
+            after = info['next_after_job_id']
+            if after is None:
+                break
+            self.assertEqual(after, found[-1])
+        self.assertEqual(found, expected)
+        # 4 full pages and a part page.
+        self.assertEqual(len(info['data']), 20)
+
+    def test_page_boundaries(self):
+        # The last page is exactly full: no next page.
+        info = self.db.get_job_info(limit=10, after_job_id=1990)
+        self.assertEqual(self.job_ids(info), range(1991, 2001))
+        self.assertIsNone(info['next_after_job_id'])
+
+        # One more job: a next page with only that job.
+        info = self.db.get_job_info(limit=10, after_job_id=1989)
+        self.assertEqual(self.job_ids(info), range(1990, 2000))
+        self.assertEqual(info['next_after_job_id'], 1999)
+        info = self.db.get_job_info(limit=10, after_job_id=1999)
+        self.assertEqual(self.job_ids(info), [2000])
+        self.assertIsNone(info['next_after_job_id'])
+
+        # Past the last job, and a page of one.
+        info = self.db.get_job_info(limit=10, after_job_id=2000)
+        self.assertEqual(info['data'], [])
+        self.assertIsNone(info['next_after_job_id'])
+        info = self.db.get_job_info(limit=1, after_job_id=0)
+        self.assertEqual(self.job_ids(info), [1])
+        self.assertEqual(info['next_after_job_id'], 1)
+
+        # Without a limit every job is returned, and there are no pages.
+        info = self.db.get_job_info(after_job_id=1000)
+        self.assertEqual(self.job_ids(info), range(1001, 2001))
+        self.assertNotIn('next_after_job_id', info)
@@ -0,0 +1,92 @@
+"""Unit testing for webapp.onramppce."""
+import gzip
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from webapp.onramppce import COMPRESS_MIN_SIZE, PCEAccess
+
+logging.getLogger('onramp.test').addHandler(logging.NullHandler())
+
+class FakeDB(object):
+    """Stands in for onrampdb.DBAccess, with one PCE."""
+    def pce_get_info(self, pce_id):
+        return {'fields': ['pce_id', 'pce_name', 'ip_addr', 'ip_port'],
+                'data': [pce_id, 'test', '127.0.0.1', 9071]}
+
+class JobOutputTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.access = PCEAccess(logging.getLogger('onramp.test'), FakeDB(),
+                                1, self.tmp_dir)
+        self.responses = []
+        self.access._pce_get = (lambda endpoint, **kwargs:
+                                self.responses.pop(0))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def fetch(self, output, digest=None, chunk=1000):
+        if digest is None:
+            digest = hashlib.sha256(output.encode('utf-8')).hexdigest()
+        self.responses = [
+            {'status_code': 0, 'size': len(output),
+             'output': output[i:i + chunk],
+             'next_offset': min(i + chunk, len(output))}
+            for i in range(0, len(output), chunk)]
+        return self.access._fetch_job_output(1, digest)
+
+    def read_output(self):
+        output_file = os.path.join(self.tmp_dir,
+                                   self.access.get_job_output(1))
+        if output_file.endswith('.gz'):
+            with gzip.open(output_file, 'rb') as f:
+                return f.read().decode('utf-8')
+        with open(output_file, 'rb') as f:
+            return f.read().decode('utf-8')
+
+    def output_files(self):
+        job_dir = os.path.join(self.access._pce_job_dir, '1')
+        return sorted(filter(lambda x: x.startswith('output.txt'),
+                             os.listdir(job_dir)))
+
+    def test_output_file(self):
+        self.assertTrue(self.access._job_output_file(
+            1, COMPRESS_MIN_SIZE - 1).endswith('/1/output.txt'))
+        self.assertTrue(self.access._job_output_file(
+            1, COMPRESS_MIN_SIZE).endswith('/1/output.txt.gz'))
+
+    def test_round_trip(self):
+        small = u'x' * (COMPRESS_MIN_SIZE - 1)
+        large = u'y' * COMPRESS_MIN_SIZE
+        for save in (self.access._save_job_output,
+                     lambda job_id, output: self.fetch(output)):
+            save(1, small)
+            self.assertEqual(self.output_files(), ['output.txt'])
+            self.assertEqual(self.read_output(), small)
+
+            # Stored compressed, and the uncompressed copy is removed.
+            save(1, large)
+            self.assertEqual(self.output_files(), ['output.txt.gz'])
+            self.assertEqual(self.read_output(), large)
+
+            save(1, small)
+            self.assertEqual(self.output_files(), ['output.txt'])
+            self.assertEqual(self.read_output(), small)
+
+    def test_digest_checked(self):
+        output = u'line 1\nline 2\n'
+        digest_file = os.path.join(self.access._pce_job_dir, '1',
+                                   'output.sha256')
+        self.assertTrue(self.fetch(output, chunk=3))
+        self.assertEqual(self.read_output(), output)
+        self.assertTrue(os.path.exists(digest_file))
+
+        # Output without the PCE's digest is fetched again next time.
+        self.assertFalse(self.fetch(u'truncated', 'f' * 64))
+        self.assertFalse(os.path.exists(digest_file))
+        self.assertTrue(self.fetch(output))
+        self.assertEqual(self.read_output(), output)
@@ -0,0 +1,166 @@
+"""Unit testing for webapp.onrampsessions and its use by webapp.onrampdb."""
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from webapp import onrampdb, onrampsessions
+from webapp.onrampsessions import SessionCache
+
+logging.getLogger('onramp.test').addHandler(logging.NullHandler())
+
+class FakeClock(object):
+    """Stands in for the time module in onrampsessions."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class SessionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.saved_time = onrampsessions.time
+        onrampsessions.time = self.clock
+
+    def tearDown(self):
+        onrampsessions.time = self.saved_time
+
+    def test_ttl(self):
+        cache = SessionCache(ttl=60)
+        cache.add(1)
+        self.assertTrue(cache.is_active('1'))
+        # Checks are remembered separately.
+        self.assertFalse(cache.is_active(1, (3, 'alice', False)))
+        cache.add(1, (3, 'alice', False))
+        self.assertTrue(cache.is_active(1, (3, 'alice', False)))
+
+        self.clock.now += 59
+        self.assertTrue(cache.is_active(1))
+        # Use doesn't extend the TTL.
+        self.clock.now += 1
+        self.assertFalse(cache.is_active(1))
+        self.assertFalse(cache.is_active(1, (3, 'alice', False)))
+
+        # Found active again: a new TTL, without the old checks.
+        cache.add(1)
+        self.clock.now += 59
+        self.assertTrue(cache.is_active(1))
+        self.assertFalse(cache.is_active(1, (3, 'alice', False)))
+
+    def test_lru(self):
+        cache = SessionCache(max_entries=2)
+        cache.add(1)
+        cache.add(2)
+        self.assertTrue(cache.is_active(1))
+        cache.add(3)
+        # 2 was least recently used.
+        self.assertTrue(cache.is_active(1))
+        self.assertFalse(cache.is_active(2))
+        self.assertTrue(cache.is_active(3))
+        cache.add(2)
+        self.assertFalse(cache.is_active(1))
+
+    def test_pending(self):
+        cache = SessionCache()
+        cache.touch(1)
+        self.clock.now += 5
+        cache.touch(1)
+        cache.touch(2)
+        self.assertEqual(cache.take_pending(), {'1': 1005.0, '2': 1005.0})
+        self.assertEqual(cache.take_pending(), {})
+
+        # Put back after a failed write, newer operations win.
+        self.clock.now += 5
+        cache.touch(2)
+        cache.restore_pending({'1': 1005.0, '2': 1005.0})
+        self.assertEqual(cache.take_pending(), {'1': 1005.0, '2': 1010.0})
+
+        cache.add(1)
+        cache.touch(1)
+        self.assertEqual(cache.evict(1), 1010.0)
+        self.assertFalse(cache.is_active(1))
+        self.assertIsNone(cache.evict(1))
+        self.assertEqual(cache.take_pending(), {})
+
+class DBAccessSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmp_dir, 'onramp.db')
+        schema = os.path.join(os.path.dirname(onrampdb.__file__), '..', 'db',
+                              'onramp_schema_sqlite.sql')
+        conn = sqlite3.connect(self.filename)
+        with open(schema) as f:
+            conn.executescript(f.read())
+        conn.execute("INSERT INTO user (username, password) "
+                     "VALUES ('alice', 'secret')")
+        conn.commit()
+        conn.close()
+        onrampdb._session_cache.clear()
+        self.db = onrampdb.DBAccess(logging.getLogger('onramp.test'),
+                                    'sqlite', {'filename': self.filename})
+        self.auth = self.db.user_login('alice', 'secret')
+        self.auth['username'] = 'alice'
+
+    def tearDown(self):
+        onrampdb._session_cache.clear()
+        shutil.rmtree(self.tmp_dir)
+
+    def session_row(self):
+        conn = sqlite3.connect(self.filename)
+        try:
+            return conn.execute("SELECT time_last_op, time_logout "
+                                "FROM auth_session WHERE session_id = ?",
+                                (self.auth['session_id'],)).fetchone()
+        finally:
+            conn.close()
+
+    def set_last_op(self, value):
+        conn = sqlite3.connect(self.filename)
+        conn.execute("UPDATE auth_session SET time_last_op = ?", (value,))
+        conn.commit()
+        conn.close()
+
+    def test_cached_checks(self):
+        self.assertTrue(self.db.check_user_apikey(self.auth['apikey']))
+        self.assertTrue(self.db.check_user_auth(self.auth))
+        # Answered from the cache: the database isn't asked again.
+        self.db._db.is_active_session_id = None
+        self.assertTrue(self.db.check_user_apikey(self.auth['apikey']))
+        self.assertTrue(self.db.check_user_auth(self.auth))
+
+    def test_logout(self):
+        self.assertTrue(self.db.check_user_auth(self.auth))
+        self.set_last_op('2000-01-01 00:00:00')
+        self.db.user_update(self.auth)
+        self.db.user_logout(self.auth)
+
+        # The pending operation is written, and the session evicted.
+        last_op, logout = self.session_row()
+        self.assertNotEqual(last_op, '2000-01-01 00:00:00')
+        self.assertIsNotNone(logout)
+        self.assertEqual(onrampdb._session_cache.take_pending(), {})
+        self.assertFalse(self.db.check_user_auth(self.auth))
+        self.assertFalse(self.db.check_user_apikey(self.auth['apikey']))
+
+    def test_flush(self):
+        self.set_last_op('2000-01-01 00:00:00')
+        self.db.user_update(self.auth)
+        self.db.user_update(self.auth)
+        self.assertEqual(self.session_row()[0], '2000-01-01 00:00:00')
+        self.db.flush_sessions()
+        self.assertNotEqual(self.session_row()[0], '2000-01-01 00:00:00')
+        self.assertEqual(onrampdb._session_cache.take_pending(), {})
+
+        # Operations that could not be written are kept for the next flush.
+        self.set_last_op('2000-01-01 00:00:00')
+        self.db.user_update(self.auth)
+        def fail(times):
+            raise sqlite3.OperationalError('database is locked')
+        self.db._db.session_update_times = fail
+        self.assertRaises(sqlite3.OperationalError, self.db.flush_sessions)
+        del self.db._db.session_update_times
+        self.db.flush_sessions()
+        self.assertNotEqual(self.session_row()[0], '2000-01-01 00:00:00')
@@ -0,0 +1,16 @@
+#!../env/bin/python
+"""Unit tests for the webapp package of the OnRamp server.
+
+Usage: ./test_webapp.py
+
+The tests need no database or PCE, and only write to temporary directories.
+"""
+import os
+import sys
+
+import nose
+
+if __name__ == '__main__':
+    # Make the webapp package importable.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    nose.main()
@@ -98,16 +98,58 @@ class _ServerResourceBase:
         return self._db.check_user_apikey( apikey )
         
     def _check_auth(self, prefix, auth, req_admin=False, throw_error=True):
-        if self._db.check_user_auth( auth, req_admin ) is False:
+        # On a session cache miss, lookup and session check in one transaction
+        with self._db.unit_of_work():
+            valid = self._db.check_user_auth( auth, req_admin )
+            if valid is not False:
+                self._db.user_update( auth );
+
+        if valid is False:
             if throw_error is True:
                 self.logger.debug(prefix + " Authorization Failed: 'auth' key invalid")
                 raise cherrypy.HTTPError(401)
             return False
-        else:
-            self._db.user_update( auth );
 
         return True
 
+    def _get_page_args(self, prefix, kwargs):
+        """Remove and return the (limit, after_job_id) paging arguments of a
+        job listing. Either is None if not given.
+        """
+        page = []
+        for key in ["limit", "after_job_id"]:
+            value = kwargs.pop(key, None)
+            if value is not None:
+                try:
+                    value = int(value)
+                except (TypeError, ValueError):
+                    value = -1
+                if value < (1 if key == "limit" else 0):
+                    self.logger.debug(prefix + " Invalid '" + key + "'")
+                    raise cherrypy.HTTPError(400)
+            page.append(value)
+        return tuple(page)
+
+    def _refresh_jobs(self, prefix, search_params):
+        """Pull job states changed on the PCEs into the DB before listing jobs
+        matching search_params, one request per PCE. Only PCEs running active
+        jobs that match are asked, each at most once every
+        onramppce.JOB_REFRESH_SECONDS.
+        """
+        search = dict((k, v) for k, v in search_params.items() if k != "state")
+        search["state"] = onramppce.ACTIVE_JOB_STATES
+        info = self._db.job_get_info(search_params=search)
+        if info is None:
+            return
+        column = list(info["fields"]).index("pce_id")
+        for pce_id in set(row[column] for row in info["data"]):
+            if self._db.is_valid_pce_id(pce_id) is False:
+                continue
+            if pce_id not in self._pces:
+                self._pces[pce_id] = onramppce.PCEAccess(self.logger, self._db, pce_id, self._tmp_dir)
+            if self._pces[pce_id].refresh_jobs() is None:
+                self.logger.error(prefix + " Could not refresh jobs of PCE " + str(pce_id))
+
     def _not_implemented(self, prefix):
         self.logger.debug(prefix + " Not implemented")
         rtn = {}
@@ -234,6 +276,7 @@ class Users(_ServerResourceBase):
             #
             # Process keys
             #
+            limit, after_job_id = self._get_page_args(prefix, kwargs)
             allowed_search = ["apikey", "workspace", "pce", "module", "state"]
 
             ids = {}
@@ -253,7 +296,8 @@ class Users(_ServerResourceBase):
                     debug += "("+key+"="+value+")"
 
             self.logger.debug(prefix + " Processing... " + debug)
-            user_info = self._db.user_get_jobs(user_id, ids)
+            self._refresh_jobs(prefix, dict(ids, user_id=user_id))
+            user_info = self._db.user_get_jobs(user_id, ids, limit, after_job_id)
             if user_info is None:
                 self.logger.error(prefix + " Error no data found")
             else:
@@ -426,6 +470,7 @@ class Workspaces(_ServerResourceBase):
             #
             # Process keys
             #
+            limit, after_job_id = self._get_page_args(prefix, kwargs)
             allowed_search = ["apikey", "user", "pce", "module", "state"]
             ids = {}
             debug = ""
@@ -444,7 +489,8 @@ class Workspaces(_ServerResourceBase):
                     debug += "("+key+"="+value+")"
 
             self.logger.debug(prefix + " Processing... " + debug)
-            workspace_info = self._db.workspace_get_jobs(workspace_id, ids)
+            self._refresh_jobs(prefix, dict(ids, workspace_id=workspace_id))
+            workspace_info = self._db.workspace_get_jobs(workspace_id, ids, limit, after_job_id)
             if workspace_info is None:
                 self.logger.error(prefix + " Error no data found")
             else:
@@ -646,6 +692,7 @@ class PCEs(_ServerResourceBase):
             #
             # Process keys
             #
+            limit, after_job_id = self._get_page_args(prefix, kwargs)
             allowed_search = ["apikey", "user", "workspace", "module", "state"]
             ids = {}
             debug = ""
@@ -664,7 +711,8 @@ class PCEs(_ServerResourceBase):
                     debug += "("+key+"="+value+")"
 
             self.logger.debug(prefix + " Processing... " + debug)
-            pce_info = self._db.pce_get_jobs(pce_id, ids)
+            self._refresh_jobs(prefix, dict(ids, pce_id=pce_id))
+            pce_info = self._db.pce_get_jobs(pce_id, ids, limit, after_job_id)
             if pce_info is None:
                 self.logger.error(prefix + " Error no data found")
             else:
@@ -814,6 +862,7 @@ class Modules(_ServerResourceBase):
             #
             # Process keys
             #
+            limit, after_job_id = self._get_page_args(prefix, kwargs)
             allowed_search = ["apikey", "user", "workspace", "pce", "state"]
             ids = {}
             debug = ""
@@ -832,7 +881,8 @@ class Modules(_ServerResourceBase):
                     debug += "("+key+"="+value+")"
 
             self.logger.debug(prefix + " Processing... " + debug)
-            module_info = self._db.module_get_jobs(module_id, ids)
+            self._refresh_jobs(prefix, dict(ids, module_id=module_id))
+            module_info = self._db.module_get_jobs(module_id, ids, limit, after_job_id)
             if module_info is None:
                 self.logger.error(prefix + " Error no data found")
             else:
@@ -952,6 +1002,7 @@ class Jobs(_ServerResourceBase):
             #
             # Process keys
             #
+            limit, after_job_id = self._get_page_args(prefix, kwargs)
             allowed_search = ["apikey", "user", "workspace", "pce", "module", "state", "output_file"]
             ids = {}
             debug = ""
@@ -971,7 +1022,8 @@ class Jobs(_ServerResourceBase):
 
             self.logger.debug(prefix + " Processing..." + debug)
 
-            job_info = self._db.job_get_info( search_params=ids )
+            self._refresh_jobs(prefix, ids)
+            job_info = self._db.job_get_info( search_params=ids, limit=limit, after_job_id=after_job_id )
             if job_info is None:
                 self.logger.error(prefix + " Error no data found")
             else:
@@ -5,6 +5,7 @@
 import os
 import json
 import exceptions
+from contextlib import contextmanager
 
 class Database():
 
@@ -14,6 +15,7 @@ class Database():
     pce_states    = { 0 : "Running",
                       1 : "Establishing Connection",
                       2 : "Down",
+                      3 : "Degraded",
                       -1 : "Error: Undefined",
                       }
     pce_states_r = {v:k for k, v in pce_states.iteritems()}
@@ -55,12 +57,18 @@ class Database():
     def is_connected(self):
         raise NotImplemented("Please implement this method")
 
-    def connect(self):
+    def connect(self, write=False):
         raise NotImplemented("Please implement this method")
 
     def disconnect(self):
         raise NotImplemented("Please implement this method")
 
+    def begin(self, write=False):
+        raise NotImplemented("Please implement this method")
+
+    def end(self, commit=True):
+        raise NotImplemented("Please implement this method")
+
     ##########################################################
     def is_valid_session_id(self, session_id):
         raise NotImplemented("Please implement this method")
@@ -99,6 +107,9 @@ class Database():
     def session_update(self, session_id):
         raise NotImplemented("Please implement this method")
 
+    def session_update_times(self, times):
+        raise NotImplemented("Please implement this method")
+
     def session_stop(self, session_id):
         raise NotImplemented("Please implement this method")
 
@@ -115,7 +126,7 @@ class Database():
     def get_user_workspaces(self, user_id):
         raise NotImplemented("Please implement this method")
 
-    def get_user_jobs(self, user_id, search_params):
+    def get_user_jobs(self, user_id, search_params, limit=None, after_job_id=None):
         raise NotImplemented("Please implement this method")
 
     def edit_user_info(self, user_id, **update_info):
@@ -152,7 +163,7 @@ class Database():
     def get_workspace_pairs(self, workspace_id):
         raise NotImplemented("Please implement this method")
 
-    def get_workspace_jobs(self, workspace_id, search_params):
+    def get_workspace_jobs(self, workspace_id, search_params, limit=None, after_job_id=None):
         raise NotImplemented("Please implement this method")
 
     ##########################################################
@@ -192,7 +203,7 @@ class Database():
     def get_pce_modules(self, pce_id, module_id=None):
         raise NotImplemented("Please implement this method")
 
-    def get_pce_jobs(self, pce_id, search_params):
+    def get_pce_jobs(self, pce_id, search_params, limit=None, after_job_id=None):
         raise NotImplemented("Please implement this method")
 
     ##########################################################
@@ -211,7 +222,7 @@ class Database():
     def get_module_pces(self, module_id):
         raise NotImplemented("Please implement this method")
 
-    def get_module_jobs(self, module_id, search_params):
+    def get_module_jobs(self, module_id, search_params, limit=None, after_job_id=None):
         raise NotImplemented("Please implement this method")
 
     ##########################################################
@@ -221,7 +232,7 @@ class Database():
     def add_job(self, user_id, workspace_id, pce_id, module_id, job_data):
         raise NotImplemented("Please implement this method")
 
-    def get_job_info(self, module_id=None, search_params={}):
+    def get_job_info(self, job_id=None, search_params={}, limit=None, after_job_id=None):
         raise NotImplemented("Please implement this method")
 
     def get_job_data(self, job_id):
@@ -230,11 +241,24 @@ class Database():
     def update_job_state(self, job_id, state):
         raise NotImplemented("Please implement this method")
 
+    def update_job_states(self, pce_id, states):
+        raise NotImplemented("Please implement this method")
+
     ##########################################################
 
     
 
-from webapp.onrampdb_sqlite import Database_sqlite
+from webapp.onrampdb_sqlite import Database_sqlite, take_stats
+from webapp.onrampsessions import SessionCache
+
+# Shared by every DBAccess, so a logout through one dispatcher is seen by all
+_session_cache = SessionCache()
+
+def take_request_stats():
+    """Return (statements, seconds) of database work done by this thread since
+    the last call, and reset the counts.
+    """
+    return take_stats()
 
 ##########################################
 class DBAccess():
@@ -248,6 +272,26 @@ class DBAccess():
             raise NotImplementedError
 
         self._db = self._known_db[dbtype](logger, auth)
+        self._sessions = _session_cache
+
+    ##########################################
+    @contextmanager
+    def unit_of_work(self, write=False):
+        """Run every DBAccess call in the with block as one transaction.
+
+        Args:
+            write (bool): Something in the block writes. The block then holds
+                the write lock from the start, so keep it short.
+
+        The transaction is rolled back if the block raises.
+        """
+        self._db.begin(write)
+        try:
+            yield self
+        except:
+            self._db.end(commit=False)
+            raise
+        self._db.end()
 
 
     ##########################################
@@ -333,7 +377,7 @@ class DBAccess():
     # User Management
     ##########################################
     def user_login(self, username, password):
-        self._db.connect()
+        self._db.connect(write=True)
         user_id = self._db.get_user_id(False, username, password)
         if user_id is None:
             self._db.disconnect()
@@ -344,22 +388,42 @@ class DBAccess():
         return {'user_id': user_id, 'session_id': session_id, 'apikey' : session_id}
 
     def user_update(self, auth ):
-        self._db.connect()
-        self._db.session_update( auth['session_id'] )
-        self._db.disconnect()
+        # Written along with other sessions by flush_sessions()
+        self._sessions.touch( auth['session_id'] )
         return True
 
     def user_logout(self, auth ):
-        self._db.connect()
+        op_time = self._sessions.evict( auth['session_id'] )
+        self._db.connect(write=True)
+        if op_time is not None:
+            self._db.session_update_times( {auth['session_id'] : op_time} )
         self._db.session_stop( auth['session_id'] )
         self._db.disconnect()
         return True
 
+    def flush_sessions(self):
+        """Write the time_last_op of sessions used since the last flush."""
+        pending = self._sessions.take_pending()
+        if len(pending) == 0:
+            return
+        try:
+            self._db.connect(write=True)
+            self._db.session_update_times(pending)
+            self._db.disconnect()
+        except:
+            self._sessions.restore_pending(pending)
+            raise
+
     def check_user_apikey(self, apikey ):
+        if self._sessions.is_active( apikey ):
+            return True
+
         self._db.connect()
         result = self._db.is_active_session_id( apikey )
         self._db.disconnect()
 
+        if result is True:
+            self._sessions.add( apikey )
         return result
 
     def check_user_auth(self, auth, req_admin=False ):
@@ -368,6 +432,10 @@ class DBAccess():
             if key not in auth.keys():
                 return False
 
+        check = (auth['user_id'], auth['username'], req_admin)
+        if self._sessions.is_active( auth['session_id'], check ):
+            return True
+
         user_id = self.user_lookup( auth['username'], req_admin=req_admin )
         # Username does not exist
         if user_id is None:
@@ -380,13 +448,15 @@ class DBAccess():
             self._db.connect()
             result = self._db.is_active_session_id(auth['session_id'], auth['user_id'])
             self._db.disconnect()
+            if result is True:
+                self._sessions.add( auth['session_id'], check )
             return result
 
         return True
 
     ##########################################
     def user_add_if_new(self, username, **create_data):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -411,7 +481,7 @@ class DBAccess():
 
     ##########################################
     def user_add(self, username, password):
-        self._db.connect()
+        self._db.connect(write=True)
         user_id = self._db.add_user(username, password)
         self._db.disconnect()
         return user_id
@@ -432,7 +502,7 @@ class DBAccess():
 
     ##########################################
     def user_edit_info(self, user_id, **data):
-        self._db.connect()
+        self._db.connect(write=True)
         
         if user_id is not None and self._db.is_valid_user_id(user_id) is False:
             self._logger.error("Invalid User ID ("+str(user_id)+")")
@@ -457,7 +527,7 @@ class DBAccess():
         return user_info
 
     ##########################################
-    def user_get_jobs(self, user_id, search_params={}):
+    def user_get_jobs(self, user_id, search_params={}, limit=None, after_job_id=None):
         self._db.connect()
 
         if self._db.is_valid_user_id(user_id) is False:
@@ -465,7 +535,7 @@ class DBAccess():
             self._db.disconnect()
             return None
 
-        user_info = self._db.get_user_jobs(user_id, search_params)
+        user_info = self._db.get_user_jobs(user_id, search_params, limit, after_job_id)
         self._db.disconnect()
         return user_info
     
@@ -474,7 +544,7 @@ class DBAccess():
     # Workspace Management
     ##########################################
     def workspace_add_if_new(self, name):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -499,14 +569,14 @@ class DBAccess():
 
     ##########################################
     def workspace_add(self, name):
-        self._db.connect()
+        self._db.connect(write=True)
         work_id = self._db.add_workspace(name)
         self._db.disconnect()
         return work_id
 
     ##########################################
     def workspace_add_user(self, workspace_id, user_id):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -534,7 +604,7 @@ class DBAccess():
 
     ##########################################
     def workspace_add_pair(self, workspace_id, pce_id, module_id):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -614,7 +684,7 @@ class DBAccess():
         return workspace_info
 
     ##########################################
-    def workspace_get_jobs(self, workspace_id, search_params={}):
+    def workspace_get_jobs(self, workspace_id, search_params={}, limit=None, after_job_id=None):
         self._db.connect()
 
         if self._db.is_valid_workspace_id(workspace_id) is False:
@@ -622,7 +692,7 @@ class DBAccess():
             self._db.disconnect()
             return None
 
-        workspace_info = self._db.get_workspace_jobs(workspace_id, search_params)
+        workspace_info = self._db.get_workspace_jobs(workspace_id, search_params, limit, after_job_id)
         self._db.disconnect()
         return workspace_info
 
@@ -637,7 +707,7 @@ class DBAccess():
         return info
 
     def pce_add_if_new(self, data):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -665,14 +735,14 @@ class DBAccess():
 
     ##########################################
     def pce_add(self, name):
-        self._db.connect()
+        self._db.connect(write=True)
         pce_id = self._db.add_pce(name)
         self._db.disconnect()
         return pce_id
 
     ##########################################
     def pce_add_module(self, pce_id, module_id, src_location_type='local', src_location_path='' ):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -700,7 +770,7 @@ class DBAccess():
 
     ##########################################
     def pce_update_module_state(self, pce_id, module_id, state):
-        self._db.connect()
+        self._db.connect(write=True)
 
         pm_pair_id = self._db.lookup_module_in_pce(pce_id, module_id)
         if pm_pair_id is None:
@@ -741,7 +811,7 @@ class DBAccess():
 
     ##########################################
     def pce_update_state(self, pce_id, state):
-        self._db.connect()
+        self._db.connect(write=True)
 
         if pce_id is not None and self._db.is_valid_pce_id(pce_id) is False:
             self._logger.error("Invalid PCE ID ("+str(pce_id)+")")
@@ -815,7 +885,7 @@ class DBAccess():
         return pce_info
 
     ##########################################
-    def pce_get_jobs(self, pce_id, search_params={}):
+    def pce_get_jobs(self, pce_id, search_params={}, limit=None, after_job_id=None):
         self._db.connect()
 
         if pce_id is not None and self._db.is_valid_pce_id(pce_id) is False:
@@ -823,7 +893,7 @@ class DBAccess():
             self._db.disconnect()
             return None
 
-        pce_info = self._db.get_pce_jobs(pce_id, search_params)
+        pce_info = self._db.get_pce_jobs(pce_id, search_params, limit, after_job_id)
         self._db.disconnect()
         return pce_info
 
@@ -832,7 +902,7 @@ class DBAccess():
     # Module Management
     ##########################################
     def module_add_if_new(self, name):
-        self._db.connect()
+        self._db.connect(write=True)
 
         info = {}
 
@@ -857,7 +927,7 @@ class DBAccess():
 
     ##########################################
     def module_add(self, name):
-        self._db.connect()
+        self._db.connect(write=True)
         module_id = self._db.add_module(name)
         self._db.disconnect()
         return module_id
@@ -902,7 +972,7 @@ class DBAccess():
         return module_info
 
     ##########################################
-    def module_get_jobs(self, module_id, search_params={}):
+    def module_get_jobs(self, module_id, search_params={}, limit=None, after_job_id=None):
         self._db.connect()
 
         if module_id is not None and self._db.is_valid_module_id(module_id) is False:
@@ -910,7 +980,7 @@ class DBAccess():
             self._db.disconnect()
             return None
 
-        module_info = self._db.get_module_jobs(module_id, search_params)
+        module_info = self._db.get_module_jobs(module_id, search_params, limit, after_job_id)
         self._db.disconnect()
         return module_info
 
@@ -918,11 +988,12 @@ class DBAccess():
     # Job Management
     ##########################################
     def job_add(self, user_id, workspace_id, pce_id, module_id, job_data):
-        self._db.connect()
+        self._db.connect(write=True)
 
         # See if already exists
         job_id = self._db.find_job_id(user_id, workspace_id, pce_id, module_id, job_data['job_name'])
         if job_id is not None:
+            self._db.disconnect()
             return (True, job_id)
 
         # Make sure this is a good tuple (allowed to submit the job)
@@ -945,7 +1016,7 @@ class DBAccess():
         return (False, job_id)
 
     ##########################################
-    def job_get_info(self, job_id=None, search_params={}):
+    def job_get_info(self, job_id=None, search_params={}, limit=None, after_job_id=None):
         self._db.connect()
 
         if job_id is not None and self._db.is_valid_job_id(job_id) is False:
@@ -953,7 +1024,7 @@ class DBAccess():
             self._db.disconnect()
             return None
 
-        job_info = self._db.get_job_info(job_id, search_params)
+        job_info = self._db.get_job_info(job_id, search_params, limit, after_job_id)
         self._db.disconnect()
         return job_info
 
@@ -972,7 +1043,7 @@ class DBAccess():
 
     ##########################################
     def job_update_state(self, job_id, state ):
-        self._db.connect()
+        self._db.connect(write=True)
 
         if self._db.is_valid_job_id(job_id) is False:
             self._logger.error("Invalid Job ID ("+str(job_id)+")")
@@ -983,3 +1054,15 @@ class DBAccess():
         self._db.disconnect()
         return job_info
 
+    ##########################################
+    def job_update_states(self, pce_id, states ):
+        """Update the state of many jobs of a PCE in one transaction.
+
+        Args:
+            pce_id (int): Id of the PCE running the jobs.
+            states (dict): Job id to new state id.
+        """
+        self._db.connect(write=True)
+        self._db.update_job_states(pce_id, states)
+        self._db.disconnect()
+
@@ -1,19 +1,95 @@
 """Functionality to support interacting with a SQLite Database
   Note the threading limitation at:
   http://cherrypy.readthedocs.org/en/latest/tutorials.html#tutorial-9-data-is-all-my-life
-  This is why we open/close the connection around each call
+  A sqlite3 connection may only be used by the thread that opened it, so each
+  thread keeps its own connection, opened on first use. The database is put in
+  WAL mode so readers do not block, and are not blocked by, the one writer.
+  Writers wait up to BUSY_TIMEOUT seconds for the write lock.
+
+  Each _connect()/_disconnect() pair runs in its own transaction, unless it is
+  inside a connect()/disconnect() pair, which runs as one transaction. A
+  begin()/end() pair (a unit of work) runs everything inside it, including
+  any connect()/disconnect() pairs, as one transaction.
+
+  The number of statements and the time spent in the database are counted per
+  thread, for request logging (see take_stats).
 """
 
 import os
 import json
 import onrampdb
 import sqlite3
-from threading import Lock
-from time import sleep
+import threading
+from time import localtime, sleep, strftime, time
+
+# Seconds to wait for a lock held by another connection
+BUSY_TIMEOUT = 30
+
+# Columns jobs may be searched by
+JOB_SEARCH_COLUMNS = ("job_id", "user_id", "workspace_id", "pce_id", "module_id", "state", "output_file")
+
+# Longest list of values bound as parameters in a job search. SQLite allows
+# 999 parameters per statement; longer lists of ids are written into the SQL.
+MAX_BOUND_LIST = 100
+
+# Schema changes, in order. A database's user_version is the number of them
+# it has. Databases created from db/onramp_schema_sqlite.sql have them all.
+_MIGRATIONS = [
+    # 1: Indexes for job searches. SQLite appends the rowid (job_id) to every
+    # index, so each is also in job_id order within equal values.
+    """
+    CREATE INDEX IF NOT EXISTS job_by_user ON job(user_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_workspace ON job(workspace_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_pce ON job(pce_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_module ON job(module_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_state ON job(state);
+    """,
+    # 2: Indexes in job_id order for all of a user's (workspace's, ...) jobs.
+    # The (X, state) indexes are only in job_id order for jobs in one state.
+    """
+    DROP INDEX IF EXISTS job_by_user;
+    DROP INDEX IF EXISTS job_by_workspace;
+    DROP INDEX IF EXISTS job_by_pce;
+    DROP INDEX IF EXISTS job_by_module;
+    CREATE INDEX IF NOT EXISTS job_by_user ON job(user_id);
+    CREATE INDEX IF NOT EXISTS job_by_workspace ON job(workspace_id);
+    CREATE INDEX IF NOT EXISTS job_by_pce ON job(pce_id);
+    CREATE INDEX IF NOT EXISTS job_by_module ON job(module_id);
+    CREATE INDEX IF NOT EXISTS job_by_user_state ON job(user_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_workspace_state ON job(workspace_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_pce_state ON job(pce_id, state);
+    CREATE INDEX IF NOT EXISTS job_by_module_state ON job(module_id, state);
+    """,
+]
+
+# Per thread: queries, seconds
+_stats = threading.local()
+
+def take_stats():
+    """Return (statements, seconds) of database work done by this thread since
+    the last call, and reset the counts.
+    """
+    stats = (getattr(_stats, 'queries', 0), getattr(_stats, 'seconds', 0.0))
+    _stats.queries = 0
+    _stats.seconds = 0.0
+    return stats
+
+def _add_time(seconds):
+    _stats.seconds = getattr(_stats, 'seconds', 0.0) + seconds
+
+def _int_literals(key, values):
+    """Return values as SQL integer literals. Only integers are written into
+    the SQL; a long list of anything else is refused.
+    """
+    literals = []
+    for value in values:
+        if type(value) not in (int, long):
+            raise ValueError("Too many values of " + str(key) + " to search by")
+        literals.append(str(value))
+    return literals
 
 class Database_sqlite(onrampdb.Database):
     _name = '[DB SQLite]'
-    _lock = Lock()
 
     def __init__(self, logger, auth):
         onrampdb.Database.__init__(self, logger, auth)
@@ -22,47 +98,130 @@ class Database_sqlite(onrampdb.Database):
             logger.critical(self._name + " Filename does not exist \""+self._auth['filename']+"\"")
         else:
             logger.debug(self._name + " Will connect with " + self._auth['filename'])
+            self._migrate()
 
-        self._connection = None
-        self._cursor = None
+        # Per thread: connection, cursor, in_unit, held, in_transaction,
+        # started
+        self._local = threading.local()
 
 
+    def _migrate(self):
+        conn = sqlite3.connect(self._auth['filename'], timeout=BUSY_TIMEOUT)
+        try:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for number in range(version, len(_MIGRATIONS)):
+                self._logger.info(self._name + " Applying schema migration " + str(number + 1))
+                conn.executescript("BEGIN; " + _MIGRATIONS[number] +
+                                   "PRAGMA user_version = " + str(number + 1) + "; COMMIT;")
+        finally:
+            conn.close()
+
     ##########################################################
-    def connect(self):
-        noop = 1
+    def _get_connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            # Transactions are started and ended explicitly (see _begin)
+            conn = sqlite3.connect(self._auth['filename'], timeout=BUSY_TIMEOUT,
+                                   isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = conn
+            self._local.cursor = None
+            self._local.in_unit = False
+            self._local.held = 0
+            self._local.in_transaction = False
+        return self._local.connection
+
+    def _begin(self, immediate=False):
+        conn = self._get_connection()
+        start = time()
+        if self._local.in_transaction:
+            # Left open by an exception part way through an earlier call
+            self._logger.warning(self._name + " Rolling back unfinished transaction")
+            conn.execute("ROLLBACK")
+        self._local.in_unit = False
+        # A deferred transaction that reads and then writes can fail with
+        # SQLITE_BUSY without waiting, so writers take the lock up front.
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        self._local.in_transaction = True
+        _add_time(time() - start)
+
+    def _commit(self):
+        if self._local.in_transaction:
+            start = time()
+            self._local.in_transaction = False
+            self._local.connection.execute("COMMIT")
+            _add_time(time() - start)
+
+    def _held(self):
+        return getattr(self._local, 'held', 0)
+
+    def begin(self, write=False):
+        """Start a unit of work: everything up to the matching end() runs as
+        one transaction. Units of work may be nested; only the outermost one
+        starts and ends the transaction. Pass write=True if anything in the
+        unit writes, so it holds the write lock from the start.
+        """
+        if self._held() == 0:
+            self._begin(immediate=write)
+        self._local.held = self._held() + 1
+
+    def end(self, commit=True):
+        """End a unit of work started with begin(). With commit=False the
+        whole transaction is rolled back, including any outer units of work.
+        """
+        if self._held() == 0:
+            return
+        if commit is False:
+            self._local.held = 0
+            if self._local.in_transaction:
+                self._local.in_transaction = False
+                self._local.connection.execute("ROLLBACK")
+            return
+        self._local.held -= 1
+        if self._local.held == 0:
+            self._commit()
+
+    def connect(self, write=False):
+        """Start a group of statements that run as one transaction, up to
+        disconnect(). Pass write=True if any of them write, so the group holds
+        the write lock from the start. Inside a unit of work this does nothing.
+        """
+        if self._held() > 0:
+            return
+        self._begin(immediate=write)
+        self._local.in_unit = True
 
     def _connect(self):
-        #self._logger.debug(self._name + " Connecting...")
-        # Need a lock to protect a re-entrant thread situation
-        self._lock.acquire()
-
-        self._connection = sqlite3.connect( self._auth['filename'] )
-        self._cursor = self._connection.cursor()
+        if not getattr(self._local, 'in_unit', False) and self._held() == 0:
+            self._begin()
+        self._local.cursor = self._local.connection.cursor()
+        self._local.started = time()
+        _stats.queries = getattr(_stats, 'queries', 0) + 1
 
     def is_connected(self):
-        is_connected = self._connection is not None
+        is_connected = getattr(self._local, 'connection', None) is not None
         return is_connected
 
     def disconnect(self):
-        noop = 1
+        if self._held() > 0:
+            return
+        if getattr(self._local, 'in_unit', False):
+            self._local.in_unit = False
+            self._commit()
 
     def _disconnect(self):
-        #self._logger.debug(self._name + " Disonnecting...")
-        self._connection.commit()
-        self._connection.close()
-        self._connection = None
-        self._cursor = None
-
-        # Need a lock to protect a re-entrant thread situation
-        self._lock.release()
+        _add_time(time() - self._local.started)
+        self._local.cursor = None
+        if not self._local.in_unit and self._held() == 0:
+            self._commit()
 
     #######################################################################
     def _valid_id_check(self, sql, args):
         self._logger.debug(self._name + " " + sql)
 
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -133,8 +292,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         # No such session
@@ -156,8 +315,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -171,8 +330,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        cnt = self._cursor.rowcount
+        self._local.cursor.execute(sql, args )
+        cnt = self._local.cursor.rowcount
         self._disconnect()
 
         if cnt > 0:
@@ -180,6 +339,20 @@ class Database_sqlite(onrampdb.Database):
         else:
             return False
 
+    def session_update_times(self, times):
+        self._logger.debug(self._name + "session_update_times(" + str(len(times)) + " sessions)")
+
+        sql = "UPDATE auth_session SET time_last_op = ? WHERE session_id = ?"
+        # Same format as datetime('now','localtime')
+        args = [(strftime('%Y-%m-%d %H:%M:%S', localtime(op_time)), session_id)
+                for session_id, op_time in times.items()]
+
+        self._logger.debug(self._name + " " + sql)
+
+        self._connect()
+        self._local.cursor.executemany(sql, args)
+        self._disconnect()
+
     def session_stop(self, session_id):
         self._logger.debug(self._name + "session_update(" + str(session_id) + ")")
 
@@ -189,8 +362,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        cnt = self._cursor.rowcount
+        self._local.cursor.execute(sql, args )
+        cnt = self._local.cursor.rowcount
         self._disconnect()
 
         if cnt > 0:
@@ -215,8 +388,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -245,8 +418,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -265,15 +438,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
+        self._local.cursor.execute(sql, args )
 
         if user_id is not None:
-            row = self._cursor.fetchone()
+            row = self._local.cursor.fetchone()
             self._disconnect()
 
             return {"fields": fields, "data": row }
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
             self._disconnect()
 
             if all_rows is None:
@@ -307,15 +480,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        all_rows = self._cursor.fetchall()
+        self._local.cursor.execute(sql, args )
+        all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields" : fields, "data": all_rows }
 
-    def get_user_jobs(self, user_id, search_params):
+    def get_user_jobs(self, user_id, search_params, limit=None, after_job_id=None):
         self._logger.debug(self._name + "get_user_jobs(" + str(user_id)+")")
-        return self._find_jobs_by('user_id', user_id, search_params)
+        return self._find_jobs_by('user_id', user_id, search_params, limit, after_job_id)
 
     def edit_user_info(self, user_id, **update_info):
         self._logger.debug(self._name + " edit_user_info({}, {})".format(str(user_id), str(update_info)))
@@ -346,8 +519,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, tuple(args) )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, tuple(args) )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -363,8 +536,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -381,8 +554,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -397,8 +570,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -415,8 +588,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -431,8 +604,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -449,8 +622,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -469,15 +642,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
+        self._local.cursor.execute(sql, args )
 
         if workspace_id is not None:
-            row = self._cursor.fetchone()
+            row = self._local.cursor.fetchone()
             self._disconnect()
 
             return {"fields": fields, "data": row }
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
             self._disconnect()
 
             if all_rows is None:
@@ -502,8 +675,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        all_rows = self._cursor.fetchall()
+        self._local.cursor.execute(sql, args )
+        all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields": fields, "data": all_rows }
@@ -524,15 +697,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        all_rows = self._cursor.fetchall()
+        self._local.cursor.execute(sql, args )
+        all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields": fields, "data": all_rows }
 
-    def get_workspace_jobs(self, workspace_id, search_params):
+    def get_workspace_jobs(self, workspace_id, search_params, limit=None, after_job_id=None):
         self._logger.debug(self._name + "get_workspace_jobs(" + str(workspace_id)+")")
-        return self._find_jobs_by('workspace_id', workspace_id, search_params)
+        return self._find_jobs_by('workspace_id', workspace_id, search_params, limit, after_job_id)
 
 
     ##########################################################
@@ -544,8 +717,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql)
-        all_rows = self._cursor.fetchall()
+        self._local.cursor.execute(sql)
+        all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         ids = []
@@ -566,8 +739,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -584,8 +757,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -600,8 +773,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -618,8 +791,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -633,8 +806,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -648,8 +821,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -668,15 +841,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
+        self._local.cursor.execute(sql, args )
 
         if pce_id is not None:
-            row = self._cursor.fetchone()
+            row = self._local.cursor.fetchone()
             self._disconnect()
 
             return {"fields": fields, "data": row }
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
             self._disconnect()
 
             if all_rows is None:
@@ -692,8 +865,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is not None:
@@ -719,8 +892,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        all_rows = self._cursor.fetchall()
+        self._local.cursor.execute(sql, args )
+        all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields": fields, "data": all_rows }
@@ -746,18 +919,18 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
+        self._local.cursor.execute(sql, args )
         if module_id is not None:
-            all_rows = self._cursor.fetchone()
+            all_rows = self._local.cursor.fetchone()
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields": fields + pa_fields, "data": all_rows }
 
-    def get_pce_jobs(self, pce_id, search_params):
+    def get_pce_jobs(self, pce_id, search_params, limit=None, after_job_id=None):
         self._logger.debug(self._name + "get_pce_jobs(" + str(pce_id)+")")
-        return self._find_jobs_by('pce_id', pce_id, search_params)
+        return self._find_jobs_by('pce_id', pce_id, search_params, limit, after_job_id)
 
     ##########################################################
     def get_module_id(self, name):
@@ -770,8 +943,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -788,8 +961,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
@@ -808,15 +981,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
+        self._local.cursor.execute(sql, args )
 
         if module_id is not None:
-            row = self._cursor.fetchone()
+            row = self._local.cursor.fetchone()
             self._disconnect()
 
             return {"fields": fields, "data": row }
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
             self._disconnect()
 
             if all_rows is None:
@@ -841,15 +1014,15 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        all_rows = self._cursor.fetchall()
+        self._local.cursor.execute(sql, args )
+        all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields": fields, "data": all_rows }
 
-    def get_module_jobs(self, module_id, search_params):
+    def get_module_jobs(self, module_id, search_params, limit=None, after_job_id=None):
         self._logger.debug(self._name + "get_module_jobs(" + str(module_id)+")")
-        return self._find_jobs_by('module_id', module_id, search_params)
+        return self._find_jobs_by('module_id', module_id, search_params, limit, after_job_id)
 
     ##########################################################
     def find_job_id(self, user_id, workspace_id, pce_id, module_id, job_name):
@@ -862,8 +1035,8 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        row = self._cursor.fetchone()
+        self._local.cursor.execute(sql, args )
+        row = self._local.cursor.fetchone()
         self._disconnect()
 
         if row is None:
@@ -881,65 +1054,19 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
 
-    def get_job_info(self, job_id=None, search_params={}):
+    def get_job_info(self, job_id=None, search_params={}, limit=None, after_job_id=None):
         self._logger.debug(self._name + "get_job_info(" + str(job_id)+")")
-        with_out_job_id = True
         if job_id is not None:
-            with_out_job_id = False
             return self._find_jobs_by('job_id', job_id, search_params)
 
-        args = ()
         fields = ("job_id", "user_id", "workspace_id", "pce_id", "module_id", "job_name", "state", "output_file")
-
-        sql  = "SELECT " + (', '.join(fields))
-        sql += " FROM job"
-
-        wsql = ""
-        largs = []
-
-        for key, value in search_params.iteritems():
-            self._logger.debug(self._name + "DEBUG Key = " + key)
-
-            if len(largs) > 0:
-                wsql += " AND "
-
-            if type(value) is list:
-                self._logger.debug(self._name + " Found a list value for the key " + key)
-
-                wsql += "("
-                for i in range(len(value)):
-                    wsql += " " + key + "= ? "
-                    largs.append(value[i])
-                    if i != len(value)-1:
-                        wsql += "OR"
-
-                wsql += ")"
-            else:
-                wsql +=  key + " = ?"
-                largs.append(value)
-
-        if len(largs) > 0:
-            sql += " WHERE " + wsql
-
-        args = tuple(largs)
-
-        self._logger.debug(self._name + " " + sql)
-        
-        self._connect()
-        self._cursor.execute(sql, args )
-        if with_out_job_id is False:
-            all_rows = self._cursor.fetchone()
-        else:
-            all_rows = self._cursor.fetchall()
-        self._disconnect()
-
-        return {"fields" : fields, "data": all_rows }
+        return self._find_jobs(fields, search_params, limit, after_job_id)
 
     def get_job_data(self, job_id):
         self._logger.debug(self._name + "get_job_data(" + str(job_id)+")")
@@ -986,11 +1113,11 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
+        self._local.cursor.execute(sql, args )
         if with_out_job_id is False:
-            all_rows = self._cursor.fetchone()
+            all_rows = self._local.cursor.fetchone()
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
         return {"fields" : fields, "data": all_rows }
@@ -1005,48 +1132,90 @@ class Database_sqlite(onrampdb.Database):
         self._logger.debug(self._name + " " + sql)
         
         self._connect()
-        self._cursor.execute(sql, args )
-        rowid = self._cursor.lastrowid
+        self._local.cursor.execute(sql, args )
+        rowid = self._local.cursor.lastrowid
         self._disconnect()
 
         return rowid
 
+    def update_job_states(self, pce_id, states):
+        self._logger.debug(self._name + "update_job_states (" + str(len(states)) + " jobs on " + str(pce_id) + ")")
+
+        sql = "UPDATE job SET state = ? WHERE job_id = ? AND pce_id = ?"
+        args = [(state, job_id, pce_id) for job_id, state in states.items()]
+
+        self._logger.debug(self._name + " " + sql)
+
+        # One transaction, committed by _disconnect()
+        self._connect()
+        self._local.cursor.executemany(sql, args)
+        self._disconnect()
+
 
     ##########################################################
-    def _find_jobs_by(self, id_str, id_value, search_params):
-        args = ()
+    def _find_jobs_by(self, id_str, id_value, search_params, limit=None, after_job_id=None):
         fields = ("job_id", "user_id", "workspace_id", "pce_id", "module_id", "job_name", "state")
-
-        sql  = "SELECT " + (', '.join(fields))
-        sql += " FROM job"
-        sql += " WHERE "+id_str+ " = ?"
-        largs = []
-        largs.append( id_value )
-        for key, value in search_params.iteritems():
+        search = dict(search_params)
+        search[id_str] = id_value
+        return self._find_jobs(fields, search, limit, after_job_id, id_str == "job_id")
+
+    def _find_jobs(self, fields, search_params, limit=None, after_job_id=None, one=False):
+        """Return the fields of jobs matching search_params, in job_id order.
+
+        search_params maps columns in JOB_SEARCH_COLUMNS to a value, or to a
+        list of values any of which may match. With limit, at most limit jobs
+        are returned, and "next_after_job_id" is the after_job_id of the next
+        page (None if there are no more jobs). With one, only the first job is
+        returned.
+        """
+        clauses = []
+        args = []
+        # Sorted, so the same search always gives the same SQL
+        for key in sorted(search_params.keys()):
+            if key not in JOB_SEARCH_COLUMNS:
+                raise ValueError("Jobs can not be searched by " + str(key))
+            value = search_params[key]
             if type(value) is list:
                 self._logger.debug(self._name + " Found a list value for the key " + key)
-                sql += " AND ("
-                for i in range(len(value)):
-                    sql += " " + key + "= ? "
-                    largs.append(value[i])
-                    if i != len(value)-1:
-                        sql += "OR"
-
-                sql += ")"
+                if len(value) == 0:
+                    # Nothing can match
+                    clauses.append("0")
+                elif len(value) <= MAX_BOUND_LIST:
+                    clauses.append(key + " IN (" + ", ".join(["?"] * len(value)) + ")")
+                    args.extend(value)
+                else:
+                    clauses.append(key + " IN (" + ", ".join(_int_literals(key, value)) + ")")
             else:
-                sql += " AND " + key + " = ?"
-                largs.append(value)
+                clauses.append(key + " = ?")
+                args.append(value)
+        if after_job_id is not None:
+            clauses.append("job_id > ?")
+            args.append(after_job_id)
 
-        args = tuple(largs)
+        sql  = "SELECT " + (', '.join(fields))
+        sql += " FROM job"
+        if len(clauses) > 0:
+            sql += " WHERE " + " AND ".join(clauses)
+        sql += " ORDER BY job_id"
+        if limit is not None:
+            # One more than a page, to tell whether there is a next page
+            sql += " LIMIT ?"
+            args.append(limit + 1)
 
         self._logger.debug(self._name + " " + sql)
-        
+
         self._connect()
-        self._cursor.execute(sql, args )
-        if id_str == "job_id":
-            all_rows = self._cursor.fetchone()
+        self._local.cursor.execute(sql, tuple(args) )
+        if one is True:
+            all_rows = self._local.cursor.fetchone()
         else:
-            all_rows = self._cursor.fetchall()
+            all_rows = self._local.cursor.fetchall()
         self._disconnect()
 
-        return {"fields" : fields, "data": all_rows }
+        info = {"fields" : fields, "data": all_rows }
+        if limit is not None:
+            info["next_after_job_id"] = None
+            if len(all_rows) > limit:
+                info["data"] = all_rows[:limit]
+                info["next_after_job_id"] = all_rows[limit - 1][0]
+        return info
@@ -3,11 +3,130 @@
 Exports:
     PCEAccess: Client-side interface to OnRamp PCE server.
 """
+import gzip
+import hashlib
 import json
 import os
-# import requests
+import threading
 import time
 
+try:
+    import requests
+    from requests.adapters import HTTPAdapter
+    from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+    # Only required to talk to PCEs.
+    requests = None
+
+# Job outputs of at least this many bytes are stored gzip-compressed.
+COMPRESS_MIN_SIZE = 4096
+
+# Connections kept open to each PCE.
+POOL_SIZE = 10
+# Seconds to wait for a PCE to accept a connection, and to send a response.
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+# Idempotent requests (GET, DELETE, ...) that fail to connect or get a 502 or
+# 504 are retried this many times, backing off exponentially from
+# RETRY_BACKOFF seconds.
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+# After CIRCUIT_THRESHOLD consecutive failed requests a PCE is marked degraded
+# and requests to it fail immediately. Every CIRCUIT_RESET seconds one request
+# is let through to test whether it has recovered.
+CIRCUIT_THRESHOLD = 5
+CIRCUIT_RESET = 30
+PCE_STATE_DEGRADED = 3
+
+# Pooled sessions by PCE URL and circuit breakers by PCE id, shared by all
+# PCEAccess instances in the process.
+_sessions = {}
+_breakers = {}
+_pool_lock = threading.Lock()
+
+# PCE job state strings to state ids stored in the job table.
+_JOB_STATE_IDS = {
+    "Setting up launch" : 1,
+    "Launch failed" : -1,
+    "Preprocessing" : 2,
+    "Preprocess failed" : -2,
+    "Scheduled" : 3,
+    "Schedule failed" : -3,
+    "Queued" : 4,
+    "Running" : 5,
+    "Run failed" : -5,
+    "Postprocessing" : 6,
+    "Done" : 7,
+}
+
+# State ids of jobs that may still change on the PCE.
+ACTIVE_JOB_STATES = [1, 2, 3, 4, 5, 6]
+
+# Least seconds between two refresh_jobs() requests to one PCE
+JOB_REFRESH_SECONDS = 10
+
+
+class _CircuitBreaker(object):
+    """Track consecutive failed requests to one PCE."""
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a request may be sent to the PCE."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= CIRCUIT_RESET:
+                # Let this request through to test the PCE. Others keep
+                # failing fast until it succeeds.
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record(self, ok):
+        """Record the outcome of a request.
+
+        Returns:
+            True if the breaker opened or closed as a result, else False.
+        """
+        with self._lock:
+            if ok:
+                changed = self.opened_at is not None
+                self.failures = 0
+                self.opened_at = None
+                return changed
+            self.failures += 1
+            if self.opened_at is None and self.failures >= CIRCUIT_THRESHOLD:
+                self.opened_at = time.time()
+                return True
+            return False
+
+
+def _get_session(url):
+    """Return the pooled session for the PCE at url."""
+    with _pool_lock:
+        if url not in _sessions:
+            retry = Retry(total=RETRIES, read=0, backoff_factor=RETRY_BACKOFF,
+                          status_forcelist=[502, 504])
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE,
+                                  max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[url] = session
+        return _sessions[url]
+
+
+def _get_breaker(pce_id):
+    """Return the circuit breaker for the PCE with the given id."""
+    with _pool_lock:
+        if pce_id not in _breakers:
+            _breakers[pce_id] = _CircuitBreaker()
+        return _breakers[pce_id]
+
 
 class PCEAccess():
     """Client-side interface to OnRamp PCE server.
@@ -21,6 +140,9 @@ class PCEAccess():
         deploy_module: Initiate module deployment actions.
         delete_module: Delete given module from PCE.
         get_jobs: Return the requested jobs.
+        update_jobs_in_db: Pull state of many jobs into the DB at once.
+        refresh_jobs: Pull state of jobs changed since the last refresh into
+            the DB.
         launch_job: Initiate job launch.
         delete_job: Delete given job from PCE.
         check_connection: Ping the server to see if it is still available.
@@ -63,6 +185,56 @@ class PCEAccess():
         pce_info = self._db.pce_get_info(pce_id)
         self._url = "http://%s:%d" % (pce_info['data'][2], pce_info['data'][3])
 
+        # PCE state version of the last refresh_jobs()
+        self._job_state_version = 0
+        # time.time() of the last refresh_jobs() request
+        self._last_refresh = 0
+        self._refresh_lock = threading.Lock()
+
+
+    def _request(self, method, endpoint, **kwargs):
+        """Send a request to the PCE over its pooled session.
+
+        Requests time out after CONNECT_TIMEOUT/READ_TIMEOUT seconds unless
+        kwargs give a timeout. Failures count toward the PCE's circuit
+        breaker, and while it is open requests fail without being sent.
+
+        Args:
+            method (str): HTTP method.
+            endpoint (str): API URL endpoint for request. Must not have leading
+                or trailing slashes.
+
+        Kwargs:
+            Passed to requests.Session.request().
+
+        Returns:
+            requests.Response, or 'None' if no response was received.
+        """
+        url = "%s/%s/" % (self._url, endpoint)
+        breaker = _get_breaker(self._pce_id)
+        if not breaker.allow():
+            self._logger.error('%s PCE degraded. Not sending %s %s'
+                               % (self._name, method, url))
+            return None
+
+        kwargs.setdefault('timeout', (CONNECT_TIMEOUT, READ_TIMEOUT))
+        try:
+            r = _get_session(self._url).request(method, url, **kwargs)
+        except requests.RequestException as e:
+            self._logger.error('%s Error: %s from %s %s'
+                               % (self._name, e, method, url))
+            r = None
+
+        ok = r is not None and r.status_code not in (502, 504)
+        if breaker.record(ok):
+            if ok:
+                self._logger.info('%s PCE recovered' % self._name)
+                self._db.pce_update_state( self._pce_id, 0 ) # see onrampdb.py
+            else:
+                self._logger.error('%s PCE degraded after %d failed requests'
+                                   % (self._name, breaker.failures))
+                self._db.pce_update_state( self._pce_id, PCE_STATE_DEGRADED )
+        return r
 
     def _pce_get(self, endpoint, raw=False, **kwargs):
         """Execute GET request to PCE endpoint.
@@ -80,13 +252,17 @@ class PCEAccess():
         Returns:
             JSON response object on success, 'None' on error.
         """
-        s = requests.Session()
-        url = "%s/%s/" % (self._url, endpoint)
-        r = s.get(url, params=kwargs)
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        if 'wait' in kwargs:
+            # Long-poll: the PCE holds the response for up to wait seconds.
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT + int(kwargs['wait']))
+        r = self._request("GET", endpoint, params=kwargs, timeout=timeout)
 
+        if r is None:
+            return None
         if r.status_code != 200:
             self._logger.error('%s Error: %d from GET %s: %s'
-                               % (self._name, r.status_code, url, r.text))
+                               % (self._name, r.status_code, r.url, r.text))
             return None
         else:
             if raw:
@@ -110,15 +286,15 @@ class PCEAccess():
             'True' if request was successfully processed by RXing PCE, 'False'
             if not.
         """
-        s = requests.Session()
-        url = "%s/%s/" % (self._url, endpoint)
         data = json.dumps(kwargs)
         headers = {"content-type": "application/json"}
-        r = s.post(url, data=data, headers=headers)
+        r = self._request("POST", endpoint, data=data, headers=headers)
 
+        if r is None:
+            return False
         if r.status_code != 200:
             self._logger.error('%s Error: %d from POST %s: %s'
-                               % (self._name, r.status_code, url, r.text))
+                               % (self._name, r.status_code, r.url, r.text))
             return False
 
         response = r.json()
@@ -139,13 +315,13 @@ class PCEAccess():
             'True' if request was successfully processed by RXing PCE, 'False'
             if not.
         """
-        s = requests.Session()
-        url = "%s/%s/" % (self._url, endpoint)
-        r = s.delete(url)
+        r = self._request("DELETE", endpoint)
 
+        if r is None:
+            return False
         if r.status_code != 200:
             self._logger.error('%s Error: %d from DELETE %s: %s'
-                               % (self._name, r.status_code, url, r.text))
+                               % (self._name, r.status_code, r.url, r.text))
             return False
         else:
             response = r.json()
@@ -311,7 +487,10 @@ class PCEAccess():
             HTTP response code from PCE ping request.
         """
         endpoint = "cluster/ping"
-        return self._pce_get(endpoint, raw=True).status_code
+        r = self._request("GET", endpoint)
+        if r is None:
+            return None
+        return r.status_code
 
     def check_connection(self):
         """Ping the server to see if it still available. Record status in given
@@ -322,7 +501,7 @@ class PCEAccess():
         """
         status_code = self.ping()
 
-        self._logger.debug("%scheck_connection() %d from %s"
+        self._logger.debug("%scheck_connection() %s from %s"
                            % (self._name, status_code, self._url))
 
         if status_code == 200:
@@ -427,9 +606,109 @@ class PCEAccess():
             os.makedirs(job_dir)
 
         # Write it out
-        output_file = os.path.join(job_dir, "output.txt")
-        with open(output_file, 'w') as f:
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        output_file = self._job_output_file(job_id, len(output))
+        tmp_file = output_file + ".part"
+        with self._open_job_output(tmp_file, output_file) as f:
             f.write(output)
+        self._replace_job_output(tmp_file, output_file)
+
+        return True
+
+    def _job_output_file(self, job_id, size):
+        """Return the path to store job output of the given size at. Outputs
+        of at least COMPRESS_MIN_SIZE bytes are stored gzip-compressed.
+        """
+        name = "output.txt.gz" if size >= COMPRESS_MIN_SIZE else "output.txt"
+        return os.path.join(self._pce_job_dir, str(job_id), name)
+
+    def _open_job_output(self, tmp_file, output_file):
+        """Open tmp_file for writing output destined for output_file."""
+        if output_file.endswith(".gz"):
+            return gzip.open(tmp_file, 'wb')
+        return open(tmp_file, 'wb')
+
+    def _replace_job_output(self, tmp_file, output_file):
+        """Move written output into place and remove any copy stored with the
+        other encoding.
+        """
+        os.rename(tmp_file, output_file)
+        if output_file.endswith(".gz"):
+            other_file = output_file[:-len(".gz")]
+        else:
+            other_file = output_file + ".gz"
+        if os.path.exists(other_file):
+            os.remove(other_file)
+
+    def _fetch_job_output(self, job_id, digest):
+        """Fetch the output of a finished job from the PCE into the local job
+        folder, unless the local copy already has the given digest. The
+        digest is stored in output.sha256 only if the fetched output has it.
+
+        Output is read from the PCE's jobs/JOB_ID/output endpoint in chunks.
+
+        Args:
+            job_id (int): Id of the job.
+            digest (str): SHA-256 hex digest of the job output reported by the
+                PCE. 'None' if the job has no output yet.
+
+        Returns:
+            'True' if the local copy is current, 'False' on error.
+        """
+        prefix = ("%sfetch_job_output(%s)" % (self._name, str(job_id)))
+
+        if digest is None:
+            return True
+
+        job_dir = os.path.join(self._pce_job_dir, str(job_id))
+        digest_file = os.path.join(job_dir, "output.sha256")
+
+        if os.path.exists(digest_file):
+            with open(digest_file, 'r') as f:
+                if f.read() == digest:
+                    return True
+
+        if not os.path.exists(job_dir):
+            os.makedirs(job_dir)
+
+        self._logger.debug("%s Fetching Job output..." % prefix)
+        response = self._pce_get("jobs/%d/output" % job_id)
+        if not response or response.get('status_code') != 0:
+            self._logger.error("%s Failed to fetch output" % prefix)
+            return False
+
+        output_file = self._job_output_file(job_id, response['size'])
+        tmp_file = output_file + ".part"
+        offset = 0
+        # Digest of the bytes written, to check against the PCE's digest
+        sha256 = hashlib.sha256()
+        with self._open_job_output(tmp_file, output_file) as f:
+            while True:
+                data = response['output'].encode('utf-8')
+                sha256.update(data)
+                f.write(data)
+                next_offset = response['next_offset']
+                if next_offset == offset or next_offset >= response['size']:
+                    break
+                offset = next_offset
+                response = self._pce_get("jobs/%d/output" % job_id,
+                                         offset=offset)
+                if not response or response.get('status_code') != 0:
+                    self._logger.error("%s Failed to fetch output at offset %d"
+                                       % (prefix, offset))
+                    return False
+
+        self._replace_job_output(tmp_file, output_file)
+        if sha256.hexdigest() != digest:
+            # Without output.sha256 the output is fetched again next time.
+            self._logger.error("%s Output digest %s doesn't match the PCE's %s"
+                               % (prefix, sha256.hexdigest(), digest))
+            if os.path.exists(digest_file):
+                os.remove(digest_file)
+            return False
+        with open(digest_file, 'w') as f:
+            f.write(digest)
 
         return True
 
@@ -444,6 +723,8 @@ class PCEAccess():
 
         # need relative job dir to server location
         abs_output_file = os.path.join(job_dir, "output.txt")
+        if os.path.exists(abs_output_file + ".gz"):
+            abs_output_file += ".gz"
         rel_output_file = os.path.relpath(abs_output_file, self._tmp_dir)
 
         return rel_output_file
@@ -658,45 +939,99 @@ class PCEAccess():
         # This is a temp fix (though after analysis may prove to be THE fix). #
         if 'job_id' not in job.keys():
             job['job_id'] = job_id
-        if 'output' not in job.keys():
-            job['output'] = None
         if 'state' not in job.keys():
             job['state'] = 'Setting up launch'
         #######################################################################
 
         self._logger.debug("%s job RAW %s" % (prefix, str(job)))
-        self._save_job_output( job["job_id"], job["output"] )
+        if 'output' in job.keys():
+            # PCEs without the jobs/ID/output endpoint return output inline.
+            self._save_job_output( job["job_id"], job["output"] )
+        else:
+            self._fetch_job_output( job["job_id"], job.get("output_digest") )
 
         self._logger.debug("%s Response: ID = %d/%d, State = %s" 
                            % (prefix, job["job_id"], job_id, job["state"]) )
-        state = -99
-        if job['state'] == "Setting up launch":
-            state =  1
-        elif job['state'] == "Launch failed":
-            state = -1
-        elif job['state'] == "Preprocessing":
-            state =  2
-        elif job['state'] == "Preprocess failed":
-            state = -2
-        elif job['state'] == "Scheduled":
-            state =  3
-        elif job['state'] == "Schedule failed":
-            state = -3
-        elif job['state'] == "Queued":
-            state =  4
-        elif job['state'] == "Running":
-            state =  5
-        elif job['state'] == "Run failed":
-            state = -5
-        elif job['state'] == "Postprocessing":
-            state =  6
-        elif job['state'] == "Done":
-            state =  7
+        state = _JOB_STATE_IDS.get(job['state'], -99)
 
         self._db.job_update_state(job_id, state) # see onrampdb.py
 
         return state
 
+    def update_jobs_in_db(self, job_ids=None, since=None, wait=None):
+        """Pull the state of many jobs from the PCE into the DB.
+
+        All jobs are fetched in one request to the PCE, and the job table is
+        updated in one transaction.
+
+        Args:
+            job_ids (list/None): Ids of the jobs to update. None for all jobs
+                on the PCE.
+            since (int/None): If given, only update jobs whose state changed
+                on the PCE after this PCE state version.
+            wait (int/None): With since, seconds the PCE may wait for a job
+                to change before responding, so that callers can wait for
+                changes instead of polling.
+
+        Returns:
+            Tuple (dict mapping job id to new state id, PCE state version) on
+            success, 'None' on error. The state version is only returned
+            when since is given; pass it as since of the next call to get
+            only jobs changed in between.
+        """
+        prefix = ("%supdate_jobs_in_db()" % self._name)
+
+        params = {}
+        if job_ids is not None:
+            if not job_ids:
+                return ({}, None)
+            params['ids'] = ','.join(str(int(job_id)) for job_id in job_ids)
+        if since is not None:
+            params['since'] = int(since)
+            if wait:
+                params['wait'] = int(wait)
+        response = self._pce_get("jobs", **params)
+        if not response or "jobs" not in response.keys():
+            self._logger.error("%s Failed to get jobs" % prefix)
+            return None
+
+        states = {}
+        for job in response["jobs"]:
+            job_id = int(job["job_id"])
+            if 'output' in job.keys():
+                self._save_job_output( job_id, job["output"] )
+            else:
+                self._fetch_job_output( job_id, job.get("output_digest") )
+            states[job_id] = _JOB_STATE_IDS.get(job.get('state'), -99)
+
+        self._db.job_update_states(self._pce_id, states) # see onrampdb.py
+
+        self._logger.debug("%s Updated %d jobs" % (prefix, len(states)))
+        return (states, response.get("state_version"))
+
+    def refresh_jobs(self):
+        """Pull the state of jobs changed on the PCE since the last refresh
+        into the DB, in one request.
+
+        Refreshes are serialized, so concurrent callers don't fetch the same
+        changes twice. The PCE is asked at most once every
+        JOB_REFRESH_SECONDS; calls in between pull nothing.
+
+        Returns:
+            Dict mapping job id to new state id on success, 'None' on error.
+        """
+        with self._refresh_lock:
+            if time.time() - self._last_refresh < JOB_REFRESH_SECONDS:
+                return {}
+            self._last_refresh = time.time()
+            result = self.update_jobs_in_db(since=self._job_state_version)
+            if result is None:
+                return None
+            states, version = result
+            # PCEs without state versions return every job each time.
+            self._job_state_version = version or 0
+            return states
+
     def check_on_job(self, job_id):
         job_id = int(job_id)
         prefix = ("%scheck_on_job()" % self._name)
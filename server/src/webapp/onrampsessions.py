@@ -0,0 +1,106 @@
+"""In-memory cache of active sessions
+
+  Every authenticated request used to check its apikey or auth against the
+  auth_session table, and then write the session's time_last_op. Sessions
+  found active are now remembered for SESSION_TTL seconds (and at most
+  SESSION_MAX entries, least recently used first out), so repeated checks
+  don't touch the database. Updates to time_last_op are kept in memory, one
+  per session, and written together by DBAccess.flush_sessions().
+
+  Session ids are kept as strings: apikeys arrive as strings, and auth
+  session_ids as numbers.
+
+  Sessions are dropped from the cache as soon as they are stopped (logout).
+  A session stopped some other way is noticed within SESSION_TTL seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# Seconds a session found active is trusted without asking the database
+SESSION_TTL = 60
+
+# Most sessions remembered at once
+SESSION_MAX = 10000
+
+# Seconds between writes of pending time_last_op updates
+SESSION_FLUSH_INTERVAL = 10
+
+
+class _Entry(object):
+    def __init__(self, expires):
+        self.expires = expires
+        # Checks passed for this session: None for a bare apikey check, or
+        # (user_id, username, req_admin) for an auth check
+        self.checks = set()
+
+
+class SessionCache(object):
+    """Active sessions, and pending time_last_op updates, keyed by session_id."""
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def is_active(self, session_id, check=None):
+        """Return True if session_id passed this check within the TTL."""
+        session_id = str(session_id)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None:
+                return False
+            if entry.expires <= now:
+                return False
+            # Reinsert as most recently used
+            self._entries[session_id] = entry
+            return check in entry.checks
+
+    def add(self, session_id, check=None):
+        """Remember that session_id is active and passed this check."""
+        session_id = str(session_id)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None or entry.expires <= now:
+                entry = _Entry(now + self._ttl)
+            entry.checks.add(check)
+            self._entries[session_id] = entry
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, session_id):
+        """Record an operation on session_id now, for DBAccess.flush_sessions()."""
+        session_id = str(session_id)
+        with self._lock:
+            self._pending[session_id] = time.time()
+
+    def evict(self, session_id):
+        """Forget session_id. Returns the time of its pending operation, if any."""
+        session_id = str(session_id)
+        with self._lock:
+            self._entries.pop(session_id, None)
+            return self._pending.pop(session_id, None)
+
+    def take_pending(self):
+        """Return and clear the pending operations as {session_id: time}."""
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            return pending
+
+    def restore_pending(self, pending):
+        """Put back operations that could not be written. Newer ones win."""
+        with self._lock:
+            for session_id, op_time in pending.items():
+                if self._pending.get(session_id, 0) < op_time:
+                    self._pending[session_id] = op_time
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pending.clear()
@@ -9,7 +9,9 @@ from django.http import HttpResponse
 from django.template import RequestContext
 from django.template.loader import get_template
 from django.shortcuts import render
-from ui.admin.models import job, workspace, pce, module
+from ui.admin.models import workspace, pce, module
+
+from core.job_listing import list_jobs, request_params
 
 
 
@@ -63,11 +65,12 @@ def get_all_jobs(request):
     :param request:
     :return:
     """
-    response = {
-        'status':0,
-        'status_message':'Success',
-        'jobs':list(job.objects.all().defer("output_file").values())
-    }
+    try:
+        response = list_jobs(request_params(request))
+    except ValueError as e:
+        response = {'status':-1, 'status_message':e.message}
+        return HttpResponse(json.dumps(response))
+    response.update({'status':0, 'status_message':'Success'})
     return HttpResponse(json.dumps(response))
 
 @staff_member_required(login_url='/')
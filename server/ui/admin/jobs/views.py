@@ -5,6 +5,8 @@ from django.template import Context
 from django.template.loader import get_template
 from ui.admin.models import workspace, job
 
+from core.job_listing import list_jobs, request_params
+
 # @login_required
 def main(request):
     """ Renders the main Admin dashboard on login
@@ -27,11 +29,12 @@ def get_all_jobs(request):
     :param request:
     :return:
     """
-    response = {
-        'status':1,
-        'status_message':'Success',
-        'jobs':list(job.objects.all().values())
-    }
+    try:
+        response = list_jobs(request_params(request))
+    except ValueError as e:
+        response = {'status':-1, 'status_message':e.message}
+        return HttpResponse(json.dumps(response))
+    response.update({'status':1, 'status_message':'Success'})
     return HttpResponse(json.dumps(response))
 
 # @login_required
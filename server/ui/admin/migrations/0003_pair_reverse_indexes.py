@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('admin', '0002_auto_20161108_0602'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='user_to_workspace',
+            index_together=set([('workspace', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='workspace_to_pce_module',
+            index_together=set([('pm_pair', 'workspace')]),
+        ),
+    ]
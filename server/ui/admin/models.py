@@ -44,6 +44,7 @@ class user_to_workspace(models.Model):
 
     class Meta:
         unique_together = ('user', 'workspace')
+        index_together = ('workspace', 'user')
 
 class module_to_pce(models.Model):
     pm_pair_id = models.AutoField(primary_key=True)
@@ -66,4 +67,5 @@ class workspace_to_pce_module(models.Model):
 
     class Meta:
         unique_together = ('workspace', 'pm_pair')
+        index_together = ('pm_pair', 'workspace')
 
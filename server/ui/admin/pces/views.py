@@ -5,11 +5,12 @@ from django.contrib.auth.decorators import login_required
 from django.http import HttpResponse
 from django.template import Context
 from django.template.loader import get_template
-from ui.admin.models import workspace, pce, module_to_pce, workspace_to_pce_module, job, module
+from ui.admin.models import workspace, pce, module_to_pce, workspace_to_pce_module, module
 
 from core.definitions import MODULE_STATES
 
-from core.pce_connect import PCEAccess
+from core.job_listing import list_jobs, request_params
+from core.pce_connect import get_pce_access, invalidate_pce_access
 
 success_response = {'status': 1, 'status_message': 'Success'}
 
@@ -88,7 +89,7 @@ def edit_pce(request):
         response = {'status': -1, 'status_message': 'No pce_id specified'}
         return HttpResponse(json.dumps(response))
     try:
-        pce_obj = pce.objects.get(id = pce_id)
+        pce_obj = pce.objects.get(pce_id = pce_id)
     except pce.DoesNotExist:
         response = {'status': -1, 'status_message': 'Invalid pce_id: {}'.format(pce_id)}
         return HttpResponse(json.dumps(response))
@@ -101,6 +102,7 @@ def edit_pce(request):
     pce_obj.description = post.get('description')
     pce_obj.pce_username = post.get('pce_username')
     pce_obj.save()
+    invalidate_pce_access(pce_obj.pce_id)
     response = {'status': 1, 'status_message': 'Success'}
     return HttpResponse(json.dumps(response))
 
@@ -114,7 +116,8 @@ def delete_pce(request):
     :return:
     """
     id = request.POST.dict().get("id")
-    pce.objects.filter(id=id).delete()
+    pce.objects.filter(pce_id=id).delete()
+    invalidate_pce_access(id)
     response = {'status': -1, 'status_message': 'Success'}
     return HttpResponse(json.dumps(response))
 
@@ -133,12 +136,11 @@ def get_pce_modules(request):
         response = {'status': -1, 'status_message':'No PCE ID specified'}
         return HttpResponse(json.dumps(response))
     try:
-        pm_pairs = module_to_pce.objects.filter(pce_id=int(pce_id))
-        modules = {}
+        pm_pairs = module_to_pce.objects.filter(pce_id=int(pce_id)).select_related('module')
+        modules = []
         for pair in pm_pairs:
             module = pair.module
-            if module.module_id in modules: continue
-            modules[module.module_id] = {
+            modules.append({
                 'module_name':module.module_name,
                 'module_id':module.module_id,
                 'description':module.description,
@@ -148,8 +150,8 @@ def get_pce_modules(request):
                 'src_location_type':pair.src_location_type,
                 'src_location_path':pair.src_location_path,
                 'is_visible':pair.is_visible
-            }
-        response = {'status': 1, 'status_message':'Success', 'modules':modules.values()}
+            })
+        response = {'status': 1, 'status_message':'Success', 'modules':modules}
     except Exception as e:
         response = {
             'status': -1,
@@ -198,7 +200,7 @@ def add_pce_module(request):
         
     if created:
         try:
-            connector = PCEAccess(int(pce_id))
+            connector = get_pce_access(int(pce_id))
         except Exception as e:
             response = {
                 'status':-1,
@@ -283,15 +285,10 @@ def get_pce_workspaces(request):
         response = {'status': -1, 'status_message': 'No PCE ID specified'}
         return HttpResponse(json.dumps(response))
     try:
-        workspaces = {}
-        for row in workspace_to_pce_module.objects.all():
-            if row.pm_pair.pce.pce_id == int(pce_id):
-                workspaces[row.workspace.workspace_id] = {
-                    'workspace_name':row.workspace.workspace_name,
-                    'workspace_id':row.workspace.workspace_id,
-                    'description':row.workspace.description,
-                }
-        response = {'status':1, 'status_message':'Success', 'workspaces':workspaces.values()}
+        workspaces = workspace.objects.filter(
+            workspace_to_pce_module__pm_pair__pce_id=int(pce_id)
+        ).distinct().values('workspace_name', 'workspace_id', 'description')
+        response = {'status':1, 'status_message':'Success', 'workspaces':list(workspaces)}
     except Exception as e:
         response = {
             'status':-1,
@@ -308,15 +305,14 @@ def get_pce_jobs(request):
     :param request:
     :return:
     """
-    post = request.POST.dict()
-    pce_id = post.get('pce_id')
+    params = request_params(request)
+    pce_id = params.get('pce_id')
     if not pce_id:
         response = {'status': -1, 'status_message': 'No PCE ID specified'}
         return HttpResponse(json.dumps(response))
     try:
-        fields = ['job_id', 'pce_id', 'workspace_id', 'module_id', 'job_name', 'state']
-        jobs = list(job.objects.filter(pce_id=int(pce_id)).values(*fields))
-        response = {'status': 1, 'status_message': 'Success', 'jobs':jobs}
+        response = list_jobs(params, pce_id=int(pce_id))
+        response.update({'status': 1, 'status_message': 'Success'})
     except Exception as e:
         response = {
             'status': -1,
@@ -368,7 +364,7 @@ def deploy_module(request):
         response = {'status': -1, 'status_message': 'No Module ID and/or PCE ID specified'}
         return HttpResponse(json.dumps(response))
     try:
-        connector = PCEAccess(int(pce_id))
+        connector = get_pce_access(int(pce_id))
     except Exception as e:
         response = {'status': 1, 'status_message':'Failed to create PCEAccess object',
                     'error_info':e.message}
@@ -0,0 +1,109 @@
+import json
+
+from django.contrib.auth.models import User
+from django.test import RequestFactory, TestCase
+
+from ui.admin.models import workspace, pce, module, module_to_pce, \
+    workspace_to_pce_module, user_to_workspace
+from ui.admin.pces import views as pce_views
+from ui.admin.users import views as user_views
+from ui.admin.workspaces import views as workspace_views
+from ui.public.workspace import views as public_workspace_views
+
+
+class QueryCountTest(TestCase):
+    """ The listing views make one query, however many rows they list. """
+
+    ROW_COUNTS = (2, 20)
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.admin = User.objects.create(username='admin', is_superuser=True)
+        self.user = User.objects.create(username='user')
+        self.workspace = workspace.objects.create(workspace_name='ws', description='')
+        self.pce = pce.objects.create(pce_name='pce')
+        self.rows = 0
+
+    def add_rows(self, count):
+        """ Grow every listing to count rows.
+
+        The pce gets count modules, all in self.workspace, each in its own
+        workspace too. self.user is in each of those workspaces,
+        self.workspace has count users, and count users are in no workspace.
+        """
+        for i in range(self.rows, count):
+            mod = module.objects.create(module_name='mod{}'.format(i))
+            pair = module_to_pce.objects.create(pce=self.pce, module=mod)
+            workspace_to_pce_module.objects.create(workspace=self.workspace, pm_pair=pair)
+            ws = workspace.objects.create(workspace_name='ws{}'.format(i), description='')
+            workspace_to_pce_module.objects.create(workspace=ws, pm_pair=pair)
+            user_to_workspace.objects.create(user=self.user, workspace=ws)
+            member = User.objects.create(username='member{}'.format(i))
+            user_to_workspace.objects.create(user=member, workspace=self.workspace)
+            User.objects.create(username='other{}'.format(i))
+        self.rows = count
+
+    def post(self, view, **data):
+        """ Return the JSON response of view to a POST of data, asserting it
+        made one query.
+        """
+        request = self.factory.post('/', data)
+        request.user = self.admin
+        with self.assertNumQueries(1):
+            response = view(request)
+        return json.loads(response.content)
+
+    def test_get_pce_workspaces(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(pce_views.get_pce_workspaces, pce_id=self.pce.pce_id)
+            self.assertEqual(len(response['workspaces']), count + 1)
+
+    def test_get_pce_modules(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(pce_views.get_pce_modules, pce_id=self.pce.pce_id)
+            self.assertEqual(len(response['modules']), count)
+
+    def test_public_get_pces(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(public_workspace_views.get_pces,
+                                 workspace_id=self.workspace.workspace_id)
+            self.assertEqual([row['pce_id'] for row in response['pces']], [self.pce.pce_id])
+
+    def test_get_modules_for_pce(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(public_workspace_views.get_modules_for_pce,
+                                 workspace_id=self.workspace.workspace_id,
+                                 pce_id=self.pce.pce_id)
+            self.assertEqual(len(response['modules']), count)
+
+    def test_admin_get_pces(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(workspace_views.get_pces,
+                                 workspace_id=self.workspace.workspace_id)
+            self.assertEqual(len(response['pces']), count)
+
+    def test_get_workspace_users(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(workspace_views.get_workspace_users,
+                                 workspace_id=self.workspace.workspace_id)
+            self.assertEqual(len(response['users']), count)
+
+    def test_get_potential_users(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(workspace_views.get_potential_users,
+                                 workspace_id=self.workspace.workspace_id)
+            # self.user and the users in no workspace
+            self.assertEqual(len(response['users']), count + 1)
+
+    def test_get_user_workspaces(self):
+        for count in self.ROW_COUNTS:
+            self.add_rows(count)
+            response = self.post(user_views.get_user_workspaces, user_id=self.user.id)
+            self.assertEqual(len(response['workspaces']), count)
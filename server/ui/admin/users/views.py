@@ -5,7 +5,9 @@ from django.contrib.auth.models import User
 from django.http import HttpResponse
 from django.template import Context
 from django.template.loader import get_template
-from ui.admin.models import job, user_to_workspace
+from ui.admin.models import user_to_workspace
+
+from core.job_listing import list_jobs, request_params
 
 @login_required
 def main(request):
@@ -186,16 +188,17 @@ def get_user_jobs(request):
     :param request:
     :return:
     """
-    post = request.POST.dict()
-    user = post.get('user_id')
+    params = request_params(request)
+    user = params.get('user_id')
     if not user:
         response = {'status':-1, 'status_message':'No user supplied'}
         return HttpResponse(json.dumps(response))
-    response = {
-        'status':1,
-        'status_message':'Success',
-        'jobs': list(job.objects.filter(user_id=user).defer('output_file'))
-    }
+    try:
+        response = list_jobs(params, user_id=int(user))
+    except ValueError as e:
+        response = {'status':-1, 'status_message':e.message}
+        return HttpResponse(json.dumps(response))
+    response.update({'status':1, 'status_message':'Success'})
     return HttpResponse(json.dumps(response))
 
 # @login_required
@@ -217,11 +220,12 @@ def get_user_workspaces(request):
         'status_message': 'Success',
         'workspaces':[]
     }
-    qs = user_to_workspace.objects.filter(user_id=user)
+    qs = user_to_workspace.objects.filter(user_id=user).values(
+        'workspace_id', 'workspace__workspace_name', 'workspace__description')
     for row in qs:
         response['workspaces'].append({
-            'workspace_id':row.workspace_id.workspace_id,
-            'workspace_name':row.workspace_id.workspace_name,
-            'description':row.workspace_id.description
+            'workspace_id':row['workspace_id'],
+            'workspace_name':row['workspace__workspace_name'],
+            'description':row['workspace__description']
         })
     return HttpResponse(json.dumps(response))
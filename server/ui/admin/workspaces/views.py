@@ -5,7 +5,9 @@ from django.contrib.auth.models import User
 from django.http import HttpResponse
 from django.template import Context
 from django.template.loader import get_template
-from ui.admin.models import workspace, job, workspace_to_pce_module, module_to_pce, user_to_workspace
+from ui.admin.models import workspace, workspace_to_pce_module, module_to_pce, user_to_workspace
+
+from core.job_listing import list_jobs, request_params
 
 @login_required
 def main(request):
@@ -65,15 +67,17 @@ def get_jobs(request):
     :param request:
     :return:
     """
-    workspace_id = request.POST.get('workspace_id')
+    params = request_params(request)
+    workspace_id = params.get('workspace_id')
     if workspace_id is None:
         response = {'status':-1, 'stauts_message':'No workspace_id specified'}
         return HttpResponse(json.dumps(response))
-    response = {
-        'status':1,
-        'status_message':'Success',
-        'jobs':list(job.objects.filter(workspace_id=workspace_id).values())
-    }
+    try:
+        response = list_jobs(params, workspace_id=int(workspace_id))
+    except ValueError as e:
+        response = {'status':-1, 'status_message':e.message}
+        return HttpResponse(json.dumps(response))
+    response.update({'status':1, 'status_message':'Success'})
     return HttpResponse(json.dumps(response))
 
 @login_required
@@ -89,22 +93,18 @@ def get_pces(request):
     if workspace_id is None:
         response = {'status':-1, 'stauts_message':'No workspace_id specified'}
         return HttpResponse(json.dumps(response))
-    pce_mod_pairs = {}
-    wpm_pairs = workspace_to_pce_module.objects.filter(workspace_id=int(workspace_id))
-    for row in wpm_pairs:
-        if row.pm_pair in pce_mod_pairs: continue
-        module_obj = row.pm_pair.module
-        pce_obj = row.pm_pair.pce
-        pce_mod_pairs[row.pm_pair] = {
-            'module_id':module_obj.module_id,
-            'module_name':module_obj.module_name,
-            'pce_id':pce_obj.pce_id,
-            'pce_name':pce_obj.pce_name
-        }
+    wpm_pairs = workspace_to_pce_module.objects.filter(workspace_id=int(workspace_id)).values(
+        'pm_pair__module_id', 'pm_pair__module__module_name', 'pm_pair__pce_id', 'pm_pair__pce__pce_name')
+    pce_mod_pairs = [{
+        'module_id':row['pm_pair__module_id'],
+        'module_name':row['pm_pair__module__module_name'],
+        'pce_id':row['pm_pair__pce_id'],
+        'pce_name':row['pm_pair__pce__pce_name']
+    } for row in wpm_pairs]
     response = {
         'status':True,
         'status_message':'Success',
-        'pces':pce_mod_pairs.values()
+        'pces':pce_mod_pairs
     }
     return HttpResponse(json.dumps(response))
 
@@ -121,8 +121,8 @@ def get_potential_users(request):
     if not post.get('workspace_id'):
         response = {'status':-1, 'status_message':'No workspace specified'}
         return HttpResponse(json.dumps(response))
-    qs = user_to_workspace.objects.filter(workspace_id=int(post['workspace_id']))
-    excluded_ids = [i.user.id for i in qs]
+    excluded_ids = user_to_workspace.objects.filter(
+        workspace_id=int(post['workspace_id'])).values('user_id')
     response = {
         'status': 1,
         'status_message': 'Success',
@@ -150,11 +150,11 @@ def get_workspace_users(request):
     if workspace_id is None:
         response = {'status':-1, 'stauts_message':'No workspace_id specified'}
         return HttpResponse(json.dumps(response))
-    qs = user_to_workspace.objects.filter(workspace_id=int(workspace_id))
+    qs = user_to_workspace.objects.filter(workspace_id=int(workspace_id)).values('user_id', 'user__username')
     response = {
         'status':1,
         'status_message':'Success',
-        'users':[{"user_id":i.user.id, "username":i.user.username} for i in qs]
+        'users':[{"user_id":i['user_id'], "username":i['user__username']} for i in qs]
     }
     return HttpResponse(json.dumps(response))
 
@@ -5,7 +5,9 @@ from django.http import HttpResponse
 from django.template import Context
 from django.template.loader import get_template
 
-from ui.admin.models import user_to_workspace, job
+from ui.admin.models import user_to_workspace
+
+from core.job_listing import list_jobs, request_params
 
 
 @login_required
@@ -31,13 +33,14 @@ def get_workspaces(request):
     :return:
     """
 
-    ws_qs = user_to_workspace.objects.filter(user_id=request.user.id)
+    ws_qs = user_to_workspace.objects.filter(user_id=request.user.id).values(
+        'workspace_id', 'workspace__workspace_name')
     response = {
         'status':0,
         'status_message':'Success',
         'workspaces':[{
-            'workspace_id':i.workspace.workspace_id,
-            'workspace_name':i.workspace.workspace_name
+            'workspace_id':i['workspace_id'],
+            'workspace_name':i['workspace__workspace_name']
         } for i in ws_qs]
     }
     return HttpResponse(json.dumps(response))
@@ -51,9 +54,10 @@ def get_jobs(request):
     :param request:
     :return:
     """
-    response = {
-        'status':0,
-        'status_message':'Success',
-        'jobs':list(job.objects.filter(user_id=request.user.id).values())
-    }
+    try:
+        response = list_jobs(request_params(request), user_id=request.user.id)
+    except ValueError as e:
+        response = {'status':-1, 'status_message':e.message}
+        return HttpResponse(json.dumps(response))
+    response.update({'status':0, 'status_message':'Success'})
     return HttpResponse(json.dumps(response))
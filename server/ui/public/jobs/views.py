@@ -8,7 +8,8 @@ from django.template.loader import get_template
 
 from ui.admin.models import workspace, workspace_to_pce_module, job
 
-from core.pce_connect import PCEAccess
+from core.job_listing import list_jobs, request_params
+from core.pce_connect import get_pce_access
 
 
 @login_required
@@ -43,7 +44,7 @@ def get_job(request):
         }
         return HttpResponse(json.dumps(response))
     job_row = job.objects.get(job_id=int(job_id))
-    conn = PCEAccess(job_row.pce.pce_id)
+    conn = get_pce_access(job_row.pce_id)
     status = conn.check_on_job(int(job_id))
     response = {
         'status':True,
@@ -64,10 +65,10 @@ def get_user_jobs(request):
     :param request: Django request object
     :return: HttpResponse
     """
-    username = request.user
-    response = {
-        'status':True,
-        'status_message':'Success',
-        'jobs':list(job.objects.filter(user__username=username).values())
-    }
+    try:
+        response = list_jobs(request_params(request), user_id=request.user.id)
+    except ValueError as e:
+        response = {'status':False, 'status_message':e.message}
+        return HttpResponse(json.dumps(response))
+    response.update({'status':True, 'status_message':'Success'})
     return HttpResponse(json.dumps(response))
@@ -7,9 +7,9 @@ from django.http import HttpResponse
 from django.template import Context
 from django.template.loader import get_template
 
-from ui.admin.models import workspace, workspace_to_pce_module, job
+from ui.admin.models import workspace, pce, module, job
 
-from core.pce_connect import PCEAccess
+from core.pce_connect import get_pce_access
 
 
 @login_required
@@ -69,18 +69,16 @@ def get_pces(request):
         }
         return HttpResponse(json.dumps(response))
     try:
-        pairs = workspace_to_pce_module.objects.filter(workspace_id=int(ws_id))
-        pces = {}
-        for wpm_pair in pairs:
-            pce = wpm_pair.pm_pair.pce
-            if pce.pce_id in pces: continue
-            pces[pce.pce_id] = {
-                'pce_id':pce.pce_id,
-                'pce_name':pce.pce_name,
-                'state':pce.state,
-                'url':"{}:{}".format(pce.ip_addr, pce.ip_port)
-            }
-        response = {'success':True, 'status_message':'Success', 'pces':pces.values()}
+        rows = pce.objects.filter(
+            module_to_pce__workspace_to_pce_module__workspace_id=int(ws_id)
+        ).distinct().values('pce_id', 'pce_name', 'state', 'ip_addr', 'ip_port')
+        pces = [{
+            'pce_id':row['pce_id'],
+            'pce_name':row['pce_name'],
+            'state':row['state'],
+            'url':"{}:{}".format(row['ip_addr'], row['ip_port'])
+        } for row in rows]
+        response = {'success':True, 'status_message':'Success', 'pces':pces}
     except Exception as e:
         response = {'success':False, 'status_message':'Error retrieving requested data',
                     'error_info':e.message}
@@ -108,18 +106,12 @@ def get_modules_for_pce(request):
     try:
         # pce_access = PCEAccess(int(pce_id))
         # pce_access.refresh_module_states(int(pce_id))
-        pairs = workspace_to_pce_module.objects.filter(workspace_id=int(ws_id))
-        modules = {}
-        for wpm_pair in pairs:
-            pce = wpm_pair.pm_pair.pce
-            if pce.pce_id != int(pce_id): continue
-            module = wpm_pair.pm_pair.module
-            modules[module.module_id] = {
-                'module_id':module.module_id,
-                'module_name':module.module_name,
-                'description':module.description
-            }
-        response = {'success':True, 'status_message':'Success', 'modules':modules.values()}
+        # Both conditions in one filter() so they apply to the same pair.
+        modules = module.objects.filter(
+            module_to_pce__pce_id=int(pce_id),
+            module_to_pce__workspace_to_pce_module__workspace_id=int(ws_id)
+        ).distinct().values('module_id', 'module_name', 'description')
+        response = {'success':True, 'status_message':'Success', 'modules':list(modules)}
     except Exception as e:
         response = {'success':False, 'status_message':'Error retrieving requested data',
                     'error_info':e.message}
@@ -145,7 +137,7 @@ def get_module_options(request):
         }
         return HttpResponse(json.dumps(response))
 
-    pce_access = PCEAccess(int(pce_id))
+    pce_access = get_pce_access(int(pce_id))
     pce_access.refresh_module_states(module_id=int(module_id))
     options = pce_access.get_module_uioptions(int(module_id), True)
     meta = pce_access.get_module_metadata(int(module_id), True)
@@ -179,7 +171,7 @@ def launch_job(request):
 
     user = User.objects.get(username=request.user)
 
-    pce_conn = PCEAccess(int(pce_id))
+    pce_conn = get_pce_access(int(pce_id))
     pce_conn.refresh_module_states(int(module_id))
     resp = pce_conn.launch_a_job(user.id, int(workspace_id), int(module_id), job_data)
 
@@ -75,18 +75,12 @@ function AdminDashboardViewModel() {
         })
 
         // Get jobs and populate the table
-        $.ajax({
-            url:'/admin/Dashboard/GetJobs/',
-            type:'GET',
-            dataType: 'json',
-            success: function(data) {
-                // loop over the users in the response and push them to the array
-                for (var x = 0; x < data.jobs.length; x++){
-                    var job_data = data.jobs[x];
-                    self.Jobslist.push(new Job(job_data, true, false));
-                }
+        getJobPages('/admin/Dashboard/GetJobs/', 'GET', {}, function(jobs) {
+            // loop over the jobs in the page and push them to the array
+            for (var x = 0; x < jobs.length; x++){
+                self.Jobslist.push(new Job(jobs[x], true, false));
             }
-        })
+        });
 
         // Get workspaces and populate the table
         $.ajax({
@@ -110,16 +110,10 @@ function AdminJobsViewModel() {
 	self.Jobslist.removeAll();
 
 	// get data from server
-	$.ajax({
-	    url:'/admin/Jobs/GetAll',
-	    type:'GET',
-	    dataType:'json',
-	    success: function(response) {
-		for (var x = 0; x < response.jobs.length; x++){
-                    var job_data = response.jobs[x];
-                    self.Jobslist.push(new myJob(job_data));
+	getJobPages('/admin/Jobs/GetAll', 'GET', {}, function(jobs) {
+		for (var x = 0; x < jobs.length; x++){
+                    self.Jobslist.push(new myJob(jobs[x]));
                 }
-	    }
 	});
     });
 }
@@ -71,22 +71,13 @@ function adminPCE (data) {
 
 	self.refreshJobs = function () {
 		self.Jobslist.removeAll();
-		$.ajax({
-		    url: '/admin/PCEs/GetPCEJobs/',
-		    type:'POST',
-		    dataType:'json',
-		    data: {'pce_id':self.id},
-		    success: function(response) {
-		        if (response.status) {
-		            for (var x = 0; x < response.jobs.length; x++){
-                        var job_data = response.jobs[x];
-                        self.Jobslist.push(new Job(job_data, true, false));
-                    }
-		        } else {
-		            alert(response.status_message);
-		        }
-		    }
-		})
+		getJobPages('/admin/PCEs/GetPCEJobs/', 'POST', {'pce_id':self.id}, function(jobs) {
+		    for (var x = 0; x < jobs.length; x++){
+                self.Jobslist.push(new Job(jobs[x], true, false));
+            }
+		}, function(response) {
+		    alert(response.status_message);
+		});
 	}
 
 	self.editPCE = function () {
@@ -26,21 +26,12 @@ function UserProfile(data) {
 		// get all user data
 
         // get jobs for this user
-        $.ajax({
-            url: '/admin/Users/Jobs/',
-            method: 'POST',
-            //headers: {'X-CSRFToken': csrftoken},
-            dataType: 'json',
-            data: {'user':self.id()},// 'csrfmiddlewaretoken':csrftoken},
-            success: function(data) {
-                self.Jobslist.removeAll();
-		        if(data.jobs) {
-		            data.job.forEach(function(job){
-			        self.JobsList.push(new Job(job, true, false));
-		            });
-		        }
-            }
-        })
+        self.Jobslist.removeAll();
+        getJobPages('/admin/Users/Jobs/', 'POST', {'user_id':self.id()}, function(jobs) {
+            jobs.forEach(function(job){
+                self.Jobslist.push(new Job(job, true, false));
+            });
+        });
 
 
 		// get workspaces for this user
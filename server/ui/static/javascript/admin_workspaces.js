@@ -40,18 +40,11 @@ function adminWorkspace(data){
 	self.refreshJobs = function () {
 		self.Jobslist.removeAll();
 
-		$.ajax({
-		    url: '/admin/Workspaces/Jobs',
-		    type:'POST',
-		    dataType: 'json',
-		    data: {'workspace_id':self.id()},
-		    success: function (data) {
-		        for (var x = 0; x < data.jobs.length; x++){
-					var job_data = data.jobs[x];
-					self.Jobslist.push(new Job(job_data, true, false));
-				}
+		getJobPages('/admin/Workspaces/Jobs', 'POST', {'workspace_id':self.id()}, function (jobs) {
+		    for (var x = 0; x < jobs.length; x++){
+				self.Jobslist.push(new Job(jobs[x], true, false));
 			}
-		})
+		});
 
 
 	};
@@ -92,6 +92,34 @@ function Workspace(data, view){
 	}
 }
 
+/*
+    Job listings are sent a page at a time. This requests the jobs at url,
+    passes the jobs of each page to addJobs, and requests the next page with
+    the next_cursor of the last one until there are no more pages. Responses
+    without jobs are passed to onError, if given.
+*/
+function getJobPages(url, type, data, addJobs, onError){
+	$.ajax({
+	    url: url,
+	    type: type,
+	    dataType: 'json',
+	    data: data,
+	    success: function(response) {
+	        if (!response.jobs) {
+	            if (onError) {
+	                onError(response);
+	            }
+	            return;
+	        }
+	        addJobs(response.jobs);
+	        if (response.next_cursor != null) {
+	            getJobPages(url, type, $.extend({}, data, {'cursor': response.next_cursor}),
+	                        addJobs, onError);
+	        }
+	    }
+	});
+}
+
 self.logout = function (){
 
 	// send post to server
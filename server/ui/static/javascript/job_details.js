@@ -29,17 +29,11 @@ function JobDetailsViewModel() {
 		self.selectedJob(null);
 		self.Jobslist.removeAll();
 
-		$.ajax({
-		    url:'/public/Jobs/UserJobs/',
-		    type:'GET',
-		    dataType:'json',
-		    success: function(response) {
-		        for (var x = 0; x < response.jobs.length; x++){
-					var job_data = response.jobs[x];
-					self.Jobslist.push(new myJob(job_data));
-				}
-		    }
-		})
+		getJobPages('/public/Jobs/UserJobs/', 'GET', {}, function(jobs) {
+		    for (var x = 0; x < jobs.length; x++){
+				self.Jobslist.push(new myJob(jobs[x]));
+			}
+		});
     }
 
 
@@ -12,17 +12,11 @@ function UserDashboardViewModel() {
 
 
 		// get jobs for this user
-		$.ajax({
-		    url: '/public/Dashboard/GetJobs/',
-		    type:'GET',
-		    dataType:'json',
-		    success: function(data) {
-		        for (var x = 0; x < data.jobs.length; x++){
-                    var job_data = data.jobs[x];
-                    self.Jobslist.push(new Job(job_data, false, true));
-                }
-		    }
-		})
+		getJobPages('/public/Dashboard/GetJobs/', 'GET', {}, function(jobs) {
+		    for (var x = 0; x < jobs.length; x++){
+                self.Jobslist.push(new Job(jobs[x], false, true));
+            }
+		});
 
 		/*
 		    get workspaces for this user
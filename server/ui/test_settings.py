@@ -0,0 +1,16 @@
+"""
+Django settings for running the ui tests.
+
+Same as ui.settings, with an sqlite database so no MySQL server is needed:
+
+    python manage.py test --settings=ui.test_settings ui core
+"""
+
+from ui.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'test.sqlite3'),
+    }
+}